@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of verifying signed requests.
+
+Compares the cost per request of verifying a signed request from scratch,
+with the HMAC key set up once, and from the cache of verified requests.
+
+    python benchmarks/bench_signed_request.py
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from facebook.signed_request import SignedRequestVerifier  # noqa
+
+SECRET = "936f45c831801a62d24493e015d06479"
+
+
+def make_signed_request(user_id):
+    data = {"algorithm": "HMAC-SHA256", "code": "x" * 200,
+            "issued_at": int(time.time()), "user_id": str(user_id)}
+    payload = base64.urlsafe_b64encode(
+        json.dumps(data).encode("utf-8")).rstrip(b"=")
+    sig = hmac.new(SECRET.encode("ascii"), payload, hashlib.sha256).digest()
+    return (base64.urlsafe_b64encode(sig).rstrip(b"=") + b"." +
+            payload).decode("ascii")
+
+
+def main(number=20000):
+    signed_requests = [make_signed_request(i) for i in range(1000)]
+    uncached = SignedRequestVerifier(SECRET, cache_size=0)
+    cached = SignedRequestVerifier(SECRET, cache_size=len(signed_requests))
+    cached.verify_many(signed_requests)
+
+    def run(verifier):
+        for i in range(number):
+            verifier.verify(signed_requests[i % len(signed_requests)])
+
+    def run_new_key():
+        # Like Auth.parse_signed_request() used to, setting up the
+        # verifier (and the HMAC key) for every request.
+        for i in range(number):
+            SignedRequestVerifier(SECRET, cache_size=0).verify(
+                signed_requests[i % len(signed_requests)])
+
+    for name, func in [("new key per request", run_new_key),
+                       ("precomputed key", lambda: run(uncached)),
+                       ("cached", lambda: run(cached))]:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print("{0:<20} {1:8.2f} us/request".format(
+            name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
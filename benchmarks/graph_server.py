@@ -0,0 +1,241 @@
+"""
+A local stand-in for the Graph API, for benchmarks that run offline.
+
+The server answers the calls the SDK makes with canned data, after a
+simulated network latency:
+
+- GET /v2.2/<id> returns an object with an ETag, and 304 when the
+  If-None-Match header matches it.
+- GET /v2.2/?ids=<ids> returns an object per id.
+- GET /v2.2/<id>/<edge> returns pages of items with cursor pagination,
+  limit items at a time (25 by default), up to the server's edge_size.
+- GET /v2.2/<id>/picture returns image bytes of the server's image_size.
+- GET /v2.2/oauth/access_token returns an access token.
+- POST /v2.2/ with a batch parameter returns a response per operation.
+- POST /v2.2/<id>/photos (or any other POST) reads the body and returns
+  an id.
+
+Every response carries an X-App-Usage header, like the Graph API does.
+GraphData has the responses without the HTTP server, so they can also be
+served from memory.
+
+    server = GraphServer(latency=0.02).start()
+    graph = facebook.GraphAPI("token", graph_url=server.url)
+    ...
+    server.stop()
+
+Run this module to serve from another process, on a fixed port or, with
+--port 0, a free one:
+
+    python benchmarks/graph_server.py --port 8000 --latency 20
+"""
+import argparse
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let Nagle's algorithm
+    # hold back the body until the client acknowledges the headers.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET", b"")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.handle_request("POST", self.rfile.read(length))
+
+    def handle_request(self, method, body):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        form = {}
+        if body and not self.headers.get("Content-Type", "").startswith(
+                "multipart/"):
+            form = dict((k, v[0]) for k, v in parse_qs(
+                body.decode("utf-8")).items())
+        status, headers, content = self.server.graph.handle(
+            method, url.path, query, form, len(body),
+            self.headers.get("If-None-Match"))
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class GraphData(object):
+    """
+    The canned responses of the stand-in, see handle().
+
+    Every request waits latency seconds, plus a random jitter of up to
+    jitter seconds from a seeded generator, so runs are comparable.
+    """
+
+    url = "http://127.0.0.1/"
+
+    def __init__(self, latency=0.0, jitter=0.0, edge_size=500,
+                 image_size=256 * 1024, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.edge_size = edge_size
+        self.image = bytes(bytearray(range(256))) * (image_size // 256)
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, query, form, length, etag=None):
+        """
+        Answers a request for path, with query and form parameters and a
+        body of length bytes. Returns the status, headers and content.
+        """
+        self.delay()
+        parts = path.strip("/").split("/")[1:]
+        status, content_type, extra = 200, "application/json", {}
+        if method == "POST" and parts in ([], [""]):
+            body = self.batch(json.loads(form["batch"]))
+        elif method == "POST":
+            body = {"id": "photo_{0}".format(length),
+                    "post_id": "{0}_{1}".format(parts[0], length)}
+        elif parts in ([], [""]):
+            ids = query.get("ids", "").split(",")
+            body = dict((id, self.object(id, query)) for id in ids)
+        elif parts == ["oauth", "access_token"]:
+            body = {"access_token": "token-" + query.get("code", "app"),
+                    "token_type": "bearer", "expires_in": 5183944}
+        elif len(parts) == 2 and parts[1] == "picture":
+            body, content_type = self.image, "image/jpeg"
+        elif len(parts) == 2:
+            body = self.page(path, parts[0], parts[1], query)
+        else:
+            body = self.object(parts[0], query)
+            extra["ETag"] = '"{0}"'.format(hashlib.md5(json.dumps(
+                body, sort_keys=True).encode("utf-8")).hexdigest())
+            if etag == extra["ETag"]:
+                status, body, content_type = 304, b"", None
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        headers = {"X-App-Usage": json.dumps(self.usage())}
+        if content_type:
+            headers["Content-Type"] = content_type
+        headers.update(extra)
+        return status, headers, body
+
+    def delay(self):
+        with self._lock:
+            self.requests += 1
+            jitter = self._random.random() * self.jitter
+        if self.latency or jitter:
+            time.sleep(self.latency + jitter)
+
+    def usage(self):
+        with self._lock:
+            return {"call_count": self.requests % 100, "total_time": 1,
+                    "total_cputime": 1}
+
+    def object(self, id, query):
+        fields = query.get("fields", "id,name,created_time").split(",")
+        values = {"name": "Object {0}".format(id),
+                  "created_time": "2015-01-01T00:00:00+0000",
+                  "message": "Message of {0} ".format(id) * 4}
+        result = dict((field, values.get(field, field)) for field in fields)
+        result["id"] = id
+        return result
+
+    def page(self, path, id, edge, query):
+        limit = int(query.get("limit", 25))
+        start = int(query.get("after", 0))
+        end = min(start + limit, self.edge_size)
+        items = [{"id": "{0}_{1}".format(id, i),
+                  "message": "{0} {1} of {2}".format(edge, i, id),
+                  "created_time": "2015-01-01T00:00:00+0000"}
+                 for i in range(start, end)]
+        page = {"data": items, "paging": {"cursors": {
+            "before": str(start), "after": str(end)}}}
+        if end < self.edge_size:
+            page["paging"]["next"] = "{0}{1}?limit={2}&after={3}".format(
+                self.url, path.lstrip("/"), limit, end)
+            if "access_token" in query:
+                page["paging"]["next"] += "&access_token=" + query[
+                    "access_token"]
+        return page
+
+    def batch(self, operations):
+        responses = []
+        for operation in operations:
+            body = {"id": operation["relative_url"].split("?")[0]}
+            responses.append({"code": 200, "headers": [],
+                              "body": json.dumps(body)})
+        return responses
+
+
+class GraphServer(GraphData):
+    """
+    Serves the stand-in Graph API on localhost in a background thread.
+    """
+
+    def __init__(self, port=0, **kwargs):
+        super(GraphServer, self).__init__(**kwargs)
+        self._httpd = _ThreadingHTTPServer(("127.0.0.1", port),
+                                           GraphRequestHandler)
+        self._httpd.graph = self
+        self.url = "http://127.0.0.1:{0}/".format(
+            self._httpd.server_address[1])
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="latency per request in milliseconds")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="random extra latency per request in ms")
+    args = parser.parse_args()
+    server = GraphServer(args.port, latency=args.latency / 1000.0,
+                         jitter=args.jitter / 1000.0).start()
+    print("Serving on {0}".format(server.url))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""
+Offline benchmark suite of the SDK.
+
+Runs the common calls against a local stand-in Graph API server (see
+graph_server.py) and reports their throughput and latency percentiles.
+The results are written as JSON, so runs on different commits can be
+compared:
+
+    python benchmarks/run.py --output before.json
+    git checkout my-branch
+    python benchmarks/run.py --output after.json --compare before.json
+
+Use --latency to simulate the round trip time to Facebook, and --only to
+run some of the benchmarks. --transport picks the transport: requests (the
+default), http2, or memory to measure the SDK without any network.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import facebook  # noqa
+from facebook.cache import ResponseCache  # noqa
+from facebook.jsoncodec import get_codec  # noqa
+from facebook.metrics import Histogram  # noqa
+from facebook.transport import HTTP2Transport, MemoryTransport, Response  # noqa
+from graph_server import GraphData  # noqa
+
+try:
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from urlparse import parse_qs, urlsplit
+
+SECRET = "936f45c831801a62d24493e015d06479"
+IMAGE = bytes(bytearray(range(256))) * 1024
+
+
+class ServerProcess(object):
+    """
+    Runs graph_server.py in a child process, so the server doesn't compete
+    with the benchmarked client for the GIL.
+    """
+
+    def __init__(self, latency=0, jitter=0):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "graph_server.py")
+        self.process = subprocess.Popen(
+            [sys.executable, script, "--port", "0", "--latency",
+             str(latency), "--jitter", str(jitter)],
+            stdout=subprocess.PIPE)
+        line = self.process.stdout.readline().decode("ascii")
+        self.url = line.split()[-1]
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class MemoryServer(GraphData):
+    """Serves the stand-in's responses through a MemoryTransport."""
+
+    def respond(self, method, url, kwargs):
+        split = urlsplit(url)
+        query = dict((k, v[0]) for k, v in parse_qs(split.query).items())
+        query.update(kwargs["params"] or {})
+        data = kwargs["data"]
+        form, length = {}, 0
+        if hasattr(data, "read"):
+            length = len(data.read())
+        elif data:
+            form = data
+        status, headers, content = self.handle(
+            method, split.path, query, form, length,
+            (kwargs["headers"] or {}).get("If-None-Match"))
+        return Response(status, headers, content, url)
+
+    def stop(self):
+        pass
+
+
+class Environment(object):
+    """Makes the GraphAPI and Auth instances for the benchmarks."""
+
+    def __init__(self, transport, latency=0, jitter=0):
+        if transport == "memory":
+            self.server = MemoryServer(latency / 1000.0, jitter / 1000.0)
+            self.transport = MemoryTransport(self.server.respond)
+        else:
+            self.server = ServerProcess(latency, jitter)
+            self.transport = None
+            if transport == "http2":
+                self.transport = HTTP2Transport()
+        self.url = self.server.url
+
+    def graph(self, **kwargs):
+        return facebook.GraphAPI("token", graph_url=self.url,
+                                 transport=self.transport, **kwargs)
+
+    def auth(self):
+        return facebook.Auth("app", SECRET, "http://localhost/",
+                             graph_url=self.url, transport=self.transport)
+
+    def stop(self):
+        self.server.stop()
+
+
+def make_signed_request(user_id):
+    data = {"algorithm": "HMAC-SHA256", "code": "x" * 200,
+            "issued_at": int(time.time()), "user_id": str(user_id)}
+    payload = base64.urlsafe_b64encode(
+        json.dumps(data).encode("utf-8")).rstrip(b"=")
+    sig = hmac.new(SECRET.encode("ascii"), payload, hashlib.sha256).digest()
+    return (base64.urlsafe_b64encode(sig).rstrip(b"=") + b"." +
+            payload).decode("ascii")
+
+
+def bench_get_object(env, number):
+    graph = env.graph()
+    return lambda i: graph.get_object(str(i), fields="id,name")
+
+
+def bench_get_object_cached(env, number):
+    graph = env.graph(cache=ResponseCache(ttl=0))
+    # Every call is revalidated with its ETag.
+    return lambda i: graph.get_object(str(i % 10), fields="id,name")
+
+
+def bench_get_objects(env, number):
+    graph = env.graph()
+    ids = [str(i) for i in range(200)]
+    return lambda i: graph.get_objects(ids, fields="id,name")
+
+
+def bench_get_connections(env, number):
+    graph = env.graph()
+    return lambda i: graph.get_connections(str(i), "feed", limit=100)
+
+
+def bench_iter_connections(env, number):
+    graph = env.graph()
+
+    def run(i):
+        for _ in graph.iter_connections(str(i), "feed", limit=100):
+            pass
+    return run
+
+
+def bench_fan_out(env, number):
+    graph = env.graph(max_workers=8)
+    calls = [("GET", str(i), {"fields": "id,name"}) for i in range(50)]
+    return lambda i: list(graph.fan_out(calls))
+
+
+def bench_batch(env, number):
+    graph = env.graph()
+    operations = [{"method": "GET", "relative_url": str(i)}
+                  for i in range(50)]
+    return lambda i: graph.batch(operations)
+
+
+def bench_put_photo(env, number):
+    graph = env.graph()
+    return lambda i: graph.put_photo(io.BytesIO(IMAGE), message="Photo")
+
+
+def bench_download(env, number):
+    graph = env.graph()
+
+    def run(i):
+        for _ in graph.iter_download("me/picture"):
+            pass
+    return run
+
+
+def bench_token_exchange(env, number):
+    auth = env.auth()
+    return lambda i: auth.get_access_token_from_code("code{0}".format(i))
+
+
+def bench_parse_signed_request(env, number):
+    auth = facebook.Auth("app", SECRET, "http://localhost/")
+    signed_requests = [make_signed_request(i) for i in range(number)]
+    return lambda i: auth.parse_signed_request(signed_requests[i])
+
+
+BENCHMARKS = [
+    # name, setup function, calls relative to --number
+    ("get_object", bench_get_object, 1),
+    ("get_object_cached", bench_get_object_cached, 1),
+    ("get_objects", bench_get_objects, 0.1),
+    ("get_connections", bench_get_connections, 1),
+    ("iter_connections", bench_iter_connections, 0.1),
+    ("fan_out", bench_fan_out, 0.1),
+    ("batch", bench_batch, 0.5),
+    ("put_photo", bench_put_photo, 0.5),
+    ("download", bench_download, 0.5),
+    ("token_exchange", bench_token_exchange, 1),
+    ("parse_signed_request", bench_parse_signed_request, 100),
+]
+
+
+def run_benchmark(setup, env, number):
+    call = setup(env, number)
+    call(0)  # Warm up connections and caches.
+    histogram = Histogram(start=0.000001, factor=1.05, buckets=400)
+    start = timeit.default_timer()
+    for i in range(number):
+        before = timeit.default_timer()
+        call(i)
+        histogram.record(timeit.default_timer() - before)
+    seconds = timeit.default_timer() - start
+    return {
+        "calls": number,
+        "seconds": seconds,
+        "calls_per_second": number / seconds,
+        "mean_ms": histogram.mean * 1000,
+        "p50_ms": histogram.percentile(50) * 1000,
+        "p90_ms": histogram.percentile(90) * 1000,
+        "p99_ms": histogram.percentile(99) * 1000,
+        "max_ms": histogram.max * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints the change in throughput per benchmark."""
+    print("\n{0:<22} {1:>12} {2:>12} {3:>8}".format(
+        "benchmark", "before/s", "after/s", "change"))
+    for name, result in sorted(results["benchmarks"].items()):
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            continue
+        change = (result["calls_per_second"] /
+                  before["calls_per_second"] - 1) * 100
+        print("{0:<22} {1:12.1f} {2:12.1f} {3:+7.1f}%".format(
+            name, before["calls_per_second"], result["calls_per_second"],
+            change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SDK against a local Graph API stand-in.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="simulated latency per request in ms")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="random extra latency per request in ms")
+    parser.add_argument("--number", type=int, default=200,
+                        help="calls per benchmark with one round trip")
+    parser.add_argument("--transport", default="requests",
+                        choices=["requests", "http2", "memory"])
+    parser.add_argument("--only", action="append",
+                        help="run only this benchmark, may be repeated")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run")
+    args = parser.parse_args(argv)
+
+    env = Environment(args.transport, args.latency, args.jitter)
+    results = {
+        "commit": git_commit(),
+        "version": facebook.__version__,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "json_codec": get_codec().name,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "transport": args.transport,
+        "latency_ms": args.latency,
+        "jitter_ms": args.jitter,
+        "benchmarks": {},
+    }
+    try:
+        print("{0:<22} {1:>8} {2:>12} {3:>10} {4:>10}".format(
+            "benchmark", "calls", "calls/s", "p50 ms", "p99 ms"))
+        for name, setup, weight in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            number = max(1, int(args.number * weight))
+            result = run_benchmark(setup, env, number)
+            results["benchmarks"][name] = result
+            print("{0:<22} {1:8d} {2:12.1f} {3:10.3f} {4:10.3f}".format(
+                name, number, result["calls_per_second"], result["p50_ms"],
+                result["p99_ms"]))
+    finally:
+        env.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    return results
+
+
+if __name__ == "__main__":
+    main()
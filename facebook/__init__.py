@@ -22,6 +22,10 @@ implement Facebook authentication. Read more about the Graph API at
 http://developers.facebook.com/docs/api. You can download the Facebook
 JavaScript SDK at http://github.com/facebook/connect-js/.
 
+Importing the package is cheap: the HTTP stack (requests), the thread pool
+and the optional JSON accelerators are only imported when first needed, so
+code that only verifies signed requests doesn't load them.
+
 If your application is using Google AppEngine's webapp framework, your
 usage of this module might look like this:
 
@@ -35,14 +39,20 @@ if user:
 
 """
 
-import base64
-import hashlib
-import hmac
-import json
-
-import requests
+import os
+import re
+import threading
+import timeit
+from collections import deque
 
 from . import version
+from .jsoncodec import LazyPage, get_codec
+from .metrics import RequestEvent, notify
+from .ratelimit import parse_usage
+from .signed_request import SignedRequestVerifier
+from .tokens import TokenManager, get_appsecret_proof
+from .transport import (RequestsTransport, get_default_session,  # noqa
+                        make_session)
 
 try:
     from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
@@ -50,9 +60,33 @@ except ImportError:
     from urlparse import parse_qs, urlsplit, urlunsplit
     from urllib import urlencode
 
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
 
 __version__ = version.__version__
 
+GRAPH_URL = "https://graph.facebook.com/"
+# Size of the blocks downloads are read and written in.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# The Graph API accepts at most this many operations in a single batch.
+BATCH_SIZE = 50
+# Number of ids get_objects() asks for in a single request.
+IDS_CHUNK_SIZE = 50
+# Types of results GraphAPI can return, see facebook.objects.
+RESULT_TYPES = ("dicts", "objects", "columns")
+_VERSION_RE = re.compile(r"^v\d+\.\d+$")
+_ID_RE = re.compile(r"^\d+(_\d+)?$")
+# JSONPath references to the result of an earlier named batch operation.
+_BATCH_REFERENCE_RE = re.compile(r"{result=([^:}]+):")
+
+# Marks the threads of a GraphAPI executor, see GraphAPI._map().
+_worker = threading.local()
+# The RequestEvent of the call a thread is making, see GraphAPI._observe().
+_observed = threading.local()
+
 
 class GraphAPI(object):
     """A client for the Facebook Graph API.
@@ -84,12 +118,33 @@ class GraphAPI(object):
 
     """
 
-    def __init__(self, access_token=None, timeout=None, version="2.2"):
+    def __init__(self, access_token=None, timeout=None, version="2.2",
+                 session=None, graph_url=GRAPH_URL, max_workers=4,
+                 executor=None, cache=None, rate_limiter=None,
+                 retry_policy=None, json_codec=None, lazy_pages=False,
+                 app_secret=None, observers=None, transport=None,
+                 results="dicts"):
         version = str(version)  # backwards compatibility for floats
         valid_api_versions = ["1.0", "2.0", "2.1", "2.2"]
 
         self.access_token = access_token
         self.timeout = timeout
+        self._session = session
+        self._transport = transport
+        self.graph_url = graph_url
+        self.max_workers = max_workers
+        self._executor = executor
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        self.json = get_codec(json_codec)
+        self.lazy_pages = lazy_pages
+        self.results = results
+        self.observers = list(observers or ())
+        self.appsecret_proof = None
+        if app_secret is not None:
+            self.appsecret_proof = get_appsecret_proof(app_secret)
+        self._executor_lock = threading.Lock()
 
         if version not in valid_api_versions:
             raise GraphAPIError("Valid API versions are {0}".format(
@@ -97,22 +152,307 @@ class GraphAPI(object):
 
         self.version = "v" + version
 
+        if results not in RESULT_TYPES:
+            raise GraphAPIError("Valid result types are {0}".format(
+                ", ".join(RESULT_TYPES)))
+
+    @property
+    def session(self):
+        """The requests Session used for all HTTP calls of this instance.
+
+        Unless one was passed in, this is the module wide session returned
+        by get_default_session(), so connections are reused across
+        instances.
+        """
+        if self._session is None:
+            return get_default_session()
+        return self._session
+
+    @property
+    def transport(self):
+        """The transport sending the HTTP requests of this instance.
+
+        Unless one was passed in, this is a RequestsTransport using the
+        session. See facebook.transport.
+        """
+        if self._transport is None:
+            self._transport = RequestsTransport(self._session)
+        return self._transport
+
+    @property
+    def usage(self):
+        """The rate limit usage last reported for the app and access token.
+
+        A dict of percentages, see facebook.ratelimit.parse_usage(). Only
+        available when a rate_limiter was given.
+        """
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.usage(self.access_token)
+
+    @property
+    def executor(self):
+        """The thread pool used for concurrent requests of this instance.
+
+        Unless an executor was passed in, a pool of max_workers threads is
+        created on first use. Pass the same executor to several instances
+        to share a single concurrency cap between them.
+        """
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers)
+        return self._executor
+
     def get_object(self, id, **args):
         """Fetchs the given object from the graph."""
-        return self.request(id, args)
+        return self._convert(self.request(id, args))
 
-    def get_objects(self, ids, **args):
+    def get_objects(self, ids, chunk_size=IDS_CHUNK_SIZE, raise_errors=True,
+                    **args):
         """Fetchs all of the given object from the graph.
 
-        We return a map from ID to object. If any of the IDs are
-        invalid, we raise an exception.
+        We return a map from ID to object. The ids are requested in chunks
+        of chunk_size, which are fetched concurrently on the executor. If
+        any of the IDs are invalid, we raise an exception, unless
+        raise_errors is False: then the chunks that failed are retried per
+        ID and invalid IDs map to a GraphAPIError instance.
+        """
+        ids = list(ids)
+        chunks = [ids[i:i + chunk_size]
+                  for i in range(0, len(ids), chunk_size)]
+
+        def fetch(chunk):
+            return self._get_objects_chunk(chunk, raise_errors, args)
+
+        if len(chunks) == 1:
+            return fetch(chunks[0])
+        result = {}
+        for objects in self._map(fetch, chunks):
+            result.update(objects)
+        return result
+
+    def _get_objects_chunk(self, ids, raise_errors, args):
+        """Fetches a single chunk of ids for get_objects()."""
+        chunk_args = dict(args, ids=",".join(ids))
+        try:
+            objects = self.request("", chunk_args)
+            return dict((id, self._convert(obj))
+                        for id, obj in objects.items())
+        except GraphAPIError:
+            if raise_errors:
+                raise
+        result = {}
+        for id in ids:
+            try:
+                result[id] = self.get_object(id, **args)
+            except GraphAPIError as e:
+                result[id] = e
+        return result
+
+    def fan_out(self, calls, ordered=True, return_exceptions=False,
+                max_in_flight=None):
+        """
+        Runs many Graph API calls concurrently on the executor.
+
+        calls is an iterable of (method, path, args) tuples, for example
+        ("GET", "me/friends", {"limit": 10}) or ("POST", "me/feed",
+        {"message": "Hello"}). At most max_in_flight calls (by default the
+        executor's max_workers) are submitted at a time, so calls can be
+        a generator over a large workload.
+
+        We yield the results in the order of the calls, or, if ordered is
+        False, (index, result) tuples as soon as each call completes. With
+        return_exceptions, a GraphAPIError is yielded in place of the
+        result of a failed call instead of being raised.
+        """
+        def call(item):
+            method, path, args = item
+            try:
+                if method.upper() == "POST":
+                    return self.request(path, post_args=dict(args or {}),
+                                        method="POST")
+                return self.request(path, dict(args or {}),
+                                    method=method.upper())
+            except GraphAPIError as e:
+                if return_exceptions:
+                    return e
+                raise
+
+        return self._map(call, calls, ordered, max_in_flight)
+
+    def fan_out_objects(self, ids, ordered=True, return_exceptions=False,
+                        **args):
+        """Fetches each of the given objects with fan_out()."""
+        return self.fan_out((("GET", id, args) for id in ids),
+                            ordered, return_exceptions)
+
+    def fan_out_connections(self, ids, connection_name, ordered=True,
+                            return_exceptions=False, **args):
+        """Fetches the connections of each of the given objects with
+        fan_out()."""
+        return self.fan_out(
+            (("GET", "{0}/{1}".format(id, connection_name), args)
+             for id in ids), ordered, return_exceptions)
+
+    def _map(self, func, items, ordered=True, max_in_flight=None):
+        """
+        Yields func(item) for every item, running them on the executor.
+
+        Within a worker thread of the executor we run the calls in that
+        thread instead, so nested calls can't exhaust the pool and
+        deadlock.
         """
-        args["ids"] = ",".join(ids)
-        return self.request(args)
+        if getattr(_worker, "graph_executor", None) is self.executor:
+            for index, item in enumerate(items):
+                result = func(item)
+                yield result if ordered else (index, result)
+            return
+
+        def run(item):
+            _worker.graph_executor = self.executor
+            try:
+                return func(item)
+            finally:
+                _worker.graph_executor = None
+
+        max_in_flight = max_in_flight or self.max_workers
+        pending = deque()
+        items = iter(enumerate(items))
+        try:
+            for index, item in items:
+                pending.append((index, self.executor.submit(run, item)))
+                if len(pending) < max_in_flight:
+                    continue
+                if ordered:
+                    yield pending.popleft()[1].result()
+                else:
+                    for completed in self._completed(pending):
+                        yield completed
+            while pending:
+                if ordered:
+                    yield pending.popleft()[1].result()
+                else:
+                    for completed in self._completed(pending):
+                        yield completed
+        finally:
+            for index, future in pending:
+                future.cancel()
+
+    @staticmethod
+    def _completed(pending):
+        """Removes and returns (index, result) of completed futures."""
+        from concurrent.futures import FIRST_COMPLETED, wait
+        done, _ = wait([future for index, future in pending],
+                       return_when=FIRST_COMPLETED)
+        completed = [(index, future) for index, future in pending
+                     if future in done]
+        for entry in completed:
+            pending.remove(entry)
+        return [(index, future.result()) for index, future in completed]
 
     def get_connections(self, id, connection_name, **args):
-        """Fetchs the connections for given object."""
-        return self.request("{0}/{1}".format(id, connection_name), args)
+        """Fetchs the connections for given object.
+
+        With lazy_pages set, the result is a facebook.jsoncodec.LazyPage,
+        which decodes the items of its data array on demand.
+        """
+        page = self.request("{0}/{1}".format(id, connection_name), args,
+                            lazy=self.lazy_pages)
+        return self._convert(page, args.get("fields"), page=True)
+
+    def iter_connections(self, id, connection_name, prefetch=1, **args):
+        """
+        Yields all connections for given object, following the paging.
+
+        Up to prefetch pages are fetched in a background thread while the
+        items of the current page are being processed, so no more than
+        prefetch + 1 pages are kept in memory. With a prefetch of 0 pages
+        are only fetched when the previous one has been consumed.
+        """
+        first = ("{0}/{1}".format(id, connection_name), args)
+        if not prefetch:
+            for page in self._iter_pages(first):
+                for item in _page_items(page):
+                    yield item
+            return
+
+        pages = Queue()
+        slots = Queue()
+        for _ in range(prefetch):
+            slots.put(True)
+        stopped = threading.Event()
+
+        def produce():
+            try:
+                for page in self._iter_pages(first, slots, stopped):
+                    pages.put((page, None))
+            except Exception as e:
+                pages.put((None, e))
+            pages.put((None, None))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                page, error = pages.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    return
+                slots.put(True)
+                for item in _page_items(page):
+                    yield item
+        finally:
+            stopped.set()
+
+    def _iter_pages(self, first, slots=None, stopped=None):
+        """
+        Yields the first page of the (path, args) and all pages after it.
+
+        Before every page a slot is taken from the slots queue, if given,
+        and iteration ends when the stopped event is set.
+        """
+        url = None
+        while True:
+            if slots is not None:
+                while True:
+                    if stopped.is_set():
+                        return
+                    try:
+                        slots.get(timeout=0.1)
+                        break
+                    except Empty:
+                        pass
+            if url is None:
+                page = self.request(first[0], dict(first[1]),
+                                    lazy=self.lazy_pages)
+            else:
+                args = None
+                if (self.appsecret_proof is not None and self.access_token and
+                        "appsecret_proof=" not in url):
+                    args = {"appsecret_proof": self.appsecret_proof(
+                        self.access_token)}
+                page = self.bare_request(url, args, lazy=self.lazy_pages)
+            if self.results == "dicts":
+                yield page
+            else:
+                # Converted before reading the paging, which would decode
+                # the items of a LazyPage a second time.
+                converted = self._convert(page, first[1].get("fields"),
+                                          page=True)
+            url = page.get("paging", {}).get("next")
+            if isinstance(page, LazyPage):
+                has_data = page.has_data()
+            else:
+                has_data = bool(page.get("data"))
+            if self.results != "dicts":
+                yield converted
+            if not url or not has_data:
+                return
 
     def put_object(self, parent_object, connection_name, **data):
         """Writes the given object to the graph, connected to the given parent.
@@ -181,6 +521,10 @@ class GraphAPI(object):
         """
         Upload an image using multipart/form-data.
 
+        The request body is streamed from the file, so memory use does not
+        depend on the size of the image. For videos, see
+        facebook.upload.ResumableUpload.
+
         image - A file object representing the image to be uploaded.
         album_path - A path representing where the image should be uploaded.
 
@@ -191,17 +535,144 @@ class GraphAPI(object):
             files={"source": image},
             method="POST")
 
+    def batch(self, operations, include_headers=False):
+        """
+        Sends the given operations through the Graph API batch endpoint.
+
+        operations is a list of dicts, each with a "method" and a
+        "relative_url" and optionally a "body" (a dict or urlencoded
+        string), "name", "depends_on" and any other key the batch API
+        supports. For example:
+
+            graph.batch([
+                {"method": "GET", "relative_url": "me/friends?limit=5",
+                 "name": "friends"},
+                {"method": "GET",
+                 "relative_url": "?ids={result=friends:$.data.*.id}"},
+                {"method": "DELETE", "relative_url": "post_id"},
+            ])
+
+        Lists longer than BATCH_SIZE are split over several batch calls,
+        keeping operations that refer to each other by name (through
+        depends_on or a JSONPath result reference) in the same call.
+
+        We return a list with a result per operation, in the same order.
+        Operations that failed are represented by a GraphAPIError instance
+        instead of a result, and operations for which Facebook omitted the
+        response (see omit_response_on_success) by None.
+        """
+        results = [None] * len(operations)
+        for chunk in _chunk_batch(operations):
+            batch = []
+            for index in chunk:
+                operation = dict(operations[index])
+                if isinstance(operation.get("body"), dict):
+                    operation["body"] = urlencode(operation["body"])
+                batch.append(operation)
+            post_args = {"batch": self.json.dumps(batch),
+                         "include_headers": str(include_headers).lower()}
+            responses = self.request("", post_args=post_args, method="POST")
+            for index, response in zip(chunk, responses):
+                results[index] = _parse_batch_response(response, self.json)
+        return results
+
+    def iter_download(self, path, chunk_size=DOWNLOAD_CHUNK_SIZE, offset=0,
+                      **args):
+        """
+        Yields the body of a binary response, like a picture or video, in
+        chunks of up to chunk_size bytes.
+
+        path is a Graph API path, like "me/picture", or a full url, like
+        the "source" of a photo. With an offset, only the bytes from that
+        offset are yielded, and nothing if the body is shorter. Use
+        download() to write to a file.
+        """
+        response = self._open_download(path, offset, args)
+        if response is None:
+            return
+        try:
+            skip = offset if response.status_code != 206 else 0
+            for chunk in response.iter_content(chunk_size):
+                if skip:
+                    # The server ignored the range, and sent it all.
+                    chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                    if not chunk:
+                        continue
+                yield chunk
+        finally:
+            response.close()
+
+    def download(self, path, dest, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                 resume=False, **args):
+        """
+        Writes the body of a binary response to dest, a file name or a
+        file object, and returns the number of bytes written.
+
+        The body is streamed in chunks of chunk_size bytes, read into a
+        single reusable buffer. With resume, a partially downloaded file
+        named dest is continued with a range request, if Facebook supports
+        that for the url; otherwise it is downloaded from the start. A
+        file that was downloaded completely already is left as it is.
+        """
+        offset = 0
+        if resume and not hasattr(dest, "write") and os.path.exists(dest):
+            offset = os.path.getsize(dest)
+
+        response = self._open_download(path, offset, args)
+        if response is None:
+            return 0
+        try:
+            if response.status_code != 206:
+                offset = 0
+            if hasattr(dest, "write"):
+                return _copy_response(response, dest, chunk_size)
+            with open(dest, "ab" if offset else "wb") as f:
+                return _copy_response(response, f, chunk_size)
+        finally:
+            response.close()
+
+    def _open_download(self, path, offset, args):
+        """
+        Starts a streaming GET request for a download, with the retry
+        policy and observers like other calls. Error responses raise a
+        GraphAPIError. Returns None if there is nothing after offset.
+        """
+        if path.startswith(("http://", "https://")):
+            url = path
+        else:
+            url = "{0}{1}/{2}".format(self.graph_url, self.version, path)
+            args = self._token_args(args)
+        headers = {"Range": "bytes={0}-".format(offset)} if offset else None
+
+        def send():
+            response = self._send("GET", url, args, headers=headers,
+                                  stream=True)
+            if response.status_code < 400:
+                return response
+            if response.status_code == 416 and offset:
+                # The range starts at the end, so it was all downloaded.
+                response.close()
+                return None
+            try:
+                self._parse(response)
+            finally:
+                response.close()
+            error = GraphAPIError(
+                "Download failed with HTTP status {0}".format(
+                    response.status_code))
+            error.status_code = response.status_code
+            raise error
+
+        return self._retry("GET", url, send)
+
     def get_version(self):
         """Fetches the current version number of the Graph API being used."""
-        args = {"access_token": self.access_token}
-        try:
-            response = requests.get("https://graph.facebook.com/" + self.version,
-                                    params=args, timeout=self.timeout)
-        except requests.HTTPError as e:
-            # We expect an Unauthenticated error, as we don't send a token
-            if e.status != 400:
-                response = json.loads(e.read())
-                raise GraphAPIError(response)
+        args = self._token_args({"access_token": self.access_token})
+        # Without a token this is an Unauthenticated error, which still
+        # carries the version header.
+        response = self.transport.request("GET",
+                                          self.graph_url + self.version,
+                                          params=args, timeout=self.timeout)
 
         try:
             headers = response.headers
@@ -210,64 +681,192 @@ class GraphAPI(object):
         except Exception:
             raise GraphAPIError("API version number not available")
 
-    def request(self, path, args=None, post_args=None, files=None, method=None):
+    def request(self, path, args=None, post_args=None, files=None, method=None,
+                lazy=False):
         """
         Fetches the given path in the Graph API.
 
         We translate args to a valid query string. If post_args is
         given, we send a POST request to the given path with the given
-        arguments.
+        arguments. With lazy, a JSON object is returned as a LazyPage.
 
         """
         args = args or {}
 
+        if post_args is not None:
+            self._token_args(post_args)
+        else:
+            self._token_args(args)
+
+        url = "{0}{1}/{2}".format(self.graph_url, self.version, path)
+        if (self.cache is not None and (method or "GET") == "GET" and
+                post_args is None and files is None):
+            return self._retry("GET", url, lambda: self._cached_request(
+                path, url, args, lazy))
+        return self.bare_request(url, args, post_args, files, method, lazy)
+
+    def _token_args(self, args):
+        """
+        Adds the access token, and its appsecret_proof if the app secret
+        is known, to args.
+        """
         if self.access_token:
-            if post_args is not None:
-                post_args["access_token"] = self.access_token
-            else:
-                args["access_token"] = self.access_token
+            args["access_token"] = self.access_token
+            if self.appsecret_proof is not None:
+                args["appsecret_proof"] = self.appsecret_proof(
+                    self.access_token)
+        return args
 
-        url = "https://graph.facebook.com/{0}/{1}".format(self.version, path)
-        return self.bare_request(url, args, post_args, files, method)
+    def _cached_request(self, path, url, args, lazy=False):
+        """
+        GETs the url through the cache.
 
-    def bare_request(self, url, args=None, post_args=None, files=None, method=None):
+        Fresh responses come straight from the cache, expired ones are
+        revalidated with their ETag.
+        """
+        event = _current_event() if self.observers else None
+        key = self.cache.key(self.version, path, args)
+        entry, fresh = self.cache.get(key)
+        if fresh:
+            if event is not None:
+                event.cache = "hit"
+            return _parse_response(entry.content_type, entry.content,
+                                   entry.url, self.json, lazy)
+
+        headers = None
+        if entry is not None and entry.etag:
+            headers = {"If-None-Match": entry.etag}
+        response = self._send("GET", url, args, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            if event is not None:
+                event.cache = "revalidated"
+            self.cache.revalidated(key, path, entry)
+            return _parse_response(entry.content_type, entry.content,
+                                   entry.url, self.json, lazy)
+
+        if event is not None:
+            event.cache = "miss"
+
+        result = self._parse(response, lazy)
+        self.cache.set(key, path, response.headers.get("content-type", ""),
+                       response.content, response.url,
+                       response.headers.get("etag"))
+        return result
+
+    def bare_request(self, url, args=None, post_args=None, files=None, method=None,
+                     lazy=False):
         """
         Request method in which you can use fully formatted urls, like for
         pagination for example.
         """
+        method = method or "GET"
+
+        def send():
+            if not files:
+                return self._send(method, url, args, post_args)
+            from .upload import MultipartEncoder
+            body = MultipartEncoder(post_args, files)
+            return self._send(method, url, args, body,
+                              headers={"Content-Type": body.content_type})
+
+        return self._retry(method, url, lambda: self._parse(send(), lazy))
+
+    def _retry(self, method, url, func):
+        """
+        Calls func according to the retry policy, if there is one, and
+        reports the call to the observers.
+        """
+        if self.observers:
+            return self._observe(method, url, func)
+        if self.retry_policy is None:
+            return func()
+        return self.retry_policy.call(func, method, path_template(url))
+
+    def _observe(self, method, url, func):
+        """
+        Calls func, collecting a RequestEvent for the observers from the
+        requests it sends.
+        """
+        event = RequestEvent(method, path_template(url))
+        previous = _current_event()
+        _observed.event = event
+        start = timeit.default_timer()
         try:
-            response = requests.request(method or "GET",
-                                        url,
-                                        timeout=self.timeout,
-                                        params=args,
-                                        data=post_args,
-                                        files=files)
-        except requests.HTTPError as e:
-            response = json.loads(e.read())
-            raise GraphAPIError(response)
-
-        headers = response.headers
-        if 'json' in headers['content-type']:
-            result = response.json()
-        elif 'image/' in headers['content-type']:
-            mimetype = headers['content-type']
-            result = {"data": response.content,
-                      "mime-type": mimetype,
-                      "url": response.url}
-        elif "access_token" in parse_qs(response.text):
-            query_str = parse_qs(response.text)
-            if "access_token" in query_str:
-                result = {"access_token": query_str["access_token"][0]}
-                if "expires" in query_str:
-                    result["expires"] = query_str["expires"][0]
-            else:
-                raise GraphAPIError(response.json())
-        else:
-            raise GraphAPIError('Maintype was not text, image, or querystring')
+            if self.retry_policy is None:
+                return func()
+            return self.retry_policy.call(func, method, event.path)
+        except Exception as e:
+            event.failed(e)
+            raise
+        finally:
+            event.total = timeit.default_timer() - start
+            _observed.event = previous
+            notify(self.observers, event)
+
+    def _send(self, method, url, args=None, data=None, headers=None,
+              stream=False):
+        """
+        Sends a request with the transport and returns the response.
 
-        if result and isinstance(result, dict) and result.get("error"):
-            raise GraphAPIError(result)
-        return result
+        data is a dict of form fields or a file-like body.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.access_token)
+        event = _current_event() if self.observers else None
+        if event is not None:
+            start = timeit.default_timer()
+        response = self.transport.request(method,
+                                          url,
+                                          timeout=self.timeout,
+                                          params=args,
+                                          data=data,
+                                          headers=headers,
+                                          stream=stream)
+        if event is not None:
+            # The elapsed time runs until the headers were parsed, the rest
+            # of the time was spent reading the body (unless streaming).
+            took = timeit.default_timer() - start
+            wait = min(took, response.elapsed.total_seconds() or took)
+            event.attempts += 1
+            event.wait += wait
+            event.download += took - wait
+            event.status_code = response.status_code
+            event.usage = parse_usage(response.headers) or event.usage
+        if self.rate_limiter is not None:
+            self.rate_limiter.observe(response.headers, self.access_token)
+        return response
+
+    def _parse(self, response, lazy=False):
+        """Parses a response, noting its HTTP status on errors."""
+        event = _current_event() if self.observers else None
+        if event is not None:
+            start = timeit.default_timer()
+        try:
+            return _parse_response(response.headers.get("content-type", ""),
+                                   response.content, response.url, self.json,
+                                   lazy)
+        except GraphAPIError as e:
+            e.status_code = response.status_code
+            raise
+        finally:
+            if event is not None:
+                event.decode += timeit.default_timer() - start
+                event.response_size += len(response.content)
+
+    def _convert(self, result, fields=None, page=False):
+        """
+        Converts a result to GraphObjects, or a page to a ColumnarPage if
+        the result type is "columns" and the fields are known.
+        """
+        if self.results == "dicts" or not isinstance(result, (dict,
+                                                              LazyPage)):
+            return result
+        from .objects import ColumnarPage, page_objects, to_objects
+        if page and fields is not None and self.results == "columns":
+            return ColumnarPage.from_page(result, fields)
+        if page:
+            return page_objects(result)
+        return to_objects(result)
 
     def fql(self, query):
         """
@@ -280,7 +879,171 @@ class GraphAPI(object):
         return self.request("fql", {"q": query})
 
 
+def _current_event():
+    """Returns the RequestEvent of the call this thread is making, if any."""
+    return getattr(_observed, "event", None)
+
+
+def path_template(url):
+    """
+    Returns the path of a Graph API url with ids replaced by "{id}".
+
+    For example "https://graph.facebook.com/v2.2/1234_5678/comments?limit=5"
+    becomes "{id}/comments". Used to group requests per endpoint.
+    """
+    path = urlsplit(url).path.strip("/").split("/")
+    if path and _VERSION_RE.match(path[0]):
+        path = path[1:]
+    return "/".join("{id}" if _ID_RE.match(part) else part for part in path)
+
+
+def _copy_response(response, f, chunk_size):
+    """
+    Writes the body of a streaming response to the file object f.
+
+    Unless the body has a content encoding to undo, it is read straight
+    from the connection into one reusable buffer, instead of allocating
+    a new bytes object per chunk. Responses of transports without a raw
+    stream to read from are copied with iter_content().
+    """
+    written = 0
+    raw = getattr(response, "raw", None)
+    if response.headers.get("content-encoding") or not hasattr(
+            raw, "readinto"):
+        for chunk in response.iter_content(chunk_size):
+            f.write(chunk)
+            written += len(chunk)
+        return written
+
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    while True:
+        n = raw.readinto(buf)
+        if not n:
+            return written
+        f.write(view[:n])
+        written += n
+
+
+def _parse_response(content_type, content, url, codec=None, lazy=False):
+    """
+    Turns the body of a Graph API response into a result.
+
+    JSON is decoded with the codec, or into a LazyPage if lazy is set and
+    the response is an object. Images are wrapped in a dict with their
+    mime-type and url, and querystring encoded access tokens are parsed.
+    Error responses raise a GraphAPIError.
+    """
+    if 'json' in content_type:
+        result = None
+        if lazy:
+            try:
+                result = LazyPage(content)
+            except ValueError:
+                pass
+        if result is None:
+            result = (codec or get_codec()).loads(content)
+    elif 'image/' in content_type:
+        result = {"data": content,
+                  "mime-type": content_type,
+                  "url": url}
+    else:
+        # With replacement, so any other body raises the GraphAPIError below.
+        query_str = parse_qs(content.decode('utf-8', 'replace'))
+        if "access_token" in query_str:
+            result = {"access_token": query_str["access_token"][0]}
+            if "expires" in query_str:
+                result["expires"] = query_str["expires"][0]
+        else:
+            raise GraphAPIError(
+                'Maintype was not text, image, or querystring')
+
+    if isinstance(result, LazyPage) and result.get("error"):
+        raise GraphAPIError({"error": result["error"]})
+    if result and isinstance(result, dict) and result.get("error"):
+        raise GraphAPIError(result)
+    return result
+
+
+def _chunk_batch(operations):
+    """
+    Splits batch operations into lists of at most BATCH_SIZE indexes.
+
+    Operations are grouped with the named operations they refer to, and
+    groups are kept together and in their original order.
+    """
+    names = dict((op["name"], i) for i, op in enumerate(operations)
+                 if op.get("name"))
+    groups = list(range(len(operations)))
+
+    def find(i):
+        while groups[i] != i:
+            groups[i] = groups[groups[i]]
+            i = groups[i]
+        return i
+
+    for i, op in enumerate(operations):
+        refs = _BATCH_REFERENCE_RE.findall(
+            op.get("relative_url", "") + str(op.get("body", "")))
+        if op.get("depends_on"):
+            refs.append(op["depends_on"])
+        for name in refs:
+            if name not in names:
+                raise GraphAPIError(
+                    "Batch operation refers to unknown name {0}".format(name))
+            groups[find(names[name])] = find(i)
+
+    grouped = {}
+    for i in range(len(operations)):
+        grouped.setdefault(find(i), []).append(i)
+
+    chunk = []
+    for group in sorted(grouped.values()):
+        if len(group) > BATCH_SIZE:
+            raise GraphAPIError("More than {0} batch operations depend on "
+                                "each other".format(BATCH_SIZE))
+        if len(chunk) + len(group) > BATCH_SIZE:
+            yield chunk
+            chunk = []
+        chunk.extend(group)
+    if chunk:
+        yield chunk
+
+
+def _page_items(page):
+    """Returns the items of a page, decoding them lazily for a LazyPage."""
+    if isinstance(page, dict):
+        return page.get("data", [])
+    if isinstance(page, LazyPage):
+        return page.iter_data()
+    # Only pages of GraphAPIs with a results type other than "dicts" get
+    # here, which have imported the module already.
+    from .objects import ColumnarPage
+    if isinstance(page, ColumnarPage):
+        return iter(page)
+    return page.get("data", [])
+
+
+def _parse_batch_response(response, codec):
+    """Decodes a single batch response into a result or GraphAPIError."""
+    if response is None:
+        return None
+    try:
+        body = codec.loads(response.get("body") or "null")
+    except ValueError:
+        body = response.get("body")
+    if isinstance(body, dict) and body.get("error"):
+        return GraphAPIError(body)
+    if response.get("code", 200) >= 400:
+        return GraphAPIError(body or "Batch operation failed with HTTP "
+                             "status {0}".format(response["code"]))
+    return body
+
+
 class GraphAPIError(Exception):
+    # HTTP status of the response the error came from, if any.
+    status_code = None
+
     def __init__(self, result):
         self.result = result
         try:
@@ -288,6 +1051,13 @@ class GraphAPIError(Exception):
         except:
             self.type = ""
 
+        # Graph API error code, see
+        # https://developers.facebook.com/docs/graph-api/using-graph-api/#errors
+        try:
+            self.code = result["error"]["code"]
+        except (KeyError, TypeError, ValueError):
+            self.code = self.type or None
+
         # OAuth 2.0 Draft 10
         try:
             self.message = result["error_description"]
@@ -312,23 +1082,58 @@ class AuthError(GraphAPIError):
 class Auth(object):
     """
     Class for dealing with authentication.
-    It is setup with the app_id and app_secret.
+    It is setup with the app_id and app_secret. An optional requests Session
+    (see make_session()) is shared with the GraphAPI used for token calls,
+    as are the observers (see facebook.metrics) and transport (see
+    facebook.transport). Access tokens are kept by a
+    facebook.tokens.TokenManager as self.tokens, which stores them in
+    token_backend if given.
     """
 
-    def __init__(self, app_id, app_secret, redirect_uri, version="2.2"):
+    graph_class = GraphAPI
+
+    def __init__(self, app_id, app_secret, redirect_uri, version="2.2",
+                 session=None, graph_url=GRAPH_URL, json_codec=None,
+                 old_app_secrets=(), exchange_cache=None,
+                 token_backend=None, observers=None, transport=None):
         self.app_id = app_id
         self.app_secret = app_secret
+        self.old_app_secrets = tuple(old_app_secrets)
         split_url = list(urlsplit(redirect_uri))
         if split_url[2] == '':
             split_url[2] = '/'
             redirect_uri = urlunsplit(split_url)
         self.redirect_uri = redirect_uri
         # Re-use version checking of the graph api
+        kwargs = {}
+        if transport is not None:
+            kwargs["transport"] = transport
         try:
-            GraphAPI(version=version)
+            self.graph = self.graph_class(version=version, session=session,
+                                          graph_url=graph_url,
+                                          json_codec=json_codec,
+                                          observers=observers, **kwargs)
         except GraphAPIError as e:
             raise AuthError(e)
         self.version = version
+        self.session = session
+        self.json = get_codec(json_codec)
+        # Signed requests may still be signed with a previous secret while
+        # rotating them.
+        self.verifier = SignedRequestVerifier(
+            [app_secret] + list(old_app_secrets), json_codec=self.json)
+        self.exchange_cache = exchange_cache
+        self.tokens = TokenManager(self, token_backend)
+
+    def webhook_handler(self, verify_token, callback=None, graph=None,
+                        **kwargs):
+        """
+        Returns a facebook.webhooks.WebhookHandler for the webhooks of this
+        app, which checks signatures with its secrets.
+        """
+        from .webhooks import WebhookHandler
+        return WebhookHandler(self.app_secret, verify_token, callback, graph,
+                              old_app_secrets=self.old_app_secrets, **kwargs)
 
     def get_user_from_cookie(self, cookies, validate=False):
         """
@@ -342,6 +1147,10 @@ class Auth(object):
         the latter can be used to make authenticated requests to the Graph API.
         If the user is not logged in, we return None.
 
+        With validate, the code in the cookie is exchanged for an access
+        token, through the exchange_cache if the Auth has one (see
+        facebook.tokens.CodeExchangeCache).
+
         Download the official Facebook JavaScript SDK at
         http://github.com/facebook/connect-js/. Read more about Facebook
         authentication at http://developers.facebook.com/docs/authentication/.
@@ -354,19 +1163,24 @@ class Auth(object):
         try:
             user_data = self.parse_signed_request(cookie)
         except ValueError as e:
-            raise AuthError('Error parsing fbsr-cookie', e)
+            raise AuthError('Error parsing fbsr-cookie: {0}'.format(e))
 
         if not user_data:
             return None
 
         if validate:
             try:
-                result = self.get_access_token_from_code(user_data["code"])
+                if self.exchange_cache is not None:
+                    result = self.exchange_cache.get_or_exchange(
+                        user_data["code"], self.get_access_token_from_code,
+                        user_data.get("user_id"))
+                else:
+                    result = self.get_access_token_from_code(
+                        user_data["code"])
             except GraphAPIError:
                 return None
-
-        user_data.update(result)
-        return result
+            user_data.update(result)
+        return user_data
 
     def parse_signed_request(self, signed_request):
         """
@@ -376,40 +1190,10 @@ class Auth(object):
         This includes a user_id if the user has authorised your application, as
         well as any information requested.
 
-        If the signed_request is malformed or corrupted, False is returned.
+        If the signed_request is malformed or corrupted, a ValueError is
+        raised. See facebook.signed_request.SignedRequestVerifier.
         """
-        try:
-            encoded_sig, payload = map(str, signed_request.split('.', 1))
-
-            sig = base64.urlsafe_b64decode(encoded_sig + "=" *
-                                           ((4 - len(encoded_sig) % 4) % 4))
-            data = base64.urlsafe_b64decode(payload + "=" *
-                                            ((4 - len(payload) % 4) % 4))
-
-            # Base64 is decoded to a bytestring, and json.loads below
-            # only takes (unicode) strings in Python3.
-            data = data.decode('utf-8')
-        except IndexError:
-            raise ValueError('signed_request malformed')
-        except (TypeError, UnicodeDecodeError):
-            raise ValueError('signed_request had corrupted payload')
-
-        data = json.loads(data)
-        if data.get('algorithm', '').upper() != 'HMAC-SHA256':
-            raise ValueError('signed_request used unknown algorithm')
-
-        # HMAC can only handle ascii (byte) strings
-        # http://bugs.python.org/issue5285
-        self.app_secret = self.app_secret.encode('ascii')
-        payload = payload.encode('ascii')
-
-        expected_sig = hmac.new(self.app_secret,
-                                msg=payload,
-                                digestmod=hashlib.sha256).digest()
-        if sig != expected_sig:
-            raise ValueError('signed_request had signature mismatch')
-
-        return data
+        return self.verifier.verify(signed_request)
 
     def get_auth_url(self, perms=None, **kwargs):
         url = "https://www.facebook.com/dialog/oauth?"
@@ -419,13 +1203,20 @@ class Auth(object):
         kvps.update(kwargs)
         return url + urlencode(kvps)
 
-    def get_app_access_token(self):
-        """Get the application's access token as a string."""
+    def get_app_access_token(self, offline=True):
+        """
+        Get the application's access token as a string.
+
+        The app token is app_id|app_secret, which Facebook accepts without
+        asking for it first. Pass offline=False to request one anyway.
+        """
+        if offline:
+            return self.tokens.app_token
         args = {'grant_type': 'client_credentials',
                 'client_id': self.app_id,
                 'client_secret': self.app_secret}
 
-        return GraphAPI(version=self.version).request(
+        return self.graph.request(
             "oauth/access_token", args=args)["access_token"]
 
     def get_access_token_from_code(self, code, **kwargs):
@@ -443,21 +1234,22 @@ class Auth(object):
         }
         args.update(**kwargs)
 
-        return GraphAPI(version=self.version).request("oauth/access_token",
-                                                      args)
+        return self.graph.request("oauth/access_token", args)
 
-    def extend_access_token(self, app_id, app_secret):
+    def extend_access_token(self, access_token):
         """
         Extends the expiration time of a valid OAuth access token. See
         <https://developers.facebook.com/roadmap/offline-access-removal/
         #extend_token>
+
+        Returns a dict with the long-lived access token and, if it expires,
+        its expiration time.
         """
         args = {
             "client_id": self.app_id,
             "client_secret": self.app_secret,
             "grant_type": "fb_exchange_token",
-            "fb_exchange_token": self.access_token,
+            "fb_exchange_token": access_token,
         }
 
-        return GraphAPI(version=self.version).request("oauth/access_token",
-                                                      args=args)
+        return self.graph.request("oauth/access_token", args=args)
@@ -0,0 +1,97 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Command line tools of the SDK.
+
+    python -m facebook export --connection feed --fields id,message \\
+        --ids-file pages.txt feeds.ndjson.gz
+
+The access token is read from the FACEBOOK_ACCESS_TOKEN environment
+variable, or given with --access-token.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from . import GraphAPI
+
+
+def read_ids(args):
+    ids = list(args.id or [])
+    if args.ids_file:
+        with open(args.ids_file) as f:
+            ids.extend(line.strip() for line in f if line.strip())
+    return ids
+
+
+def export(args):
+    from .export import Export
+    extra = {}
+    if args.fields:
+        extra["fields"] = args.fields
+    if args.limit:
+        extra["limit"] = args.limit
+    graph = GraphAPI(args.access_token, version=args.api_version,
+                     timeout=args.timeout)
+    exporter = Export(graph, args.output, args.connection,
+                      state_path=args.state, compression=args.compression,
+                      skip_errors=args.skip_errors, **extra)
+    stats = exporter.run(read_ids(args))
+    print(json.dumps(stats, sort_keys=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m facebook")
+    parser.add_argument("--access-token",
+                        default=os.environ.get("FACEBOOK_ACCESS_TOKEN"))
+    parser.add_argument("--api-version", default="2.2")
+    parser.add_argument("--timeout", type=float, default=60)
+    commands = parser.add_subparsers(dest="command")
+
+    command = commands.add_parser(
+        "export", help="export connections to NDJSON",
+        description="Export the connections of objects to NDJSON, gzip "
+                    "compressed for .gz and zstd for .zst files. Run the "
+                    "same command again to resume an interrupted export.")
+    command.add_argument("output", help="file to write")
+    command.add_argument("--id", action="append",
+                         help="id of an object, may be repeated")
+    command.add_argument("--ids-file", help="file with an id per line")
+    command.add_argument("--connection", action="append", required=True,
+                         help="connection to export, may be repeated")
+    command.add_argument("--fields", help="fields of the items")
+    command.add_argument("--limit", type=int, help="items per page")
+    command.add_argument("--state",
+                         help="state file, by default OUTPUT.state")
+    command.add_argument("--compression", choices=["gzip", "zstd", "none"])
+    command.add_argument("--skip-errors", action="store_true",
+                         help="skip objects whose connection can't be read")
+    command.set_defaults(func=export)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "func", None) is None:
+        parser.print_help()
+        return 2
+    if not args.access_token:
+        parser.error("an access token is required, set "
+                     "FACEBOOK_ACCESS_TOKEN or use --access-token")
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
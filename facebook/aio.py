@@ -0,0 +1,443 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Asyncio client for the Facebook Graph API.
+
+Requires Python 3.5+ and aiohttp. The clients mirror GraphAPI and Auth, but
+every method that talks to Facebook is a coroutine:
+
+import facebook.aio
+graph = facebook.aio.AsyncGraphAPI(access_token, max_concurrency=500)
+profile = await graph.get_object("me")
+friends = await graph.get_connections("me", "friends")
+await graph.close()
+
+"""
+
+import asyncio
+import timeit
+
+import aiohttp
+
+from . import (GRAPH_URL, IDS_CHUNK_SIZE, Auth, AuthError, GraphAPI,
+               GraphAPIError, _parse_response, path_template)
+from .coalesce import Batch, request_key
+from .jsoncodec import get_codec
+from .metrics import RequestEvent, notify
+from .ratelimit import parse_usage
+from .tokens import CodeExchangeCache, get_appsecret_proof
+
+
+class AsyncGraphAPI(object):
+    """
+    Asyncio version of GraphAPI.
+
+    Unless an aiohttp ClientSession is passed in, each instance creates
+    its own on first use, with a connector keeping up to limit connections
+    (limit_per_host per host) alive. Pass the same session to several
+    instances to share its connection pool.
+    max_concurrency caps the number of requests in flight for this
+    instance, further requests wait for a free slot.
+    """
+
+    def __init__(self, access_token=None, timeout=None, version="2.2",
+                 session=None, graph_url=GRAPH_URL, max_concurrency=100,
+                 limit=100, limit_per_host=0, keepalive_timeout=30,
+                 json_codec=None, app_secret=None, observers=None):
+        # Re-use version checking of the graph api
+        GraphAPI(version=version)
+
+        self.access_token = access_token
+        self.timeout = timeout
+        self.version = "v" + str(version)
+        self.graph_url = graph_url
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.max_concurrency = max_concurrency
+        self._session = session
+        self._owns_session = session is None
+        self._semaphore = None
+        self.json = get_codec(json_codec)
+        self.observers = list(observers or ())
+        self.appsecret_proof = None
+        if app_secret is not None:
+            self.appsecret_proof = get_appsecret_proof(app_secret)
+
+    @property
+    def session(self):
+        """The aiohttp ClientSession used for all HTTP calls."""
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        """Closes the session, if it was created by this instance."""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_object(self, id, **args):
+        """Fetchs the given object from the graph."""
+        return await self.request(id, args)
+
+    async def get_objects(self, ids, chunk_size=IDS_CHUNK_SIZE,
+                          raise_errors=True, **args):
+        """Fetchs all of the given object from the graph.
+
+        Like GraphAPI.get_objects(), but all chunks are requested at once,
+        limited only by max_concurrency.
+        """
+        ids = list(ids)
+        chunks = [ids[i:i + chunk_size]
+                  for i in range(0, len(ids), chunk_size)]
+        result = {}
+        for objects in await asyncio.gather(*[
+                self._get_objects_chunk(chunk, raise_errors, args)
+                for chunk in chunks]):
+            result.update(objects)
+        return result
+
+    async def _get_objects_chunk(self, ids, raise_errors, args):
+        """Fetches a single chunk of ids for get_objects()."""
+        try:
+            return await self.request("", dict(args, ids=",".join(ids)))
+        except GraphAPIError:
+            if raise_errors:
+                raise
+        result = {}
+        for id in ids:
+            try:
+                result[id] = await self.get_object(id, **args)
+            except GraphAPIError as e:
+                result[id] = e
+        return result
+
+    async def get_connections(self, id, connection_name, **args):
+        """Fetchs the connections for given object."""
+        return await self.request("{0}/{1}".format(id, connection_name), args)
+
+    async def put_object(self, parent_object, connection_name, **data):
+        """Writes the given object to the graph, connected to the given parent.
+
+        See GraphAPI.put_object().
+        """
+        assert self.access_token, "Write operations require an access token"
+        return await self.request(
+            "{0}/{1}".format(parent_object, connection_name),
+            post_args=data, method="POST")
+
+    async def put_photo(self, image, album_path="me/photos", **kwargs):
+        """
+        Upload an image using multipart/form-data.
+
+        image - A file object representing the image to be uploaded.
+        album_path - A path representing where the image should be uploaded.
+
+        """
+        return await self.request(
+            album_path,
+            post_args=kwargs,
+            files={"source": image},
+            method="POST")
+
+    async def delete_object(self, id):
+        """Deletes the object with the given ID from the graph."""
+        await self.request(id, method="DELETE")
+
+    async def request(self, path, args=None, post_args=None, files=None,
+                      method=None):
+        """
+        Fetches the given path in the Graph API.
+
+        See GraphAPI.request().
+        """
+        args = args or {}
+
+        if post_args is not None:
+            self._token_args(post_args)
+        else:
+            self._token_args(args)
+
+        url = "{0}{1}/{2}".format(self.graph_url, self.version, path)
+        return await self.bare_request(url, args, post_args, files, method)
+
+    def _token_args(self, args):
+        """See GraphAPI._token_args()."""
+        if self.access_token:
+            args["access_token"] = self.access_token
+            if self.appsecret_proof is not None:
+                args["appsecret_proof"] = self.appsecret_proof(
+                    self.access_token)
+        return args
+
+    async def bare_request(self, url, args=None, post_args=None, files=None,
+                           method=None):
+        """
+        Request method in which you can use fully formatted urls, like for
+        pagination for example.
+        """
+        data = post_args
+        if files:
+            data = aiohttp.FormData()
+            for key, value in (post_args or {}).items():
+                data.add_field(key, str(value))
+            for key, value in files.items():
+                data.add_field(key, value,
+                               filename=getattr(value, "name", key))
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        event = None
+        if self.observers:
+            event = RequestEvent(method or "GET", path_template(url))
+        start = timeit.default_timer()
+        try:
+            async with self._semaphore:
+                sent = timeit.default_timer()
+                async with self.session.request(method or "GET", url,
+                                                params=args, data=data,
+                                                timeout=timeout) as response:
+                    received = timeit.default_timer()
+                    content = await response.read()
+                    read = timeit.default_timer()
+                    if event is not None:
+                        event.attempts = 1
+                        event.wait = received - sent
+                        event.download = read - received
+                        event.status_code = response.status
+                        event.response_size = len(content)
+                        event.usage = parse_usage(response.headers) or None
+                    try:
+                        return _parse_response(
+                            response.headers.get("content-type", ""),
+                            content, str(response.url), self.json)
+                    finally:
+                        if event is not None:
+                            event.decode = timeit.default_timer() - read
+        except Exception as e:
+            if event is not None:
+                event.failed(e)
+            raise
+        finally:
+            if event is not None:
+                event.total = timeit.default_timer() - start
+                notify(self.observers, event)
+
+
+class AsyncCoalescer(object):
+    """
+    Asyncio version of facebook.coalesce.Coalescer, merging get_object
+    calls on an AsyncGraphAPI made within window seconds.
+    """
+
+    def __init__(self, graph, window=0.005, max_keys=IDS_CHUNK_SIZE):
+        self.graph = graph
+        self.window = window
+        self.max_keys = max_keys
+        self.requests = 0
+        self._batches = {}
+        self._calls = {}
+
+    async def get_object(self, id, **args):
+        """Fetches the given object from the graph."""
+        return await asyncio.shield(self.submit(id, **args))
+
+    def submit(self, id, **args):
+        """
+        Schedules a get_object call, and returns a Future of its result.
+        """
+        batch_key, call_key, fields = request_key(id, args)
+        future = self._calls.get(call_key)
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = self._calls[call_key] = loop.create_future()
+        future.add_done_callback(lambda _: self._calls.pop(call_key, None))
+        batch = self._batches.get(batch_key)
+        if batch is None:
+            batch = self._batches[batch_key] = Batch(args)
+            batch.timer = loop.call_later(self.window, self._flush,
+                                          batch_key, batch)
+        batch.add(id, fields, future)
+        if len(batch) >= self.max_keys:
+            batch.timer.cancel()
+            self._flush(batch_key, batch)
+        return future
+
+    def _flush(self, batch_key, batch):
+        if self._batches.get(batch_key) is not batch:
+            return
+        del self._batches[batch_key]
+        self.requests += 1
+        asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch):
+        try:
+            objects = await self.graph.get_objects(
+                batch.ids, chunk_size=self.max_keys, raise_errors=False,
+                **batch.request_args())
+        except Exception as e:
+            objects = dict((id, e) for id in batch.ids)
+        for future, result in batch.results(objects):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class AsyncAuth(Auth):
+    """
+    Asyncio version of Auth.
+
+    Methods that don't need the network, like parse_signed_request() and
+    get_auth_url(), are the same as on Auth. Requests are sent with
+    aiohttp, so it takes no transport. Call close(), or use it as an
+    async context manager, to close the session of its AsyncGraphAPI.
+    """
+
+    graph_class = AsyncGraphAPI
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("transport") is not None:
+            raise TypeError("AsyncAuth sends requests with aiohttp, and "
+                            "doesn't take a transport")
+        super(AsyncAuth, self).__init__(*args, **kwargs)
+        # Refreshing needs a synchronous extend_access_token().
+        self.tokens.refresh_margin = None
+        self._exchanges = {}
+
+    async def close(self):
+        """Closes the session of the graph, if it was created by it."""
+        await self.graph.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_user_from_cookie(self, cookies, validate=False):
+        """
+        Parses the cookie set by the official Facebook JavaScript SDK.
+
+        See Auth.get_user_from_cookie().
+        """
+        cookie = cookies.get("fbsr_" + self.app_id, "")
+        if not cookie:
+            return None
+
+        try:
+            user_data = self.parse_signed_request(cookie)
+        except ValueError as e:
+            raise AuthError('Error parsing fbsr-cookie: {0}'.format(e))
+
+        if not user_data:
+            return None
+
+        if validate:
+            try:
+                result = await self._exchange_code(user_data["code"],
+                                                   user_data.get("user_id"))
+            except GraphAPIError:
+                return None
+            user_data.update(result)
+        return user_data
+
+    def _exchange_code(self, code, user_id):
+        """
+        Returns a future of the token code is exchanged for. Concurrent
+        calls for the same code share a single exchange.
+        """
+        key = CodeExchangeCache.key(code, user_id)
+        future = self._exchanges.get(key)
+        if future is None:
+            future = self._exchanges[key] = asyncio.ensure_future(
+                self._exchange(code, user_id))
+            future.add_done_callback(
+                lambda _: self._exchanges.pop(key, None))
+        # A cancelled caller doesn't cancel the exchange of the others.
+        return asyncio.shield(future)
+
+    async def _exchange(self, code, user_id):
+        cache = self.exchange_cache
+        if cache is not None:
+            result = cache.get(code, user_id)
+            if result is not None:
+                return result
+            cache.misses += 1
+        result = await self.get_access_token_from_code(code)
+        if cache is not None:
+            cache.set(code, result, user_id)
+        return result
+
+    async def get_app_access_token(self, offline=True):
+        """
+        Get the application's access token as a string.
+
+        See Auth.get_app_access_token().
+        """
+        if offline:
+            return self.tokens.app_token
+        args = {'grant_type': 'client_credentials',
+                'client_id': self.app_id,
+                'client_secret': self.app_secret}
+
+        result = await self.graph.request("oauth/access_token", args=args)
+        return result["access_token"]
+
+    async def get_access_token_from_code(self, code, **kwargs):
+        """
+        Get an access token from the "code" returned from an OAuth dialog.
+
+        See Auth.get_access_token_from_code().
+        """
+        args = {
+            "code": code,
+            "redirect_uri": self.redirect_uri,
+            "client_id": self.app_id,
+            "client_secret": self.app_secret
+        }
+        args.update(**kwargs)
+
+        return await self.graph.request("oauth/access_token", args)
+
+    async def extend_access_token(self, access_token):
+        """
+        Extends the expiration time of a valid OAuth access token.
+
+        See Auth.extend_access_token(). Tokens kept by self.tokens are not
+        refreshed automatically, as its refreshes run in threads.
+        """
+        args = {
+            "client_id": self.app_id,
+            "client_secret": self.app_secret,
+            "grant_type": "fb_exchange_token",
+            "fb_exchange_token": access_token,
+        }
+
+        return await self.graph.request("oauth/access_token", args=args)
@@ -0,0 +1,189 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+In-process caching of Graph API responses.
+
+A ResponseCache can be passed to any number of GraphAPI instances:
+
+import facebook
+from facebook.cache import ResponseCache
+cache = ResponseCache(ttl=60, ttls={"*/feed": 10}, max_bytes=32 * 2 ** 20)
+graph = facebook.GraphAPI(access_token, cache=cache)
+graph.get_object("me")  # From Facebook
+graph.get_object("me")  # From memory
+cache.stats()
+
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that evicts the least recently used keys.
+
+    It holds at most maxsize keys and, if max_bytes is given, values with
+    a total size of at most max_bytes, as given to set().
+    """
+
+    def __init__(self, maxsize=1024, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = (value, size)
+            return value
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while self._data and (
+                    len(self._data) > self.maxsize or
+                    (self.max_bytes is not None and
+                     self.size > self.max_bytes)):
+                self.size -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class CacheEntry(object):
+    """A cached response body with its ETag and expiry time."""
+
+    __slots__ = ("content_type", "content", "url", "etag", "expires")
+
+    def __init__(self, content_type, content, url, etag, expires):
+        self.content_type = content_type
+        self.content = content
+        self.url = url
+        self.etag = etag
+        self.expires = expires
+
+
+class ResponseCache(object):
+    """
+    Caches GET responses of the Graph API.
+
+    Responses are cached for ttl seconds, or for the seconds of the first
+    pattern in ttls (a dict of fnmatch patterns, matched against the
+    request path, to seconds) that matches. Expired responses that came
+    with an ETag are kept and revalidated with If-None-Match, so an
+    unchanged object only costs a 304 response.
+
+    Keys are made of the API version, path and arguments. The access
+    token is left out of the arguments, but a hash of it is part of the
+    key, so users never see each others responses.
+    """
+
+    def __init__(self, ttl=60, ttls=None, maxsize=1024, max_bytes=None,
+                 clock=time.time):
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = LRUCache(maxsize, max_bytes)
+
+    def key(self, version, path, args):
+        """Returns the cache key for a request."""
+        token = args.get("access_token")
+        if token:
+            token = hashlib.sha1(token.encode("utf-8")).hexdigest()
+        items = tuple(sorted((k, str(v)) for k, v in args.items()
+                             if k != "access_token"))
+        return (version, path.strip("/"), items, token)
+
+    def ttl_for(self, path):
+        """Returns the number of seconds responses for path are fresh."""
+        for pattern, ttl in self.ttls.items():
+            if fnmatchcase(path.strip("/"), pattern):
+                return ttl
+        return self.ttl
+
+    def get(self, key):
+        """
+        Returns a (entry, fresh) tuple for key.
+
+        entry is None when nothing is cached, and fresh tells whether the
+        entry can be used without revalidating it.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires > self.clock():
+            self.hits += 1
+            return entry, True
+        self.misses += 1
+        return entry, False
+
+    def set(self, key, path, content_type, content, url, etag=None):
+        """Caches a response, if it can be used or revalidated later."""
+        ttl = self.ttl_for(path)
+        if ttl <= 0 and not etag:
+            return
+        entry = CacheEntry(content_type, content, url, etag,
+                           self.clock() + ttl)
+        self._entries.set(key, entry, len(content))
+
+    def revalidated(self, key, path, entry):
+        """Marks an entry as fresh again after a 304 response."""
+        self.revalidations += 1
+        entry.expires = self.clock() + self.ttl_for(path)
+        self._entries.set(key, entry, len(entry.content))
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """Returns a dict with the hit, miss and eviction counts and size."""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self._entries.evictions,
+                "entries": len(self._entries),
+                "bytes": self._entries.size}
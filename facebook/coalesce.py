@@ -0,0 +1,209 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Coalescing of get_object calls.
+
+A Coalescer collects the get_object calls made within a short window, from
+any thread, and fetches them with a single ids= request:
+
+import facebook
+from facebook.coalesce import Coalescer
+objects = Coalescer(facebook.GraphAPI(access_token), window=0.005)
+user = objects.get_object("4", fields="name")
+
+The fields of the calls are merged, and every caller gets only the fields
+it asked for. A call that is identical to one that is waiting or in flight
+shares its result instead of being sent again. facebook.aio.AsyncCoalescer
+does the same for AsyncGraphAPI.
+"""
+
+import re
+import threading
+from concurrent.futures import Future
+
+from . import IDS_CHUNK_SIZE, GraphAPIError
+
+_FIELD_NAME_RE = re.compile(r"[.{(]")
+
+
+def split_fields(fields):
+    """
+    Splits a fields argument, a comma separated string or a list, into
+    its top level fields, leaving nested fields like "posts{id,message}"
+    intact.
+    """
+    if isinstance(fields, (list, tuple, set)):
+        fields = ",".join(fields)
+    result = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(fields):
+        if char in "{(":
+            depth += 1
+        elif char in "})":
+            depth -= 1
+        elif char == "," and depth == 0:
+            result.append(fields[start:index].strip())
+            start = index + 1
+    result.append(fields[start:].strip())
+    return [field for field in result if field]
+
+
+def field_name(field):
+    """Returns the key a field ends up under, "posts" for "posts{id}"."""
+    return _FIELD_NAME_RE.split(field, 1)[0].strip()
+
+
+class Batch(object):
+    """
+    The get_object calls with the same arguments, apart from fields, that
+    are waiting to be sent together.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.ids = []
+        self.fields = set()
+        self.waiters = []
+        self.timer = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id, fields, future):
+        if id not in self.ids:
+            self.ids.append(id)
+        names = None
+        if fields is not None:
+            self.fields.update(fields)
+            names = set(field_name(field) for field in fields)
+        self.waiters.append((id, names, future))
+
+    def request_args(self):
+        args = dict(self.args)
+        if self.fields:
+            args["fields"] = ",".join(sorted(self.fields))
+        return args
+
+    def results(self, objects):
+        """Yields the future and result or error of every waiter."""
+        for id, names, future in self.waiters:
+            obj = objects.get(id)
+            if obj is None:
+                yield future, GraphAPIError(
+                    "No object returned for {0}".format(id))
+            elif isinstance(obj, Exception) or names is None:
+                yield future, obj
+            else:
+                yield future, dict((key, value) for key, value in obj.items()
+                                   if key in names or key == "id")
+
+
+def request_key(id, args):
+    """
+    Returns the keys identifying a get_object call: the key of the batch
+    it can join, and the key of identical calls, and its fields. Calls
+    without fields get the default fields, so they're batched separately.
+    """
+    fields = args.pop("fields", None)
+    if fields is not None:
+        fields = tuple(sorted(split_fields(fields)))
+    batch_key = (fields is None, tuple(sorted(
+        (key, str(value)) for key, value in args.items())))
+    return batch_key, (id, batch_key, fields), fields
+
+
+class Coalescer(object):
+    """
+    Merges get_object calls on graph made within window seconds into one
+    request for up to max_keys ids.
+
+    When a batch is full it is sent right away, otherwise when the window
+    closes. Calls with other arguments than fields, like a different
+    locale, are batched separately.
+    """
+
+    def __init__(self, graph, window=0.005, max_keys=IDS_CHUNK_SIZE):
+        self.graph = graph
+        self.window = window
+        self.max_keys = max_keys
+        self.requests = 0
+        self._batches = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def get_object(self, id, **args):
+        """Fetches the given object from the graph, like GraphAPI does."""
+        return self.submit(id, **args).result()
+
+    def submit(self, id, **args):
+        """
+        Schedules a get_object call, and returns a Future of its result.
+        """
+        batch_key, call_key, fields = request_key(id, args)
+        with self._lock:
+            future = self._calls.get(call_key)
+            if future is not None:
+                return future
+            future = self._calls[call_key] = Future()
+            batch = self._batches.get(batch_key)
+            if batch is None:
+                batch = self._batches[batch_key] = Batch(args)
+                timer = threading.Timer(self.window, self._flush,
+                                        (batch_key, batch))
+                timer.daemon = True
+                timer.start()
+                batch.timer = timer
+            batch.add(id, fields, future)
+            full = len(batch) >= self.max_keys and self._take(batch_key,
+                                                              batch)
+        future.add_done_callback(lambda _: self._done(call_key))
+        if full:
+            batch.timer.cancel()
+            thread = threading.Thread(target=self._send, args=(batch,))
+            thread.daemon = True
+            thread.start()
+        return future
+
+    def _done(self, call_key):
+        with self._lock:
+            self._calls.pop(call_key, None)
+
+    def _take(self, batch_key, batch):
+        """Removes batch from the waiting batches, if it still is one."""
+        if self._batches.get(batch_key) is not batch:
+            return False
+        del self._batches[batch_key]
+        self.requests += 1
+        return True
+
+    def _flush(self, batch_key, batch):
+        with self._lock:
+            if not self._take(batch_key, batch):
+                return
+        self._send(batch)
+
+    def _send(self, batch):
+        try:
+            objects = self.graph.get_objects(
+                batch.ids, chunk_size=self.max_keys, raise_errors=False,
+                **batch.request_args())
+        except Exception as e:
+            objects = dict((id, e) for id in batch.ids)
+        for future, result in batch.results(objects):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,288 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Bulk export of connections to newline delimited JSON.
+
+An Export streams the connections of many objects to a file, one line per
+item, without keeping more than a page and the write buffer in memory:
+
+import facebook
+from facebook.export import Export
+graph = facebook.GraphAPI(access_token)
+export = Export(graph, "feeds.ndjson.gz", ["feed", "comments"],
+                fields="id,message,created_time")
+export.run(page_ids)
+
+Every line is {"object_id": ..., "connection": ..., "data": item}. Files
+ending in .gz are gzip compressed and files ending in .zst zstd compressed,
+which requires Python 3.14 or the zstandard package.
+
+Whenever the write buffer is flushed, the position in the list of objects
+and the cursor of the next page are saved to a small state file next to
+the output. Running the same export again after a crash resumes exactly
+there: the output is truncated to the last flush, so no item is written
+twice or skipped. The state file is removed once the export completes.
+
+The same is available on the command line, see python -m facebook export
+--help.
+"""
+
+import hashlib
+import json
+import os
+import timeit
+import zlib
+
+from . import GraphAPIError
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+except ImportError:
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+    from urllib import urlencode
+
+try:
+    _replace = os.replace
+except AttributeError:
+    _replace = os.rename
+
+BUFFER_SIZE = 4 * 1024 * 1024
+# Query parameters that aren't saved in the state file.
+_SECRET_PARAMS = ("access_token", "appsecret_proof")
+
+
+def _gzip_compressor(level):
+    def compress(data):
+        # Every flush is a complete gzip member, and concatenated members
+        # are a valid gzip file.
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    return compress
+
+
+def _zstd_compressor(level):
+    try:
+        from compression import zstd
+        return lambda data: zstd.compress(data, level)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires Python 3.14 or the "
+                          "zstandard package: pip install zstandard")
+    # Every flush is a complete frame, and concatenated frames are a valid
+    # zstd file.
+    return zstandard.ZstdCompressor(level=level).compress
+
+
+COMPRESSIONS = {
+    "gzip": (_gzip_compressor, 6),
+    "zstd": (_zstd_compressor, 3),
+    "none": (lambda level: lambda data: data, None),
+}
+
+
+def compression_for(path):
+    """Returns the compression of a file by its extension."""
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".zst"):
+        return "zstd"
+    return "none"
+
+
+def strip_secrets(url):
+    """Removes the access token and its proof from a url."""
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query)
+             if key not in _SECRET_PARAMS]
+    return urlunsplit(parts[:3] + (urlencode(query),) + parts[4:])
+
+
+class Export(object):
+    """
+    Writes the connections of objects to path as NDJSON.
+
+    connections is a list of connection names, which are exported for
+    each object in turn. args, like fields and limit, are passed with the
+    request for the first page. With skip_errors, objects of which a
+    connection can't be read (like deleted ones) are counted in
+    stats["errors"] and skipped instead of raising the GraphAPIError.
+
+    The output is written and the state saved whenever buffer_size bytes
+    of lines were collected, and every checkpoint_interval seconds. The
+    state file defaults to path + ".state".
+    """
+
+    def __init__(self, graph, path, connections, state_path=None,
+                 compression=None, level=None, buffer_size=BUFFER_SIZE,
+                 checkpoint_interval=60, skip_errors=False, **args):
+        self.graph = graph
+        self.path = path
+        if isinstance(connections, str):
+            connections = [connections]
+        self.connections = list(connections)
+        self.state_path = state_path or path + ".state"
+        self.compression = compression or compression_for(path)
+        make, default_level = COMPRESSIONS[self.compression]
+        self._compress = make(default_level if level is None else level)
+        self.buffer_size = buffer_size
+        self.checkpoint_interval = checkpoint_interval
+        self.skip_errors = skip_errors
+        self.args = args
+        self.stats = {"items": 0, "pages": 0, "errors": 0, "bytes": 0}
+        self._buffer = []
+        self._buffered = 0
+        self._file = None
+        self._offset = 0
+        self._checkpointed = None
+        self._key = None
+        self._position = (0, None)
+
+    def run(self, ids):
+        """
+        Exports the connections of the objects with the given ids, resuming
+        an earlier run of the same export if its state file exists.
+        Returns the stats of the export.
+        """
+        ids = list(ids)
+        state = self._load_state(ids)
+        position = state["position"]
+        next_url = state["next"]
+        self._open(state["offset"])
+        try:
+            pairs = [(id, name) for id in ids for name in self.connections]
+            while position < len(pairs):
+                id, name = pairs[position]
+                next_url = self._export(id, name, next_url)
+                if next_url is None:
+                    position += 1
+                # Only whole pages are buffered, so the buffer always
+                # matches the position and cursor to save with it.
+                self._position = (position, next_url)
+                if (self._buffered >= self.buffer_size or
+                        timeit.default_timer() - self._checkpointed >=
+                        self.checkpoint_interval):
+                    self.checkpoint()
+            self.checkpoint()
+        except BaseException:
+            # Keep what was fetched; the original error is raised anyway.
+            try:
+                self.checkpoint()
+            except Exception:
+                pass
+            self._close()
+            raise
+        self._close()
+        os.remove(self.state_path)
+        return self.stats
+
+    def _export(self, id, name, url):
+        """
+        Exports a page of a connection, the first one if url is None.
+        Returns the url of the next page, or None after the last one.
+        """
+        # request() returns plain pages, whatever the graph's result type.
+        try:
+            if url is None:
+                page = self.graph.request("{0}/{1}".format(id, name),
+                                          dict(self.args))
+            else:
+                page = self.graph.bare_request(
+                    url, self.graph._token_args({}))
+        except GraphAPIError:
+            if not self.skip_errors:
+                raise
+            self.stats["errors"] += 1
+            return None
+        self.stats["pages"] += 1
+        dumps = self.graph.json.dumps
+        prefix = '{{"object_id": {0}, "connection": {1}, "data": '.format(
+            json.dumps(id), json.dumps(name))
+        items = page.get("data") or []
+        for item in items:
+            line = (prefix + dumps(item) + "}\n").encode("utf-8")
+            self._buffer.append(line)
+            self._buffered += len(line)
+        self.stats["items"] += len(items)
+        url = page.get("paging", {}).get("next")
+        if not url or not items:
+            return None
+        return strip_secrets(url)
+
+    def checkpoint(self):
+        """Writes the buffered lines, and then saves the state."""
+        if self._buffer:
+            data = self._compress(b"".join(self._buffer))
+            # From the last checkpoint, overwriting anything a failed
+            # attempt left behind.
+            self._file.seek(self._offset)
+            self._file.write(data)
+            self._file.truncate()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._offset += len(data)
+            self.stats["bytes"] = self._offset
+            self._buffer = []
+            self._buffered = 0
+        position, next_url = self._position
+        self._save_state({"key": self._key, "position": position,
+                          "next": next_url, "offset": self._offset,
+                          "stats": self.stats})
+        self._checkpointed = timeit.default_timer()
+
+    def _open(self, offset):
+        self._file = open(self.path, "r+b" if offset else "wb")
+        # Drop whatever was written after the last checkpoint.
+        self._file.truncate(offset)
+        self._offset = offset
+        self._checkpointed = timeit.default_timer()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _load_state(self, ids):
+        self._key = hashlib.sha1(json.dumps(
+            [ids, self.connections, self.args],
+            sort_keys=True).encode("utf-8")).hexdigest()
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, OSError):
+            state = {"key": self._key, "position": 0, "next": None,
+                     "offset": 0}
+        if state["key"] != self._key:
+            raise ValueError("{0} is the state of another export".format(
+                self.state_path))
+        self.stats.update(state.get("stats", {}))
+        self._position = (state["position"], state["next"])
+        return state
+
+    def _save_state(self, state):
+        temp = self.state_path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # Atomically, so a crash leaves either the old or the new state.
+        _replace(temp, self.state_path)
+
+
+def export_connections(graph, ids, connections, path, **kwargs):
+    """Exports connections of ids to path, see Export. Returns the stats."""
+    return Export(graph, path, connections, **kwargs).run(ids)
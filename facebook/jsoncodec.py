@@ -0,0 +1,244 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+JSON codecs, and lazy decoding of large pages.
+
+GraphAPI and Auth decode JSON with the fastest codec installed: orjson,
+ujson or the standard library's json module, in that order. A specific one
+can be chosen with their json_codec argument:
+
+graph = facebook.GraphAPI(access_token, json_codec="json")
+
+"""
+
+import json
+import re
+
+_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+# Strings, skipped whole so their brackets don't count, and brackets.
+_STRUCTURE_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+
+
+class StdlibCodec(object):
+    """The json module of the standard library."""
+
+    name = "json"
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+
+    def loads(self, content):
+        if isinstance(content, bytes):
+            content = content.decode("utf-8")
+        return self._decoder.decode(content)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+
+class OrjsonCodec(object):
+    """orjson, see https://github.com/ijl/orjson."""
+
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+        self._dumps = orjson.dumps
+
+    def dumps(self, obj):
+        return self._dumps(obj).decode("utf-8")
+
+
+class UjsonCodec(object):
+    """ujson, see https://github.com/ultrajson/ultrajson."""
+
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.loads = ujson.loads
+        self.dumps = ujson.dumps
+
+
+CODECS = {
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+    "json": StdlibCodec,
+}
+
+
+class _FastestCodec(object):
+    """
+    The fastest codec that is installed, which is only looked for (and
+    imported) when it is first used.
+    """
+
+    def __getattr__(self, name):
+        for codec_name in ("orjson", "ujson"):
+            try:
+                codec = CODECS[codec_name]()
+                break
+            except ImportError:
+                pass
+        else:
+            codec = StdlibCodec()
+        # From now on these are found without calling __getattr__.
+        self.name = codec.name
+        self.loads = codec.loads
+        self.dumps = codec.dumps
+        return getattr(codec, name)
+
+
+_default_codec = _FastestCodec()
+
+
+def get_codec(codec=None):
+    """
+    Returns a JSON codec.
+
+    codec is the name of a codec in CODECS, an object with loads() and
+    dumps(), or None for the fastest codec that is installed.
+    """
+    if codec is None:
+        return _default_codec
+    if isinstance(codec, str):
+        return CODECS[codec]()
+    return codec
+
+
+class LazyPage(object):
+    """
+    A page of results of which the "data" array is decoded on demand.
+
+    Instead of decoding the whole response at once, iter_data() decodes the
+    items of the "data" array one by one from the raw response, so they
+    can be processed and dropped without holding the complete decoded page
+    in memory. The other keys, like "paging", are available like in a dict.
+    """
+
+    def __init__(self, content):
+        if isinstance(content, bytes):
+            content = content.decode("utf-8")
+        self._text = content
+        self._decoder = json.JSONDecoder()
+        self._fields = {}
+        self._data_at = None
+        self._after_data = None
+        self._end = None
+        self._scan(stop_at_data=True)
+
+    def _skip(self, index, char=None):
+        index = _WHITESPACE_RE.match(self._text, index).end()
+        if char is not None:
+            if self._text[index:index + 1] != char:
+                raise ValueError("Expected {0!r} at {1}".format(char, index))
+            index = _WHITESPACE_RE.match(self._text, index + 1).end()
+        return index
+
+    def _scan(self, index=None, stop_at_data=False):
+        """
+        Decodes the top level keys from index, and remembers where the
+        data array starts. With stop_at_data, stops at the data array.
+        """
+        if index is None:
+            index = self._skip(0, "{")
+        while self._text[index] != "}":
+            key, index = self._decoder.raw_decode(self._text, index)
+            index = self._skip(index, ":")
+            if key == "data" and self._text[index] == "[":
+                self._data_at = index
+                if stop_at_data:
+                    return
+                index = self._skip_data()
+            else:
+                self._fields[key], index = self._decoder.raw_decode(
+                    self._text, index)
+            index = self._skip(index)
+            if self._text[index] == ",":
+                index = self._skip(index + 1)
+        self._end = index
+
+    def _items(self):
+        """
+        Yields the items of the data array, and remembers where the array
+        ends once they're all decoded.
+        """
+        index = self._skip(self._data_at, "[")
+        while self._text[index] != "]":
+            item, index = self._decoder.raw_decode(self._text, index)
+            index = self._skip(index)
+            if self._text[index] == ",":
+                index = self._skip(index + 1)
+            yield item
+        self._after_data = index + 1
+
+    def iter_data(self):
+        """Yields the items of the data array, decoding them one by one."""
+        if self._data_at is None:
+            return iter(())
+        return self._items()
+
+    def has_data(self):
+        """Returns whether the data array has any items."""
+        if self._data_at is None:
+            return False
+        return self._text[self._skip(self._data_at, "[")] != "]"
+
+    def _skip_data(self):
+        """
+        Returns where the data array ends, finding the matching bracket
+        without decoding the items if they weren't decoded yet.
+        """
+        if self._after_data is not None:
+            return self._after_data
+        depth = 0
+        for match in _STRUCTURE_RE.finditer(self._text, self._data_at):
+            token = match.group()
+            if token in "[{":
+                depth += 1
+            elif token in "]}":
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError("Unterminated data array")
+
+    def _complete(self):
+        """Decodes the keys after the data array, if not done yet."""
+        if self._end is not None:
+            return
+        index = self._skip(self._skip_data())
+        if self._text[index] == ",":
+            index = self._skip(index + 1)
+        self._scan(index)
+
+    def __getitem__(self, key):
+        if key == "data" and self._data_at is not None:
+            return list(self.iter_data())
+        if key not in self._fields:
+            self._complete()
+        return self._fields[key]
+
+    def __contains__(self, key):
+        if key == "data":
+            return self._data_at is not None
+        self._complete()
+        return key in self._fields
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -0,0 +1,245 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Instrumentation of Graph API calls.
+
+GraphAPI, AsyncGraphAPI and Auth take a list of observers, callables that
+are called with a RequestEvent after every call. A MetricsCollector is an
+observer that keeps latency and size histograms per endpoint:
+
+import facebook
+from facebook.metrics import MetricsCollector
+metrics = MetricsCollector()
+graph = facebook.GraphAPI(access_token, observers=[metrics])
+graph.get_object("me")
+for endpoint in metrics.slowest(5):
+    print(endpoint["method"], endpoint["path"], endpoint["p99"])
+
+"""
+
+import math
+import threading
+import time
+
+
+class RequestEvent(object):
+    """
+    A single call to the Graph API, including its retries.
+
+    path is the path template of the url, like "{id}/comments", so calls
+    to the same endpoint can be grouped. Timings are in seconds:
+
+    - total: the whole call, including retries and backoff.
+    - connect: setting up the connection, if the transport reports it.
+    - wait: from sending the request until the response headers arrived,
+      including connecting if that isn't reported separately.
+    - download: reading the response body.
+    - decode: parsing the JSON.
+
+    cache is "hit", "revalidated" or "miss" for calls through a
+    ResponseCache and None otherwise. usage is the rate limit usage from
+    the last response's headers, see facebook.ratelimit.parse_usage().
+    """
+
+    __slots__ = ("method", "path", "started", "total", "connect", "wait",
+                 "download", "decode", "status_code", "response_size",
+                 "cache", "attempts", "error", "error_code", "usage")
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.total = 0.0
+        self.connect = None
+        self.wait = 0.0
+        self.download = 0.0
+        self.decode = 0.0
+        self.status_code = None
+        self.response_size = 0
+        self.cache = None
+        self.attempts = 0
+        self.error = None
+        self.error_code = None
+        self.usage = None
+
+    @property
+    def retries(self):
+        return max(0, self.attempts - 1)
+
+    def failed(self, error):
+        """Notes the error the call ended with."""
+        self.error = error
+        self.error_code = getattr(error, "code", None)
+        if getattr(error, "status_code", None) is not None:
+            self.status_code = error.status_code
+
+    def as_dict(self):
+        result = dict((name, getattr(self, name)) for name in self.__slots__)
+        result["retries"] = self.retries
+        if self.error is not None:
+            result["error"] = repr(self.error)
+        return result
+
+    def __repr__(self):
+        return "<RequestEvent {0} {1} {2} {3:.3f}s>".format(
+            self.method, self.path, self.status_code, self.total)
+
+
+def notify(observers, event):
+    """Calls every observer with the event."""
+    for observer in observers:
+        try:
+            observer(event)
+        except Exception:
+            # Instrumentation must not break the calls it observes.
+            pass
+
+
+class Histogram(object):
+    """
+    Counts values in exponentially growing buckets, from start up, each
+    factor times as wide as the previous one. Percentiles are estimated
+    from the buckets, within the factor of the actual value.
+    """
+
+    def __init__(self, start=0.0001, factor=1.1, buckets=200):
+        self.start = start
+        self.factor = factor
+        self._log_factor = math.log(factor)
+        self.counts = [0] * (buckets + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value <= self.start:
+            index = 0
+        else:
+            index = min(len(self.counts) - 1, 1 + int(
+                math.log(value / self.start) / self._log_factor))
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, percent):
+        """Returns an estimate of the given percentile, like 99."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                upper = self.start * self.factor ** index
+                return max(self.min, min(upper, self.max))
+        return self.max
+
+
+class EndpointStats(object):
+    """The metrics of the calls to one endpoint."""
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.latency = Histogram()
+        self.size = Histogram(start=64, factor=1.5, buckets=40)
+        self.errors = 0
+        self.retries = 0
+        self.cache_hits = 0
+        self.status_codes = {}
+        self.error_codes = {}
+        self.usage = None
+
+    def record(self, event):
+        self.latency.record(event.total)
+        self.size.record(event.response_size)
+        self.retries += event.retries
+        if event.cache in ("hit", "revalidated"):
+            self.cache_hits += 1
+        if event.status_code is not None:
+            self.status_codes[event.status_code] = self.status_codes.get(
+                event.status_code, 0) + 1
+        if event.error is not None:
+            self.errors += 1
+            if event.error_code is not None:
+                self.error_codes[event.error_code] = self.error_codes.get(
+                    event.error_code, 0) + 1
+        if event.usage:
+            self.usage = event.usage
+
+    def as_dict(self):
+        return {
+            "method": self.method,
+            "path": self.path,
+            "count": self.latency.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "cache_hits": self.cache_hits,
+            "status_codes": dict(self.status_codes),
+            "error_codes": dict(self.error_codes),
+            "mean": self.latency.mean,
+            "p50": self.latency.percentile(50),
+            "p90": self.latency.percentile(90),
+            "p99": self.latency.percentile(99),
+            "max": self.latency.max,
+            "bytes": int(self.size.sum),
+            "p99_bytes": self.size.percentile(99),
+            "usage": self.usage,
+        }
+
+
+class MetricsCollector(object):
+    """
+    Keeps metrics of the observed calls per method and path template.
+
+    snapshot() returns them as a list of dicts, ready to be exported to a
+    monitoring system, and slowest() the endpoints with the highest
+    latency percentile.
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event.method, event.path)
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = EndpointStats(*key)
+            stats.record(event)
+
+    def snapshot(self):
+        """Returns the metrics of every endpoint."""
+        with self._lock:
+            return [stats.as_dict() for stats in self._endpoints.values()]
+
+    def slowest(self, count=10, percentile="p99"):
+        """Returns the metrics of the count slowest endpoints."""
+        return sorted(self.snapshot(), key=lambda stats: stats[percentile],
+                      reverse=True)[:count]
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
@@ -0,0 +1,351 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Compact results, for crawls that keep many objects in memory.
+
+By default results are nested dicts, which store their keys in every
+object. With results="objects" GraphAPI returns GraphObjects instead:
+records with __slots__, of which one class is made per set of keys, so the
+keys are stored once per class. With results="columns", pages of
+get_connections and iter_connections calls with fields are kept as a
+ColumnarPage, one list per field, and rows are only made when asked for:
+
+import facebook
+graph = facebook.GraphAPI(access_token, results="columns")
+page = graph.get_connections("me", "feed", fields="id,message")
+messages = page.column("message")
+for post in page:
+    print(post.id, post["message"])
+
+Both can be read like the dicts they replace, and to_dict() converts them.
+"""
+
+import keyword
+import re
+import threading
+
+from .cache import LRUCache
+from .coalesce import field_name, split_fields
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+_IDENTIFIER_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+_ID_RE = re.compile(r"^\d+(?:_\d+)?$")
+
+# The number of GraphObject classes that are kept.
+MAX_CLASSES = 1024
+# Dicts with more keys than this stay dicts, see to_objects().
+MAX_FIELDS = 64
+
+
+class GraphObject(object):
+    """
+    A Graph API object with its fields in slots.
+
+    Fields can be read as attributes, obj.name, or like a dict, obj["name"],
+    which also works for fields that aren't valid attribute names.
+    """
+
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            return getattr(self, self._slot(key))
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in self._fields:
+            return getattr(self, self._slot(key))
+        return default
+
+    def _slot(self, key):
+        return key
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [self[key] for key in self._fields]
+
+    def items(self):
+        return [(key, self[key]) for key in self._fields]
+
+    def to_dict(self):
+        """Returns the object as nested dicts and lists."""
+        return dict((key, to_dicts(value)) for key, value in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (GraphObject, dict)):
+            return self.to_dict() == to_dicts(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return to_objects, (self.to_dict(),)
+
+    def __repr__(self):
+        return "GraphObject({0!r})".format(self.to_dict())
+
+
+class _MangledObject(GraphObject):
+    """A GraphObject with fields that can't be slot names as they are."""
+
+    __slots__ = ()
+    _slots = {}
+
+    def _slot(self, key):
+        return self._slots[key]
+
+
+_classes = LRUCache(MAX_CLASSES)
+_classes_lock = threading.Lock()
+_reserved = set(dir(GraphObject))
+
+
+def object_class(keys):
+    """
+    Returns the GraphObject class with the given tuple of keys. The
+    MAX_CLASSES most recently used classes are kept; objects of a class
+    that was dropped keep working.
+    """
+    cls = _classes.get(keys)
+    if cls is not None:
+        return cls
+    with _classes_lock:
+        cls = _classes.get(keys)
+        if cls is None:
+            cls = _make_class(keys)
+            _classes.set(keys, cls)
+        return cls
+
+
+def _make_class(keys):
+    keys = tuple(intern(str(key)) for key in keys)
+    if all(_valid_slot(key) for key in keys):
+        cls = type("GraphObject", (GraphObject,),
+                   {"__slots__": keys, "_fields": keys})
+    else:
+        slots = dict((key, key if _valid_slot(key) else "_f{0}".format(i))
+                     for i, key in enumerate(keys))
+        cls = type("GraphObject", (_MangledObject,),
+                   {"__slots__": tuple(slots[key] for key in keys),
+                    "_fields": keys, "_slots": slots})
+    return cls
+
+
+def _dict_like(value):
+    """
+    Whether a dict is a mapping rather than a record, like the result of
+    get_objects() which is keyed by ids. A class per set of keys would
+    only be used once for those.
+    """
+    return (len(value) > MAX_FIELDS or
+            any(_ID_RE.match(str(key)) for key in value))
+
+
+def _valid_slot(key):
+    return (_IDENTIFIER_RE.match(key) is not None and
+            not keyword.iskeyword(key) and key not in _reserved)
+
+
+def to_objects(value, memo=None):
+    """
+    Converts dicts in value, and in its lists and dicts, to GraphObjects.
+
+    Equal strings are replaced by a single instance, kept in the memo dict
+    for the duration of the conversion. JSON decoders return a new string
+    for every occurrence of values like timestamps and names.
+
+    Dicts keyed by ids, or with more than MAX_FIELDS keys, are kept as
+    dicts of converted values.
+    """
+    if memo is None:
+        memo = {}
+    if isinstance(value, dict):
+        if _dict_like(value):
+            return dict((key, to_objects(item, memo))
+                        for key, item in value.items())
+        cls = object_class(tuple(value))
+        obj = cls.__new__(cls)
+        slot = obj._slot
+        for key, item in value.items():
+            object.__setattr__(obj, slot(key), to_objects(item, memo))
+        return obj
+    if isinstance(value, list):
+        return [to_objects(item, memo) for item in value]
+    if isinstance(value, _STRING_TYPES):
+        return memo.setdefault(value, value)
+    return value
+
+
+def page_objects(page):
+    """Converts a decoded page or a LazyPage to a GraphObject."""
+    from . import _page_items
+    # The items first, so a LazyPage decodes them only once.
+    memo = {}
+    data = [to_objects(item, memo) for item in _page_items(page)]
+    result = dict(_page_keys(page))
+    result["data"] = data
+    return to_objects(result, memo)
+
+
+def _page_keys(page):
+    """Yields the keys and values of a page other than the data array."""
+    if isinstance(page, dict):
+        keys = [key for key in page if key != "data"]
+    else:
+        # A LazyPage, of which only the usual keys are looked up.
+        keys = [key for key in ("paging", "summary") if key in page]
+    for key in keys:
+        yield key, page[key]
+
+
+def to_dicts(value):
+    """Converts GraphObjects and ColumnarPages in value to dicts."""
+    if isinstance(value, (GraphObject, ColumnarPage)):
+        return value.to_dict()
+    if isinstance(value, dict):
+        return dict((key, to_dicts(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [to_dicts(item) for item in value]
+    return value
+
+
+class ColumnarPage(object):
+    """
+    A page of connections with a list of values per field, in the order
+    of the data array, instead of an object per item.
+
+    Values of fields an item doesn't have are None. Items are returned as
+    GraphObjects with only the fields they have, and the other keys of the
+    page, like "paging", are available like in a dict.
+    """
+
+    def __init__(self, fields, items=(), extra=None):
+        self.fields = tuple(intern(field_name(field))
+                            for field in split_fields(fields))
+        if "id" not in self.fields:
+            # The Graph API always returns the id.
+            self.fields = ("id",) + self.fields
+        self.columns = dict((name, []) for name in self.fields)
+        # The indexes of the items without a field, per field.
+        self._missing = dict((name, set()) for name in self.fields)
+        self._extra = {}
+        self._length = 0
+        memo = {}
+        for item in items:
+            self.append(item, memo)
+        for key, value in (extra or {}).items():
+            if key != "data":
+                self._extra[key] = to_objects(value, memo)
+
+    @classmethod
+    def from_page(cls, page, fields):
+        """Makes a ColumnarPage of a decoded page or a LazyPage."""
+        from . import _page_items
+        # The items first, so a LazyPage decodes them only once.
+        result = cls(fields, _page_items(page))
+        result._extra = dict((key, to_objects(value))
+                             for key, value in _page_keys(page))
+        return result
+
+    def append(self, item, memo=None):
+        """
+        Adds an item of the data array. Strings equal to ones in the memo
+        dict are replaced by those, see to_objects().
+        """
+        for name in self.fields:
+            if name not in item:
+                self._missing[name].add(self._length)
+            self.columns[name].append(to_objects(item.get(name), memo))
+        self._length += 1
+
+    def column(self, name):
+        """Returns the list of values of a field."""
+        return self.columns[name]
+
+    def __len__(self):
+        return self._length
+
+    def row(self, index):
+        """Returns the item at index as a GraphObject."""
+        if index < 0:
+            index += self._length
+        names = tuple(name for name in self.fields
+                      if index not in self._missing[name])
+        cls = object_class(names)
+        obj = cls.__new__(cls)
+        for name in names:
+            object.__setattr__(obj, obj._slot(name),
+                               self.columns[name][index])
+        return obj
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self.row(index)
+
+    def has_data(self):
+        return self._length > 0
+
+    def to_dicts(self):
+        """Returns the items as a list of dicts."""
+        return [row.to_dict() for row in self]
+
+    def to_dict(self):
+        """Returns the page as it was returned by the Graph API."""
+        result = dict((key, to_dicts(value))
+                      for key, value in self._extra.items())
+        result["data"] = self.to_dicts()
+        return result
+
+    def __getitem__(self, key):
+        if key == "data":
+            return list(self)
+        return self._extra[key]
+
+    def __contains__(self, key):
+        return key == "data" or key in self._extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "<ColumnarPage {0} items of {1}>".format(
+            self._length, ",".join(self.fields))
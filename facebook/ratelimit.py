@@ -0,0 +1,233 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Rate limiting driven by the Graph API usage headers.
+
+Facebook reports how much of the rate limits an app, page or business has
+used in the X-App-Usage, X-Page-Usage and X-Business-Use-Case-Usage
+headers, as percentages. A RateLimiter shared by all GraphAPI instances of
+an app slows requests down as these get close to 100%:
+
+import facebook
+from facebook.ratelimit import RateLimiter
+limiter = RateLimiter(rate=20)
+graph = facebook.GraphAPI(access_token, rate_limiter=limiter)
+graph.get_object("me")
+graph.usage
+
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+USAGE_HEADERS = {
+    "x-app-usage": "app",
+    "x-page-usage": "page",
+    "x-ad-account-usage": "ad_account",
+}
+BUSINESS_USAGE_HEADER = "x-business-use-case-usage"
+USAGE_KEYS = ("call_count", "total_cputime", "total_time",
+              "acc_id_util_pct")
+
+
+def parse_usage(headers):
+    """
+    Returns the usage reported in the headers of a response.
+
+    The result maps "app", "page", "ad_account" and "business" to the
+    highest percentage of their limits used, for the headers that were
+    present. For the business use case header the estimated number of
+    seconds until access is regained is included as "regain_seconds".
+    """
+    usage = {}
+    for header, scope in USAGE_HEADERS.items():
+        value = _load(headers.get(header))
+        if isinstance(value, dict):
+            usage[scope] = _highest(value)
+
+    business = _load(headers.get(BUSINESS_USAGE_HEADER))
+    if isinstance(business, dict):
+        percentages = [0]
+        regain = [0]
+        for entries in business.values():
+            for entry in entries if isinstance(entries, list) else [entries]:
+                percentages.append(_highest(entry))
+                regain.append(60 * float(
+                    entry.get("estimated_time_to_regain_access") or 0))
+        usage["business"] = max(percentages)
+        usage["regain_seconds"] = max(regain)
+    return usage
+
+
+def _load(value):
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+def _highest(values):
+    return max([float(values.get(key) or 0) for key in USAGE_KEYS] + [0])
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket.
+
+    Tokens are added at rate per second, up to capacity. acquire() blocks
+    until a token is available. Until paused_until, no tokens are added.
+    """
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.paused_until = 0
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        start = max(self._updated, self.paused_until)
+        if now > start:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - start) * self.rate)
+        self._updated = max(now, self._updated)
+
+    def acquire(self):
+        """Takes a token, waiting for it when the bucket is empty."""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens -= 1
+            wait = max(0, self.paused_until - now)
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(self.clock())
+            self.rate = float(rate)
+
+    def pause(self, seconds):
+        """Stops adding tokens for the given number of seconds."""
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.paused_until = max(self.paused_until, now + seconds)
+            self.tokens = min(self.tokens, 0)
+
+
+class RateLimiter(object):
+    """
+    Schedules Graph API requests within the app's rate limits.
+
+    Requests are allowed at rate per second (with bursts of burst
+    requests), both for the app as a whole and per access token. When the
+    reported usage of a scope passes slowdown_at percent, the rate of its
+    bucket drops linearly, down to min_rate at stop_at percent. When
+    Facebook reports a business use case as throttled, requests with that
+    token are paused until it expects access to be regained.
+    """
+
+    def __init__(self, rate=50, burst=None, slowdown_at=75, stop_at=95,
+                 min_rate=0.2, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst or rate
+        self.slowdown_at = slowdown_at
+        self.stop_at = stop_at
+        self.min_rate = min_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.app_usage = {}
+        self._token_usage = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key):
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate, self.burst,
+                                                 self.clock, self.sleep)
+            return self._buckets[key]
+
+    @staticmethod
+    def _token_key(access_token):
+        if not access_token:
+            return None
+        return hashlib.sha1(access_token.encode("utf-8")).hexdigest()
+
+    def acquire(self, access_token=None):
+        """
+        Waits until a request with the access token may be made.
+
+        Returns the number of seconds waited.
+        """
+        waited = self._bucket("app").acquire()
+        key = self._token_key(access_token)
+        if key is not None:
+            waited += self._bucket(key).acquire()
+        return waited
+
+    def observe(self, headers, access_token=None):
+        """Updates the rates with the usage headers of a response."""
+        usage = parse_usage(headers)
+        if not usage:
+            return
+        if "app" in usage:
+            self.app_usage = {"app": usage["app"]}
+            self._bucket("app").set_rate(self.rate_for(usage["app"]))
+
+        key = self._token_key(access_token)
+        token_usage = dict((scope, value) for scope, value in usage.items()
+                           if scope != "app")
+        if key is None or not token_usage:
+            return
+        self._token_usage[key] = token_usage
+        bucket = self._bucket(key)
+        bucket.set_rate(self.rate_for(max(
+            value for scope, value in token_usage.items()
+            if scope != "regain_seconds")))
+        if token_usage.get("regain_seconds"):
+            bucket.pause(token_usage["regain_seconds"])
+
+    def rate_for(self, percentage):
+        """Returns the request rate to use at the given usage percentage."""
+        if percentage < self.slowdown_at:
+            return self.rate
+        if percentage >= self.stop_at:
+            return self.min_rate
+        fraction = ((self.stop_at - percentage) /
+                    float(self.stop_at - self.slowdown_at))
+        return max(self.min_rate, self.rate * fraction)
+
+    def usage(self, access_token=None):
+        """
+        Returns the last reported usage percentages for the app and, if
+        given, for the access token.
+        """
+        usage = dict(self.app_usage)
+        key = self._token_key(access_token)
+        if key is not None:
+            usage.update(self._token_usage.get(key, {}))
+        return usage
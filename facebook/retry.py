@@ -0,0 +1,189 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Retrying transient Graph API errors.
+
+import facebook
+from facebook.retry import RetryPolicy
+graph = facebook.GraphAPI(access_token, retry_policy=RetryPolicy())
+
+Transient errors are retried with exponential backoff and full jitter,
+within a total time budget. Per endpoint a circuit breaker is kept: after
+too many consecutive transient failures, calls to that endpoint fail with
+CircuitOpenError straight away, until the endpoint is tried again after a
+cool down period.
+"""
+
+import random
+import threading
+import time
+
+import requests
+
+from . import GraphAPIError
+from .transport import TransportError
+
+# Graph API error codes that are worth retrying: unknown/service errors,
+# and application, user and page level throttling.
+RETRY_CODES = (1, 2, 4, 17, 32, 341, 613)
+
+
+class CircuitOpenError(GraphAPIError):
+    """Raised instead of calling an endpoint whose circuit is open."""
+
+
+class CircuitBreaker(object):
+    """
+    Keeps track of consecutive failures of a single endpoint.
+
+    After threshold failures the circuit opens for reset_timeout seconds.
+    After that a single trial call is let through: if it succeeds the
+    circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30, clock=time.time):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Returns whether a call may be made now."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = self.clock()
+            self._trial = False
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed calls are retried, and when.
+
+    Calls with a method in retry_methods are attempted up to max_attempts
+    times, sleeping a random time between 0 and backoff * 2 ** attempt
+    (at most max_backoff) seconds in between, and giving up when the next
+    attempt would start after budget seconds. Errors are retried when
+    they're a GraphAPIError with a code in retry_codes or an HTTP status
+    of 500 or higher, or a connection error or timeout of the transport.
+
+    A circuit breaker with breaker_threshold and breaker_timeout is kept
+    per endpoint, set breaker_threshold to None to disable them.
+    """
+
+    def __init__(self, max_attempts=4, backoff=0.5, max_backoff=30,
+                 budget=60, retry_codes=RETRY_CODES,
+                 retry_methods=("GET", "DELETE"), breaker_threshold=5,
+                 breaker_timeout=30, clock=time.time, sleep=time.sleep,
+                 random=random.random):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.retry_codes = retry_codes
+        self.retry_methods = retry_methods
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.random = random
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def is_retryable(self, error):
+        """Returns whether the error is likely to go away on a retry."""
+        if isinstance(error, GraphAPIError):
+            if error.code in self.retry_codes:
+                return True
+            return (error.status_code or 0) >= 500
+        return isinstance(error, (requests.ConnectionError,
+                                  requests.Timeout, TransportError))
+
+    def breaker(self, endpoint):
+        """Returns the circuit breaker for endpoint."""
+        if self.breaker_threshold is None:
+            return None
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_timeout,
+                    self.clock)
+            return self._breakers[endpoint]
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait before the next attempt."""
+        return self.random() * min(self.max_backoff,
+                                   self.backoff * 2 ** attempt)
+
+    def call(self, func, method="GET", endpoint=""):
+        """Calls func, retrying it on transient errors."""
+        breaker = self.breaker(endpoint)
+        attempts = self.max_attempts
+        if method.upper() not in self.retry_methods:
+            attempts = 1
+        deadline = self.clock() + self.budget
+        attempt = 0
+        while True:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(
+                    "Circuit for {0} is open after repeated failures".format(
+                        endpoint or "endpoint"))
+            try:
+                result = func()
+            except Exception as e:
+                retryable = self.is_retryable(e)
+                if breaker is not None:
+                    if retryable:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+                attempt += 1
+                if not retryable or attempt >= attempts:
+                    raise
+                delay = self.delay(attempt - 1)
+                if self.clock() + delay > deadline:
+                    raise
+                self.sleep(delay)
+            else:
+                if breaker is not None:
+                    breaker.success()
+                return result
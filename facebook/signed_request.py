@@ -0,0 +1,153 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Verification of signed requests, as found in the fbsr_ cookie.
+
+Auth.parse_signed_request() uses a SignedRequestVerifier, which can also be
+used on its own, for example when rotating the app secret:
+
+from facebook.signed_request import SignedRequestVerifier
+verifier = SignedRequestVerifier([new_secret, old_secret])
+data = verifier.verify(cookies["fbsr_" + app_id])
+
+"""
+
+import base64
+import hashlib
+import hmac
+import time
+
+from .cache import LRUCache
+from .jsoncodec import get_codec
+
+_compare_digest = getattr(hmac, "compare_digest", None)
+
+
+def compare_digest(a, b):
+    """
+    Compares two byte strings in constant time, like hmac.compare_digest()
+    which older Pythons don't have.
+    """
+    if _compare_digest is not None:
+        return _compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+def _urlsafe_b64decode(value):
+    if not isinstance(value, bytes):
+        value = value.encode("ascii")
+    return base64.urlsafe_b64decode(value + b"=" * ((4 - len(value) % 4) % 4))
+
+
+class SignedRequestVerifier(object):
+    """
+    Verifies and decodes signed requests.
+
+    secrets is the app secret, or a list of them of which any may have
+    signed the request. The HMAC key setup is done once per secret, and
+    signatures are compared in constant time.
+
+    Verified signed requests are kept in an LRU of cache_size entries,
+    until max_age seconds after their issued_at time, so a cookie that is
+    sent with every request is only verified once.
+    """
+
+    def __init__(self, secrets, cache_size=1024, max_age=3600,
+                 clock=time.time, json_codec=None):
+        if not isinstance(secrets, (list, tuple)):
+            secrets = [secrets]
+        # HMAC can only handle ascii (byte) strings
+        # http://bugs.python.org/issue5285
+        self._macs = [hmac.new(secret.encode("ascii")
+                               if not isinstance(secret, bytes) else secret,
+                               digestmod=hashlib.sha256)
+                      for secret in secrets]
+        self.max_age = max_age
+        self.clock = clock
+        self.json = get_codec(json_codec)
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def verify(self, signed_request):
+        """
+        Return dictionary with signed request data.
+
+        Raises a ValueError if the signed request is malformed, corrupted
+        or not signed with one of the secrets.
+        """
+        if self.cache is not None:
+            cached = self.cache.get(signed_request)
+            if cached is not None:
+                data, expires = cached
+                if expires > self.clock():
+                    return dict(data)
+                self.cache.pop(signed_request)
+
+        data = self._verify(signed_request)
+        issued_at = data.get("issued_at")
+        if self.cache is not None and isinstance(issued_at, (int, float)):
+            expires = issued_at + self.max_age
+            if expires > self.clock():
+                self.cache.set(signed_request, (data, expires))
+        return dict(data)
+
+    def verify_many(self, signed_requests):
+        """
+        Verifies many signed requests, for example from logs.
+
+        Returns a list with the data of each signed request, or the
+        ValueError it raised, in the same order.
+        """
+        results = []
+        for signed_request in signed_requests:
+            try:
+                results.append(self.verify(signed_request))
+            except ValueError as e:
+                results.append(e)
+        return results
+
+    def _verify(self, signed_request):
+        try:
+            encoded_sig, payload = signed_request.split('.', 1)
+            sig = _urlsafe_b64decode(encoded_sig)
+        except (ValueError, TypeError):
+            raise ValueError('signed_request malformed')
+
+        try:
+            payload = payload.encode('ascii')
+        except (AttributeError, UnicodeError):
+            raise ValueError('signed_request malformed')
+        for mac in self._macs:
+            mac = mac.copy()
+            mac.update(payload)
+            if compare_digest(sig, mac.digest()):
+                break
+        else:
+            raise ValueError('signed_request had signature mismatch')
+
+        try:
+            data = self.json.loads(_urlsafe_b64decode(payload))
+        except (TypeError, ValueError):
+            raise ValueError('signed_request had corrupted payload')
+        if not isinstance(data, dict):
+            raise ValueError('signed_request had corrupted payload')
+
+        if data.get('algorithm', '').upper() != 'HMAC-SHA256':
+            raise ValueError('signed_request used unknown algorithm')
+        return data
@@ -0,0 +1,250 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Incremental sync of connections.
+
+A DeltaSync remembers a high-water mark per object and connection, and
+only fetches the items that are newer than it on the next run, instead of
+the whole connection:
+
+import facebook
+from facebook.sync import DeltaSync
+from facebook.tokens import SQLiteBackend
+graph = facebook.GraphAPI(access_token)
+sync = DeltaSync(graph, SQLiteBackend("sync.sqlite", table="facebook_sync"))
+for page_id, result in sync.sync_many(page_ids, "feed").items():
+    store(result.items)
+
+The mark is the latest created_time seen, and items are fetched with
+since. As timestamps have a resolution of seconds, and items can show up
+a little late, the ids of the items within overlap seconds of the mark are
+kept too, so items at the boundary aren't reported twice. Connections
+that can't be filtered by time use the "before" cursor of the newest item
+instead, with mode="cursor".
+"""
+
+import calendar
+import re
+import time
+
+from .export import strip_secrets
+from .tokens import MemoryBackend
+
+_TIME_RE = re.compile(
+    r"^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?"
+    r"(Z|([+-])(\d\d):?(\d\d))?$")
+# Marks are kept until they are replaced.
+_FOREVER = float("inf")
+
+
+def parse_time(value):
+    """
+    Returns the Unix time of a Graph API timestamp, which is either ISO
+    8601, like "2015-01-01T12:00:00+0000", or already a Unix time.
+    """
+    if isinstance(value, (int, float)):
+        return value
+    if value.isdigit():
+        return int(value)
+    match = _TIME_RE.match(value)
+    if match is None:
+        raise ValueError("Unknown time format: {0}".format(value))
+    parts = match.groups()
+    seconds = calendar.timegm(tuple(int(part) for part in parts[:6]))
+    if parts[7]:
+        offset = int(parts[8]) * 3600 + int(parts[9]) * 60
+        seconds -= offset if parts[7] == "+" else -offset
+    return seconds
+
+
+class SyncResult(object):
+    """
+    What a sync of one connection found: the new items, newest first as
+    the Graph API returns them, the number of requests it took, and the
+    high-water marks before and after. full is set for the first sync of
+    a connection, which has no mark to start from.
+    """
+
+    def __init__(self, id, connection, items, requests, old_mark, mark):
+        self.id = id
+        self.connection = connection
+        self.items = items
+        self.requests = requests
+        self.old_mark = old_mark
+        self.mark = mark
+        self.full = old_mark is None
+
+    @property
+    def changed(self):
+        return bool(self.items)
+
+    def __repr__(self):
+        return "<SyncResult {0}/{1}: {2} new in {3} requests>".format(
+            self.id, self.connection, len(self.items), self.requests)
+
+
+class DeltaSync(object):
+    """
+    Fetches the items of connections that are new since the last sync.
+
+    store keeps the marks, a facebook.tokens.MemoryBackend or
+    SQLiteBackend (or anything with their get, set and delete methods);
+    by default they're only kept in memory. mode is "time" to filter on
+    time_field with since, or "cursor" to continue from the newest item's
+    cursor. start is the Unix time to sync from when a connection has no
+    mark yet, by default its whole history. args, like fields and limit,
+    are passed with every request.
+    """
+
+    def __init__(self, graph, store=None, mode="time", time_field=None,
+                 overlap=300, start=None, clock=time.time, **args):
+        if mode not in ("time", "cursor"):
+            raise ValueError("mode is either 'time' or 'cursor'")
+        self.graph = graph
+        self.store = store or MemoryBackend(maxsize=_FOREVER)
+        self.mode = mode
+        self.time_field = time_field or "created_time"
+        self.overlap = overlap
+        self.start = start
+        self.clock = clock
+        self.args = args
+
+    def key(self, id, connection):
+        return "{0}/{1}".format(id, connection)
+
+    def get_mark(self, id, connection):
+        """Returns the high-water mark of a connection, or None."""
+        return self.store.get(self.key(id, connection), self.clock())
+
+    def reset(self, id, connection):
+        """Forgets the mark, so the next sync fetches everything again."""
+        self.store.delete(self.key(id, connection))
+
+    def sync(self, id, connection, **args):
+        """
+        Fetches the new items of a connection and moves its mark past them,
+        once all of them were fetched. Returns a SyncResult.
+        """
+        args = dict(self.args, **args)
+        mark = self.get_mark(id, connection)
+        if self.mode == "cursor":
+            result = self._sync_cursor(id, connection, args, mark)
+        else:
+            result = self._sync_time(id, connection, args, mark)
+        if result.mark is not None:
+            self.store.set(self.key(id, connection), result.mark, _FOREVER,
+                           self.clock())
+        return result
+
+    def sync_many(self, ids, connection, **args):
+        """
+        Syncs a connection of many objects concurrently, on the graph's
+        executor. Returns a dict of id to SyncResult.
+        """
+        ids = list(ids)
+        results = self.graph._map(
+            lambda id: self.sync(id, connection, **args), ids)
+        return dict(zip(ids, results))
+
+    def _sync_time(self, id, connection, args, mark):
+        field = self.time_field
+        if "fields" in args:
+            fields = args["fields"].split(",")
+            if field not in fields:
+                args["fields"] = ",".join(fields + [field])
+        if mark is not None:
+            since = mark["time"] - self.overlap
+        else:
+            since = self.start
+        if since is not None:
+            args["since"] = int(since)
+
+        seen = dict(mark["seen"]) if mark is not None else {}
+        items = []
+        latest = mark["time"] if mark is not None else None
+        requests = 0
+        for page in self._pages(id, connection, args):
+            requests += 1
+            older = 0
+            for item in page.get("data") or []:
+                created = parse_time(item[field])
+                if since is not None and created < since:
+                    # Past the mark, if the connection ignores since.
+                    older += 1
+                    continue
+                if item["id"] in seen:
+                    continue
+                seen[item["id"]] = created
+                items.append(item)
+                if latest is None or created > latest:
+                    latest = created
+            if older:
+                break
+
+        new_mark = None
+        if latest is not None:
+            # Only the ids that can show up again in the overlap are kept.
+            new_mark = {"time": latest, "seen": dict(
+                (item_id, created) for item_id, created in seen.items()
+                if created >= latest - self.overlap)}
+        return SyncResult(id, connection, items, requests, mark,
+                          new_mark or mark)
+
+    def _sync_cursor(self, id, connection, args, mark):
+        items = []
+        requests = 0
+        cursor = mark["before"] if mark is not None else None
+        if cursor is None:
+            # The first page has the newest items, and its before cursor
+            # the position to continue from next time.
+            for page in self._pages(id, connection, args):
+                requests += 1
+                if cursor is None:
+                    cursor = _cursor(page, "before")
+                items.extend(page.get("data") or [])
+        else:
+            # Pages with a before cursor go towards newer items, which are
+            # requested until there are none.
+            while True:
+                page = self.graph.request(
+                    "{0}/{1}".format(id, connection),
+                    dict(args, before=cursor))
+                requests += 1
+                data = page.get("data") or []
+                if not data:
+                    break
+                items[:0] = data
+                cursor = _cursor(page, "before") or cursor
+                if not page.get("paging", {}).get("previous"):
+                    break
+        new_mark = {"before": cursor} if cursor is not None else None
+        return SyncResult(id, connection, items, requests, mark,
+                          new_mark or mark)
+
+    def _pages(self, id, connection, args):
+        """Yields the pages of a connection, following paging.next."""
+        page = self.graph.request("{0}/{1}".format(id, connection),
+                                  dict(args))
+        while True:
+            yield page
+            url = page.get("paging", {}).get("next")
+            if not url or not page.get("data"):
+                return
+            page = self.graph.bare_request(strip_secrets(url),
+                                           self.graph._token_args({}))
+
+
+def _cursor(page, name):
+    return page.get("paging", {}).get("cursors", {}).get(name)
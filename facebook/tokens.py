@@ -0,0 +1,422 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Caching and refreshing of access tokens.
+
+The fbsr_ cookie keeps the same OAuth code until it is rotated, and a code
+can only be exchanged for an access token once. A CodeExchangeCache
+remembers the token per code, so Auth.get_user_from_cookie(validate=True)
+only calls Facebook when the cookie changes. With a SQLiteBackend the
+cache is shared by all processes on a machine:
+
+import facebook
+from facebook.tokens import CodeExchangeCache, SQLiteBackend
+cache = CodeExchangeCache(SQLiteBackend("/var/tmp/fb-tokens.sqlite"))
+auth = facebook.Auth(app_id, app_secret, redirect_uri, exchange_cache=cache)
+
+Every Auth has a TokenManager as auth.tokens, which keeps long-lived user
+and page tokens and extends them before they expire:
+
+auth.tokens.add(page_id, page_token, expires_in=5184000)
+auth.tokens.start()
+graph = auth.tokens.graph(page_id)
+
+With an app secret, GraphAPI signs every call with an appsecret_proof, see
+https://developers.facebook.com/docs/graph-api/securing-requests:
+
+graph = facebook.GraphAPI(page_token, app_secret=app_secret)
+
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import weakref
+
+from .cache import LRUCache
+
+
+class MemoryBackend(object):
+    """Keeps values in an LRU of maxsize entries in this process."""
+
+    def __init__(self, maxsize=10000):
+        self._entries = LRUCache(maxsize)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def set(self, key, value, expires, now):
+        self._entries.set(key, (value, expires))
+
+    def delete(self, key):
+        self._entries.pop(key)
+
+
+class SQLiteBackend(object):
+    """
+    Keeps values in a SQLite database, which can be shared by several
+    processes. Values must be JSON serializable.
+    """
+
+    def __init__(self, path, table="facebook_tokens"):
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY,"
+                       " value TEXT, expires REAL)".format(table))
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            import sqlite3
+            db = self._local.db = sqlite3.connect(self.path, timeout=10)
+        return db
+
+    def get(self, key, now):
+        row = self._connection().execute(
+            "SELECT value FROM {0} WHERE key = ? AND expires > ?".format(
+                self.table), (key, now)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, expires, now):
+        with self._connection() as db:
+            db.execute("INSERT OR REPLACE INTO {0} VALUES (?, ?, ?)".format(
+                self.table), (key, json.dumps(value), expires))
+            db.execute("DELETE FROM {0} WHERE expires <= ?".format(
+                self.table), (now,))
+
+    def delete(self, key):
+        with self._connection() as db:
+            db.execute("DELETE FROM {0} WHERE key = ?".format(self.table),
+                       (key,))
+
+
+class AppSecretProof(object):
+    """
+    Computes the appsecret_proof of access tokens, the HMAC-SHA256 of the
+    token keyed with the app secret.
+
+    The HMAC key setup is done once, and the proofs of the last maxsize
+    tokens are kept, so a proof is only computed once per token.
+    """
+
+    def __init__(self, app_secret, maxsize=10000):
+        if not isinstance(app_secret, bytes):
+            app_secret = app_secret.encode("ascii")
+        self._mac = hmac.new(app_secret, digestmod=hashlib.sha256)
+        self._proofs = LRUCache(maxsize)
+
+    def __call__(self, access_token):
+        proof = self._proofs.get(access_token)
+        if proof is None:
+            mac = self._mac.copy()
+            mac.update(access_token.encode("utf-8"))
+            proof = mac.hexdigest()
+            self._proofs.set(access_token, proof)
+        return proof
+
+
+_proofs = {}
+_proofs_lock = threading.Lock()
+
+
+def get_appsecret_proof(app_secret):
+    """
+    Returns the AppSecretProof for app_secret, which is shared by all
+    GraphAPI instances with that secret.
+    """
+    if isinstance(app_secret, AppSecretProof):
+        return app_secret
+    with _proofs_lock:
+        if app_secret not in _proofs:
+            _proofs[app_secret] = AppSecretProof(app_secret)
+        return _proofs[app_secret]
+
+
+class _InFlight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CodeExchangeCache(object):
+    """
+    Caches the access tokens that OAuth codes were exchanged for.
+
+    Tokens are kept until margin seconds before they expire, according to
+    the "expires" Facebook returned with them, or for default_ttl seconds
+    if it didn't. When several threads ask for the same code at once, only
+    one of them exchanges it and the others wait for its result.
+    """
+
+    def __init__(self, backend=None, default_ttl=3600, margin=60,
+                 clock=time.time):
+        self.backend = backend or MemoryBackend()
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(code, user_id=None):
+        """Returns the cache key for a code, without storing the code."""
+        value = u"{0}:{1}".format(user_id or "", code).encode("utf-8")
+        return "code:" + hashlib.sha256(value).hexdigest()
+
+    def get(self, code, user_id=None):
+        """Returns the cached token for code, or None."""
+        result = self.backend.get(self.key(code, user_id), self.clock())
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def set(self, code, result, user_id=None):
+        """Caches the token code was exchanged for."""
+        self.backend.set(self.key(code, user_id), result,
+                         self._expires(result), self.clock())
+
+    def get_or_exchange(self, code, exchange, user_id=None):
+        """
+        Returns the cached token for code, or calls exchange(code) to get
+        it. The result is a dict like get_access_token_from_code() returns.
+        """
+        result = self.get(code, user_id)
+        if result is not None:
+            return result
+
+        key = self.key(code, user_id)
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[key] = _InFlight()
+        if not leader:
+            in_flight.event.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        self.misses += 1
+        try:
+            result = in_flight.result = exchange(code)
+            self.set(code, result, user_id)
+            return result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.event.set()
+
+    def _expires(self, result):
+        try:
+            ttl = int(result["expires"])
+        except (KeyError, TypeError, ValueError):
+            ttl = self.default_ttl
+        return self.clock() + ttl - self.margin
+
+
+class TokenManager(object):
+    """
+    Hands out access tokens for an Auth without calls on the hot path.
+
+    The app token is formed locally as "app_id|app_secret". User and page
+    tokens are added with add() and kept with their expiry, in memory and
+    in the backend if one is given, so other processes can get() them too.
+
+    Tokens that are less than refresh_margin seconds from expiring are
+    extended with Auth.extend_access_token() in a background thread, when
+    they're asked for or, after start(), every interval seconds. Graphs
+    returned by graph() are handed the new token. With a refresh_margin of
+    None tokens are never refreshed, and get() drops them once expired.
+    """
+
+    def __init__(self, auth, backend=None, refresh_margin=7 * 24 * 3600,
+                 retry_interval=60, clock=time.time):
+        self.auth = auth
+        self.backend = backend
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.errors = {}
+        self._tokens = {}
+        self._graphs = {}
+        self._refreshing = set()
+        self._retry_at = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def app_token(self):
+        """The app access token, which needs no call to Facebook."""
+        return u"{0}|{1}".format(self.auth.app_id, self.auth.app_secret)
+
+    def add(self, key, access_token, expires_in=None):
+        """
+        Keeps access_token under key, for example a user or page id.
+        expires_in is the number of seconds the token is valid, or None if
+        it doesn't expire, like page tokens of long-lived user tokens.
+        """
+        expires = None
+        if expires_in is not None:
+            expires = self.clock() + int(expires_in)
+        with self._lock:
+            self._tokens[key] = (access_token, expires)
+            graphs = list(self._graphs.get(key, ()))
+        for graph in graphs:
+            graph.access_token = access_token
+        if self.backend is not None:
+            self.backend.set(
+                "token:{0}".format(key),
+                {"access_token": access_token, "expires": expires},
+                float("inf") if expires is None else expires, self.clock())
+
+    def get(self, key):
+        """
+        Returns the access token kept under key, or None.
+
+        A token close to expiring is returned while a fresh one is fetched
+        in the background. An expired token is refreshed before returning.
+        """
+        entry = self._tokens.get(key)
+        if entry is None and self.backend is not None:
+            value = self.backend.get("token:{0}".format(key), self.clock())
+            if value is not None:
+                entry = (value["access_token"], value["expires"])
+                with self._lock:
+                    self._tokens.setdefault(key, entry)
+        if entry is None:
+            return None
+        access_token, expires = entry
+        if expires is not None:
+            now = self.clock()
+            if self.refresh_margin is None:
+                return access_token if expires > now else None
+            if expires <= now:
+                return self.refresh(key)
+            if expires - now <= self.refresh_margin:
+                self._refresh_in_background(key)
+        return access_token
+
+    def expires(self, key):
+        """Returns when the token under key expires, or None."""
+        entry = self._tokens.get(key)
+        return entry[1] if entry else None
+
+    def refresh(self, key):
+        """Extends the token under key now, and returns the new token."""
+        access_token = self._tokens[key][0]
+        result = self.auth.extend_access_token(access_token)
+        self.add(key, result["access_token"],
+                 result.get("expires_in", result.get("expires")))
+        self.errors.pop(key, None)
+        return result["access_token"]
+
+    def _refresh_in_background(self, key):
+        with self._lock:
+            if (key in self._refreshing or
+                    self._retry_at.get(key, 0) > self.clock()):
+                return
+            self._refreshing.add(key)
+        thread = threading.Thread(target=self._refresh_quietly, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_quietly(self, key):
+        try:
+            self.refresh(key)
+        except Exception as e:
+            # The current token is still valid, try again a bit later.
+            self.errors[key] = e
+            with self._lock:
+                self._retry_at[key] = self.clock() + self.retry_interval
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def refresh_due(self):
+        """Refreshes all tokens close to expiring, returns their keys."""
+        if self.refresh_margin is None:
+            return []
+        now = self.clock()
+        with self._lock:
+            due = [key for key, (_, expires) in self._tokens.items()
+                   if expires is not None and
+                   expires - now <= self.refresh_margin and
+                   self._retry_at.get(key, 0) <= now]
+        for key in due:
+            with self._lock:
+                if key in self._refreshing:
+                    continue
+                self._refreshing.add(key)
+            self._refresh_quietly(key)
+        return due
+
+    def start(self, interval=3600):
+        """Refreshes tokens close to expiring every interval seconds."""
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stopped.wait(interval):
+                self.refresh_due()
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops refreshing tokens in the background."""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def graph(self, key=None, **kwargs):
+        """
+        Returns a GraphAPI using the token under key, or the app token if
+        key is None. The graph gets the new token whenever it is refreshed.
+        """
+        kwargs.setdefault("version", self.auth.version)
+        kwargs.setdefault("session", self.auth.session)
+        kwargs.setdefault("graph_url", self.auth.graph.graph_url)
+        kwargs.setdefault("json_codec", self.auth.json)
+        kwargs.setdefault("app_secret", self.auth.app_secret)
+        kwargs.setdefault("observers", self.auth.graph.observers)
+        if getattr(self.auth.graph, "_transport", None) is not None:
+            kwargs.setdefault("transport", self.auth.graph.transport)
+        if key is None:
+            return self.auth.graph_class(access_token=self.app_token,
+                                         **kwargs)
+        access_token = self.get(key)
+        if access_token is None:
+            raise KeyError(key)
+        graph = self.auth.graph_class(access_token=access_token, **kwargs)
+        with self._lock:
+            self._graphs.setdefault(key, weakref.WeakSet()).add(graph)
+        return graph
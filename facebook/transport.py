@@ -0,0 +1,291 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Transports, which send the HTTP requests of GraphAPI and Auth.
+
+A transport has a single method, like requests.Session.request():
+
+    request(method, url, params=None, data=None, headers=None,
+            timeout=None, stream=False)
+
+which returns a response with status_code, headers, content, url and
+elapsed attributes, and iter_content() and close() methods. The body is
+turned into a result by GraphAPI, whatever the transport. A response may
+also have a raw attribute with a readinto() method, which download() then
+reads the body with.
+
+RequestsTransport is the default. HTTP2Transport multiplexes concurrent
+requests over a few HTTP/2 connections, and MemoryTransport answers
+requests from memory, for tests and benchmarks:
+
+import facebook
+from facebook.transport import HTTP2Transport
+transport = HTTP2Transport(max_connections=4)
+graph = facebook.GraphAPI(access_token, transport=transport, max_workers=200)
+
+"""
+
+import datetime
+import json
+import threading
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def make_session(pool_connections=10, pool_maxsize=10, pool_block=False,
+                 keep_alive=True):
+    """
+    Create a requests Session with a connection pool for the Graph API.
+
+    pool_connections is the number of per-host pools to cache, pool_maxsize
+    the maximum number of connections kept open to a single host. With
+    pool_block set, callers wait for a free connection instead of opening
+    an extra, unpooled one. The returned session can be shared between
+    threads and passed to any number of GraphAPI and Auth instances.
+    """
+    # requests is only imported when a session is first needed, as it
+    # takes longer to import than the rest of the package.
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          pool_block=pool_block)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
+
+
+def get_default_session():
+    """Return the session shared by all instances that weren't given one."""
+    global _default_session
+    if _default_session is None:
+        with _default_session_lock:
+            if _default_session is None:
+                _default_session = make_session()
+    return _default_session
+
+
+class TransportError(IOError):
+    """
+    A connection error or timeout of a transport other than requests,
+    which raises requests.ConnectionError and requests.Timeout instead.
+    """
+
+
+class RequestsTransport(object):
+    """
+    Sends requests with a requests Session, by default the module wide
+    one returned by get_default_session().
+    """
+
+    def __init__(self, session=None):
+        self._session = session
+
+    @property
+    def session(self):
+        if self._session is None:
+            return get_default_session()
+        return self._session
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, stream=False):
+        return self.session.request(method, url, params=params, data=data,
+                                    headers=headers, timeout=timeout,
+                                    stream=stream)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+class Headers(dict):
+    """A dict of HTTP headers with case-insensitive names."""
+
+    def __init__(self, headers=()):
+        super(Headers, self).__init__()
+        for name, value in dict(headers).items():
+            self[name] = value
+
+    def __setitem__(self, name, value):
+        super(Headers, self).__setitem__(name.lower(), value)
+
+    def __getitem__(self, name):
+        return super(Headers, self).__getitem__(name.lower())
+
+    def __contains__(self, name):
+        return super(Headers, self).__contains__(name.lower())
+
+    def get(self, name, default=None):
+        return super(Headers, self).get(name.lower(), default)
+
+
+class Response(object):
+    """A response of a transport, with the attributes GraphAPI uses."""
+
+    def __init__(self, status_code=200, headers=None, content=b"", url="",
+                 elapsed=None):
+        self.status_code = status_code
+        self.headers = Headers(headers or {})
+        self.content = content
+        self.url = url
+        self.elapsed = elapsed or datetime.timedelta(0)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class _HTTPXResponse(object):
+    """Gives an httpx response the attributes of a requests response."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def content(self):
+        return self._response.read()
+
+    @property
+    def elapsed(self):
+        try:
+            return self._response.elapsed
+        except RuntimeError:
+            # Only known once the body was read.
+            return datetime.timedelta(0)
+
+    def iter_content(self, chunk_size=1):
+        return self._response.iter_bytes(chunk_size)
+
+    def close(self):
+        self._response.close()
+
+
+class HTTP2Transport(object):
+    """
+    Sends requests over HTTP/2 with httpx, so concurrent requests from
+    any number of threads share up to max_connections connections to a
+    host. Requires httpx with HTTP/2 support: pip install httpx[http2].
+    """
+
+    def __init__(self, max_connections=4, keepalive_expiry=30,
+                 http1=True, client=None):
+        import httpx
+        self._httpx = httpx
+        if client is None:
+            client = httpx.Client(
+                http2=True, http1=http1,
+                limits=httpx.Limits(max_connections=max_connections,
+                                    keepalive_expiry=keepalive_expiry))
+        self.client = client
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, stream=False):
+        headers = dict(headers or {})
+        kwargs = {}
+        if hasattr(data, "read"):
+            # A streaming body, like upload.MultipartEncoder.
+            if hasattr(data, "__len__"):
+                headers["Content-Length"] = str(len(data))
+            kwargs["content"] = iter(data)
+        elif data is not None:
+            kwargs["data"] = data
+        try:
+            request = self.client.build_request(
+                method, url, params=params, headers=headers,
+                timeout=timeout, **kwargs)
+            response = self.client.send(request, stream=stream)
+        except self._httpx.TransportError as e:
+            raise TransportError(e)
+        return _HTTPXResponse(response)
+
+    def close(self):
+        self.client.close()
+
+
+class MemoryTransport(object):
+    """
+    Answers requests from memory, without any network.
+
+    routes maps paths (without the version, like "me" or "1/feed") to
+    responses: a dict or list is returned as JSON, bytes as a binary body,
+    a Response as is, and a callable is called with (method, url, kwargs)
+    to get one of those. Paths without a route get a Graph API error.
+    Instead of routes, a single callable can be given for all paths.
+
+    All requests are recorded in calls, as (method, url, kwargs) tuples.
+    """
+
+    def __init__(self, routes=None):
+        self.routes = routes if routes is not None else {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, stream=False):
+        kwargs = {"params": params, "data": data, "headers": headers}
+        with self._lock:
+            self.calls.append((method, url, kwargs))
+        if callable(self.routes):
+            result = self.routes(method, url, kwargs)
+        else:
+            result = self.routes.get(self.path(url))
+            if result is None:
+                result = Response(404, {"content-type": "application/json"},
+                                  json.dumps({"error": {
+                                      "message": "Unknown path components",
+                                      "type": "OAuthException",
+                                      "code": 2500}}).encode("utf-8"))
+            elif callable(result):
+                result = result(method, url, kwargs)
+        return self.response(result, url)
+
+    @staticmethod
+    def path(url):
+        """Returns the path of url without the version."""
+        parts = urlsplit(url).path.strip("/").split("/")
+        if parts and parts[0][:1] == "v" and parts[0][1:2].isdigit():
+            parts = parts[1:]
+        return "/".join(parts)
+
+    @staticmethod
+    def response(result, url=""):
+        """Turns a route's result into a Response."""
+        if hasattr(result, "status_code"):
+            if not result.url:
+                result.url = url
+            return result
+        if isinstance(result, bytes):
+            return Response(200, {"content-type": "application/octet-stream"},
+                            result, url)
+        return Response(200, {"content-type": "application/json"},
+                        json.dumps(result).encode("utf-8"), url)
+
+    def close(self):
+        pass
@@ -0,0 +1,285 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Streaming uploads to the Graph API.
+
+MultipartEncoder streams a multipart/form-data body from files, instead of
+building it in memory, and is used by GraphAPI.put_photo(). ResumableUpload
+implements the chunked video upload protocol:
+
+import facebook
+from facebook.upload import ResumableUpload
+graph = facebook.GraphAPI(page_token)
+upload = ResumableUpload(graph, "page_id/videos", "movie.mp4",
+                         progress=lambda sent, total: print(sent, total))
+try:
+    video = upload.upload(title="Movie")
+except Exception:
+    video = upload.upload(title="Movie")  # Resumes at the last chunk
+
+See https://developers.facebook.com/docs/graph-api/video-uploads
+"""
+
+import mmap
+import os
+import threading
+import uuid
+
+from . import GraphAPIError
+
+BLOCK_SIZE = 64 * 1024
+
+
+def _size(fileobj):
+    """Returns the number of bytes left to read in fileobj."""
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, OSError, IOError, ValueError):
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - position
+        fileobj.seek(position)
+        return size
+
+
+class MultipartEncoder(object):
+    """
+    A file-like multipart/form-data body, read part by part.
+
+    fields is a dict of form field names to values. files is a dict of
+    field names to file objects, bytes-like objects or (filename, file,
+    content_type) tuples. Files are read in blocks when the body is read,
+    so memory use does not depend on their size.
+    """
+
+    def __init__(self, fields=None, files=None, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={0}".format(
+            self.boundary)
+        self._parts = []
+        for name, value in (fields or {}).items():
+            self._add_part(name, value, None, None)
+        for name, value in (files or {}).items():
+            if isinstance(value, tuple):
+                filename, value, content_type = value
+            else:
+                filename = os.path.basename(getattr(value, "name", name))
+                content_type = "application/octet-stream"
+            self._add_part(name, value, filename, content_type)
+        self._parts.append(
+            "--{0}--\r\n".format(self.boundary).encode("utf-8"))
+        self.len = sum(len(part) if not hasattr(part, "read") else _size(part)
+                       for part in self._parts)
+        self._current = 0
+
+    def _add_part(self, name, value, filename, content_type):
+        header = '--{0}\r\nContent-Disposition: form-data; name="{1}"'.format(
+            self.boundary, name)
+        if filename is not None:
+            header += '; filename="{0}"\r\nContent-Type: {1}'.format(
+                filename, content_type)
+        self._parts.append((header + "\r\n\r\n").encode("utf-8"))
+        if filename is None and not isinstance(value, bytes):
+            value = u"{0}".format(value).encode("utf-8")
+        if not hasattr(value, "read"):
+            value = memoryview(value)
+        self._parts.append(value)
+        self._parts.append(b"\r\n")
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        """Reads up to size bytes of the body, or all of it."""
+        chunks = []
+        while self._current < len(self._parts) and size != 0:
+            part = self._parts[self._current]
+            if hasattr(part, "read"):
+                chunk = part.read(BLOCK_SIZE if size < 0 else size)
+            else:
+                end = len(part) if size < 0 else size
+                chunk = bytes(part[:end])
+                self._parts[self._current] = part[len(chunk):]
+            if not chunk:
+                self._current += 1
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(BLOCK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class ResumableUpload(object):
+    """
+    Uploads a video with the start/transfer/finish upload phases.
+
+    file is a path or a file object backed by a real file, which is
+    memory-mapped so chunks are sent without copying the file into memory.
+    A file opened from a path is closed by close(), or at the end of a
+    with block.
+    path is the videos edge, like "me/videos" or "page_id/videos".
+
+    The acknowledged offset is kept on the instance, so after a failure
+    calling upload() again resumes at the last chunk Facebook confirmed.
+    progress, if given, is called with the number of bytes confirmed and
+    the file size after every chunk.
+
+    Facebook hands out the offsets of every next chunk, so chunks are sent
+    one after the other. With workers > 1 and a chunk_size, the rest of the
+    file is instead split into chunks of chunk_size that are sent
+    concurrently; only use that with endpoints that accept chunks out of
+    order.
+    """
+
+    def __init__(self, graph, path, file, chunk_size=None, workers=1,
+                 progress=None):
+        self.graph = graph
+        self.path = path
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.progress = progress
+        # A file opened from a path is closed by close(), a file object is
+        # left to the caller.
+        self._owns_file = not hasattr(file, "fileno")
+        if self._owns_file:
+            self._file = open(file, "rb")
+        else:
+            self._file = file
+        self.file_size = os.fstat(self._file.fileno()).st_size
+        self._map = None
+        self.session_id = None
+        self.video_id = None
+        self.start_offset = 0
+        self.end_offset = 0
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        """A memory-map of the file."""
+        if self._map is None:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        return self._map
+
+    def close(self):
+        """
+        Releases the memory-map, and closes the file if it was opened from
+        a path. Called by upload() once the upload is finished.
+        """
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Chunks are still referenced, the map is closed when the
+                # last of them is garbage collected.
+                pass
+            self._map = None
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def upload(self, **params):
+        """
+        Uploads the whole file and finishes the upload with params (like
+        title and description). Returns the response of the finish phase.
+        """
+        if self.session_id is None:
+            self.start()
+        if self.workers > 1 and self.chunk_size:
+            self._transfer_parallel()
+        else:
+            while self.start_offset < self.end_offset:
+                self.transfer()
+        result = self.finish(**params)
+        self.close()
+        return result
+
+    def start(self):
+        """Starts an upload session."""
+        result = self.graph.request(self.path, post_args={
+            "upload_phase": "start", "file_size": self.file_size},
+            method="POST")
+        self.session_id = result["upload_session_id"]
+        self.video_id = result.get("video_id")
+        self.start_offset = int(result["start_offset"])
+        self.end_offset = int(result["end_offset"])
+        return result
+
+    def transfer(self):
+        """Sends the chunk Facebook asked for next."""
+        result = self._send_chunk(self.start_offset, self.end_offset)
+        self.start_offset = int(result["start_offset"])
+        self.end_offset = int(result["end_offset"])
+        self._report(self.start_offset)
+        return result
+
+    def _transfer_parallel(self):
+        """Sends the rest of the file in concurrent chunks of chunk_size."""
+        offsets = list(range(self.start_offset, self.file_size,
+                             self.chunk_size))
+        done = set()
+
+        def send(start):
+            self._send_chunk(start, min(start + self.chunk_size,
+                                        self.file_size))
+            with self._lock:
+                done.add(start)
+                # Only a contiguous prefix of chunks counts as confirmed.
+                while self.start_offset in done:
+                    self.start_offset = min(
+                        self.start_offset + self.chunk_size, self.file_size)
+                self._report(self.start_offset)
+
+        calls = self.graph._map(send, offsets, max_in_flight=self.workers)
+        for _ in calls:
+            pass
+        self.end_offset = self.start_offset
+
+    def _send_chunk(self, start, end):
+        chunk = memoryview(self.data)[start:end]
+        fields = {"upload_phase": "transfer",
+                  "upload_session_id": self.session_id,
+                  "start_offset": start}
+        result = self.graph.request(
+            self.path, post_args=fields,
+            files={"video_file_chunk": ("chunk", chunk,
+                                        "application/octet-stream")},
+            method="POST")
+        if "start_offset" not in result:
+            raise GraphAPIError(result)
+        return result
+
+    def finish(self, **params):
+        """Finishes the upload session."""
+        params.update(upload_phase="finish",
+                      upload_session_id=self.session_id)
+        return self.graph.request(self.path, post_args=params,
+                                  method="POST")
+
+    def _report(self, offset):
+        if self.progress is not None:
+            self.progress(offset, self.file_size)
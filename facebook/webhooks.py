@@ -0,0 +1,367 @@
+# Copyright 2015 Tino de Bruijn
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Receiving webhooks (Real-time Updates).
+
+A WebhookHandler answers the subscription verification, checks the
+signature of notifications, drops the ones that were delivered before and
+fetches the changed objects in batches on a background thread. It works
+with any web framework, through handle():
+
+import facebook
+from facebook.webhooks import WebhookHandler
+
+def process(results):
+    for change, obj in results:
+        print(change.field, change.object_id, obj)
+
+handler = WebhookHandler(app_secret, verify_token, process,
+                         graph=facebook.GraphAPI(page_token),
+                         fields="id,message")
+
+# In a view of the callback url:
+status, body = handler.handle(request.method, request.GET, request.headers,
+                              request.body)
+
+See https://developers.facebook.com/docs/graph-api/webhooks
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+
+from . import IDS_CHUNK_SIZE
+from .cache import LRUCache
+from .signed_request import compare_digest
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+logger = logging.getLogger(__name__)
+
+
+def _header(headers, name):
+    """Looks up a header in a dict, whatever the case of its name."""
+    value = headers.get(name)
+    if value is None:
+        name = name.lower()
+        for key in headers:
+            if key.lower() == name:
+                return headers[key]
+    return value
+
+
+class Change(object):
+    """
+    A single change of a notification.
+
+    object is the type of object, like "page" or "user", entry_id the id
+    of the object the subscription is for, field the field that changed
+    and value its details (for "feed" changes a dict with the item, verb
+    and post_id among others). time is the Unix time of the entry.
+    """
+
+    __slots__ = ("object", "entry_id", "field", "value", "time")
+
+    def __init__(self, object, entry_id, field, value=None, time=None):
+        self.object = object
+        self.entry_id = entry_id
+        self.field = field
+        self.value = value
+        self.time = time
+
+    @property
+    def object_id(self):
+        """
+        The id of the object to fetch for the change: the comment, post or
+        other item it is about if it has one, otherwise the entry's.
+        """
+        if isinstance(self.value, dict):
+            for key in ("comment_id", "post_id", "photo_id", "video_id",
+                        "id"):
+                if self.value.get(key):
+                    return str(self.value[key])
+        return str(self.entry_id)
+
+    @property
+    def removed(self):
+        """Whether the change removed the item, so it can't be fetched."""
+        return (isinstance(self.value, dict) and
+                self.value.get("verb") in ("remove", "delete"))
+
+    def key(self):
+        """Identifies the change, to recognize repeated deliveries."""
+        return hashlib.sha1(json.dumps(
+            [self.object, self.entry_id, self.field, self.value, self.time],
+            sort_keys=True).encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        return "<Change {0} {1} {2}>".format(self.object, self.entry_id,
+                                             self.field)
+
+
+def parse_changes(payload):
+    """Returns the changes of a decoded notification."""
+    changes = []
+    object_type = payload.get("object")
+    for entry in payload.get("entry") or []:
+        entry_id = entry.get("id") or entry.get("uid")
+        entry_time = entry.get("time")
+        if "changes" in entry:
+            for change in entry["changes"]:
+                changes.append(Change(object_type, entry_id,
+                                      change.get("field"),
+                                      change.get("value"), entry_time))
+        else:
+            # The older format, with just the names of changed fields.
+            for field in entry.get("changed_fields") or []:
+                changes.append(Change(object_type, entry_id, field,
+                                      time=entry_time))
+    return changes
+
+
+class WebhookHandler(object):
+    """
+    Handles webhook requests for an app.
+
+    verify_token is the token given when subscribing. Notifications must
+    be signed with app_secret, or one of old_app_secrets while rotating
+    it; the HMAC keys are set up once and signatures are compared in
+    constant time. Changes seen in the last dedupe_window seconds are
+    dropped, as Facebook delivers notifications again when it doesn't
+    get a response in time.
+
+    callback is called on a background thread with a list of
+    (change, object) tuples. With a graph, the changed objects are fetched
+    with get_objects() (passing args, like fields), collecting the
+    changes of up to batch_window seconds and max_batch distinct ids per
+    call; the object is a GraphAPIError for ids that couldn't be fetched,
+    and None for removed items. Without a graph it is always None.
+    Exceptions raised by callback are logged and counted in
+    stats["callback_errors"].
+    """
+
+    def __init__(self, app_secret, verify_token, callback=None, graph=None,
+                 old_app_secrets=(), dedupe_window=3600, dedupe_size=100000,
+                 batch_window=1.0, max_batch=IDS_CHUNK_SIZE,
+                 clock=time.time, **args):
+        secrets = [app_secret] + list(old_app_secrets)
+        secrets = [secret if isinstance(secret, bytes)
+                   else secret.encode("ascii") for secret in secrets]
+        self._macs = {
+            "sha256": [hmac.new(secret, digestmod=hashlib.sha256)
+                       for secret in secrets],
+            "sha1": [hmac.new(secret, digestmod=hashlib.sha1)
+                     for secret in secrets],
+        }
+        self.verify_token = verify_token
+        self.callback = callback
+        self.graph = graph
+        self.dedupe_window = dedupe_window
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.clock = clock
+        self.args = args
+        self.stats = {"notifications": 0, "changes": 0, "duplicates": 0,
+                      "invalid": 0, "fetches": 0, "callback_errors": 0}
+        self._seen = LRUCache(dedupe_size)
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def handle(self, method, query, headers, body):
+        """
+        Handles a request to the callback url, with its method, query
+        parameters (a dict of strings), headers and raw body. Returns the
+        status code and body of the response to send.
+        """
+        if method == "GET":
+            try:
+                return 200, self.challenge(query)
+            except ValueError as e:
+                return 403, str(e)
+        if method != "POST":
+            return 405, "Method not allowed"
+        try:
+            self.verify_signature(body, headers)
+        except ValueError as e:
+            self.stats["invalid"] += 1
+            return 403, str(e)
+        try:
+            payload = json.loads(body.decode("utf-8")
+                                 if isinstance(body, bytes) else body)
+        except ValueError:
+            self.stats["invalid"] += 1
+            return 400, "Invalid JSON"
+        self.receive(payload)
+        return 200, "OK"
+
+    def challenge(self, query):
+        """
+        Returns the hub.challenge of a subscription verification request.
+        Raises a ValueError if it isn't one, or has another verify token.
+        """
+        if query.get("hub.mode") != "subscribe":
+            raise ValueError("not a subscription request")
+        token = query.get("hub.verify_token") or ""
+        if not compare_digest(token.encode("utf-8"),
+                              self.verify_token.encode("utf-8")):
+            raise ValueError("verify token mismatch")
+        return query.get("hub.challenge", "")
+
+    def verify_signature(self, body, headers):
+        """
+        Checks the X-Hub-Signature-256, or else the X-Hub-Signature, header
+        of a notification. Raises a ValueError if it doesn't match.
+        """
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        signature = _header(headers, "X-Hub-Signature-256")
+        algorithm = "sha256"
+        if signature is None:
+            signature = _header(headers, "X-Hub-Signature")
+            algorithm = "sha1"
+        if not signature or "=" not in signature:
+            raise ValueError("missing signature")
+        prefix, digest = signature.split("=", 1)
+        if prefix != algorithm:
+            raise ValueError("unknown signature algorithm")
+        digest = digest.encode("ascii")
+        for mac in self._macs[algorithm]:
+            mac = mac.copy()
+            mac.update(body)
+            if compare_digest(mac.hexdigest().encode("ascii"), digest):
+                return
+        raise ValueError("signature mismatch")
+
+    def receive(self, payload):
+        """
+        Queues the changes of a verified, decoded notification that weren't
+        seen before. Returns the new changes.
+        """
+        now = self.clock()
+        changes = []
+        with self._lock:
+            self.stats["notifications"] += 1
+            for change in parse_changes(payload):
+                key = change.key()
+                seen = self._seen.get(key)
+                if seen is not None and seen > now - self.dedupe_window:
+                    self.stats["duplicates"] += 1
+                    continue
+                self._seen.set(key, now)
+                changes.append(change)
+            self.stats["changes"] += len(changes)
+        for change in changes:
+            self._queue.put(change)
+        if changes:
+            self._start()
+        return changes
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            change = self._queue.get()
+            if change is None:
+                return
+            self._process(self._collect(change))
+
+    def _collect(self, first):
+        """
+        Collects the queued changes of up to batch_window seconds, until
+        they are about max_batch distinct objects.
+        """
+        changes = [first]
+        ids = set([first.object_id])
+        deadline = time.time() + self.batch_window
+        while len(ids) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                change = self._queue.get(timeout=timeout)
+            except Empty:
+                break
+            if change is None:
+                # Stop after this batch.
+                self._queue.put(None)
+                break
+            changes.append(change)
+            ids.add(change.object_id)
+        return changes
+
+    def _process(self, changes):
+        objects = {}
+        ids = []
+        if self.graph is not None:
+            ids = list(set(change.object_id for change in changes
+                           if not change.removed))
+        if ids:
+            with self._lock:
+                self.stats["fetches"] += 1
+            try:
+                objects = self.graph.get_objects(
+                    ids, chunk_size=self.max_batch, raise_errors=False,
+                    **self.args)
+            except Exception as e:
+                objects = dict((id, e) for id in ids)
+        results = [(change, None if change.removed
+                    else objects.get(change.object_id))
+                   for change in changes]
+        if self.callback is not None:
+            try:
+                self.callback(results)
+            except Exception:
+                # The worker must keep going for the next notifications.
+                with self._lock:
+                    self.stats["callback_errors"] += 1
+                logger.exception("Webhook callback failed for %d changes",
+                                 len(results))
+
+    def flush(self):
+        """Processes the queued changes right away, on this thread."""
+        changes = []
+        while True:
+            try:
+                change = self._queue.get_nowait()
+            except Empty:
+                break
+            if change is None:
+                self._queue.put(None)
+                break
+            changes.append(change)
+        for start in range(0, len(changes), self.max_batch):
+            self._process(changes[start:start + self.max_batch])
+
+    def close(self):
+        """Processes what is queued and stops the background thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+        # Changes that were queued while stopping.
+        self.flush()
@@ -24,5 +24,11 @@ setup(
     ],
     install_requires=[
         'requests',
+        'futures; python_version < "3"',
     ],
+    extras_require={
+        'aio': ['aiohttp'],
+        'http2': ['httpx[http2]'],
+        'zstd': ['zstandard'],
+    },
 )
@@ -13,17 +13,192 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import base64
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import logging
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+import requests
+from requests.structures import CaseInsensitiveDict
+
 import facebook
+from facebook.cache import LRUCache, ResponseCache
+from facebook.coalesce import Coalescer, split_fields
+from facebook.export import Export
+from facebook.jsoncodec import LazyPage, StdlibCodec, get_codec
+from facebook.metrics import Histogram, MetricsCollector
+from facebook.objects import ColumnarPage, GraphObject, to_objects
+from facebook.ratelimit import RateLimiter, TokenBucket, parse_usage
+from facebook.retry import CircuitOpenError, RetryPolicy
+from facebook.signed_request import SignedRequestVerifier
+from facebook.sync import DeltaSync, parse_time
+from facebook.tokens import (AppSecretProof, CodeExchangeCache, MemoryBackend,
+                             SQLiteBackend, TokenManager, get_appsecret_proof)
+from facebook.transport import (HTTP2Transport, MemoryTransport, Response,
+                                TransportError)
+from facebook.upload import MultipartEncoder, ResumableUpload
+from facebook.webhooks import WebhookHandler, parse_changes
 
 try:
-    from urllib.parse import parse_qs, urlencode, urlparse
+    from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse
 except ImportError:
-    from urlparse import parse_qs, urlparse
+    from urlparse import parse_qs, parse_qsl, urlparse
     from urllib import urlencode
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    import asyncio
+    import facebook.aio
+except (ImportError, SyntaxError):
+    asyncio = None
+
+try:
+    import httpx
+    import h2  # noqa
+except ImportError:
+    httpx = h2 = None
+
+
+def make_response(body, status_code=200, headers=None, url=""):
+    """Build a requests Response as if it came from the Graph API."""
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = url
+    response.headers = CaseInsensitiveDict(
+        {"content-type": "application/json; charset=UTF-8"})
+    response.headers.update(headers or {})
+    if isinstance(body, bytes):
+        response._content = body
+    else:
+        response._content = json.dumps(body).encode("utf-8")
+    return response
+
+
+class FakeSession(object):
+    """
+    Stand-in for requests.Session that records calls and answers them with
+    the given responder, a callable taking (method, url, kwargs).
+    """
+    def __init__(self, responder=None):
+        self.calls = []
+        self.responder = responder or (lambda method, url, kwargs: {})
+        self.lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        with self.lock:
+            self.calls.append((method, url, kwargs))
+        result = self.responder(method, url, kwargs)
+        if isinstance(result, requests.Response):
+            return result
+        return make_response(result, url=url)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+
+IMAGE = bytes(bytearray(range(256))) * 1000
+
+
+class GraphRequestHandler(BaseHTTPRequestHandler):
+    """Local stand-in for graph.facebook.com, echoing what it was sent."""
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        path = url.path.split("/", 2)[-1]
+        if path.endswith("picture"):
+            self.send_image(query)
+            return
+        if "ids" in query:
+            body = dict((id, {"id": id}) for id in query["ids"].split(","))
+        elif path == "oauth/access_token":
+            body = {"access_token": "token-" + query.get("code", "app")}
+        else:
+            body = {"id": path, "query": query}
+        self.respond(body)
+
+    def do_POST(self):
+        length = int(self.headers["content-length"])
+        self.rfile.read(length)
+        self.respond({"id": "post", "length": length})
+
+    def send_image(self, query):
+        if query.get("access_token") != "token":
+            self.respond({"error": {"message": "No token", "code": 190}},
+                         status=400)
+            return
+        if self.server.failures:
+            self.server.failures -= 1
+            self.respond({"error": {"message": "Unavailable", "code": 2}},
+                         status=503)
+            return
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][6:-1])
+        if start >= len(IMAGE):
+            self.respond({"error": {"message": "Not satisfiable"}},
+                         status=416)
+            return
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(IMAGE) - start))
+        self.end_headers()
+        self.wfile.write(IMAGE[start:])
+
+    def respond(self, body, status=200):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalGraphServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler=GraphRequestHandler):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        # The number of downloads to fail before serving them.
+        self.failures = 0
+        self.url = "http://127.0.0.1:{0}/".format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_signed_request(data, secret):
+    """Sign data like Facebook does for the fbsr_ cookie."""
+    payload = base64.urlsafe_b64encode(
+        json.dumps(data).encode("utf-8")).rstrip(b"=")
+    sig = hmac.new(secret.encode("ascii"), payload, hashlib.sha256).digest()
+    return (base64.urlsafe_b64encode(sig).rstrip(b"=") + b"." +
+            payload).decode("ascii")
+
 
 class FacebookTestCase(unittest.TestCase):
     """Sets up application ID and secret from environment."""
@@ -152,5 +327,1842 @@ class TestAuthURL(FacebookTestCase):
         self.assertEqual(qs['redirect_uri'][0],
                          "http://localhost.dev/?test=1#blaat")
 
+
+class TestSession(unittest.TestCase):
+    """Test connection pooling through a shared requests Session."""
+    def test_default_session_is_shared(self):
+        self.assertIs(facebook.GraphAPI().session,
+                      facebook.GraphAPI("token").session)
+        self.assertIs(facebook.GraphAPI().session,
+                      facebook.get_default_session())
+
+    def test_make_session_pool_size(self):
+        session = facebook.make_session(pool_connections=2, pool_maxsize=20,
+                                        keep_alive=False)
+        adapter = session.get_adapter("https://graph.facebook.com/")
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertEqual(session.headers["Connection"], "close")
+
+    def test_requests_use_given_session(self):
+        session = FakeSession(lambda method, url, kwargs: {"id": "1"})
+        graph = facebook.GraphAPI("token", session=session)
+        self.assertEqual(graph.get_object("1"), {"id": "1"})
+        method, url, kwargs = session.calls[0]
+        self.assertEqual(method, "GET")
+        self.assertEqual(url, "https://graph.facebook.com/v2.2/1")
+        self.assertEqual(kwargs["params"]["access_token"], "token")
+
+    def test_auth_uses_given_session(self):
+        session = FakeSession(
+            lambda method, url, kwargs: {"access_token": "app|token"})
+        auth = facebook.Auth("app", "secret", "http://localhost/",
+                             session=session)
+        self.assertEqual(auth.get_app_access_token(offline=False),
+                         "app|token")
+        auth.get_access_token_from_code("code")
+        self.assertEqual(len(session.calls), 2)
+
+
+def batch_responder(method, url, kwargs):
+    """Answer batch calls with the relative_url of every operation."""
+    batch = json.loads(kwargs["data"]["batch"])
+    responses = []
+    for operation in batch:
+        if operation["relative_url"] == "error":
+            body = {"error": {"message": "Unsupported get request.",
+                              "code": 100}}
+            responses.append({"code": 400, "body": json.dumps(body)})
+        else:
+            body = {"url": operation["relative_url"]}
+            responses.append({"code": 200, "body": json.dumps(body)})
+    return responses
+
+
+class TestBatch(unittest.TestCase):
+    """Test sending operations through the batch endpoint."""
+    def test_batch_results_in_order(self):
+        session = FakeSession(batch_responder)
+        graph = facebook.GraphAPI("token", session=session)
+        operations = [{"method": "GET", "relative_url": str(i)}
+                      for i in range(120)]
+        results = graph.batch(operations)
+        self.assertEqual(len(session.calls), 3)
+        self.assertEqual([r["url"] for r in results],
+                         [str(i) for i in range(120)])
+        method, url, kwargs = session.calls[0]
+        self.assertEqual(method, "POST")
+        self.assertEqual(kwargs["data"]["access_token"], "token")
+        self.assertEqual(len(json.loads(kwargs["data"]["batch"])), 50)
+
+    def test_batch_keeps_dependencies_together(self):
+        session = FakeSession(batch_responder)
+        graph = facebook.GraphAPI("token", session=session)
+        operations = [{"method": "GET", "relative_url": str(i)}
+                      for i in range(49)]
+        operations.append({"method": "GET", "relative_url": "me/friends",
+                           "name": "friends"})
+        operations.append({"method": "GET", "depends_on": "friends",
+                           "relative_url": "?ids={result=friends:$.data.*.id}"})
+        results = graph.batch(operations)
+        self.assertEqual(len(session.calls), 2)
+        second = json.loads(session.calls[1][2]["data"]["batch"])
+        self.assertEqual([op.get("name") for op in second], ["friends", None])
+        self.assertEqual(results[-1]["url"], operations[-1]["relative_url"])
+
+    def test_batch_errors_per_operation(self):
+        graph = facebook.GraphAPI("token", session=FakeSession(batch_responder))
+        results = graph.batch([
+            {"method": "GET", "relative_url": "me"},
+            {"method": "GET", "relative_url": "error"},
+            {"method": "POST", "relative_url": "me/feed",
+             "body": {"message": "Hello"}},
+        ])
+        self.assertEqual(results[0], {"url": "me"})
+        self.assertIsInstance(results[1], facebook.GraphAPIError)
+        self.assertEqual(results[1].message, "Unsupported get request.")
+        self.assertEqual(results[2], {"url": "me/feed"})
+
+    def test_batch_unknown_reference(self):
+        graph = facebook.GraphAPI("token", session=FakeSession(batch_responder))
+        self.assertRaises(facebook.GraphAPIError, graph.batch,
+                          [{"method": "GET", "relative_url": "me",
+                            "depends_on": "missing"}])
+
+
+def objects_responder(method, url, kwargs):
+    """Answer object requests, failing for the id "invalid"."""
+    params = kwargs["params"]
+    ids = params["ids"].split(",") if "ids" in params else [url.split("/")[-1]]
+    if "invalid" in ids:
+        error = {"error": {"message": "invalid id", "code": 100}}
+        return make_response(error, status_code=400)
+    objects = dict((id, {"id": id, "fields": params.get("fields")})
+                   for id in ids)
+    return objects if "ids" in params else objects[ids[0]]
+
+
+class TestGetObjects(unittest.TestCase):
+    """Test chunked, concurrent fetching of multiple objects."""
+    def test_get_objects_chunks(self):
+        session = FakeSession(objects_responder)
+        graph = facebook.GraphAPI("token", session=session)
+        ids = [str(i) for i in range(120)]
+        result = graph.get_objects(ids, chunk_size=50, fields="name")
+        self.assertEqual(len(session.calls), 3)
+        self.assertEqual(sorted(result), sorted(ids))
+        self.assertEqual(result["7"], {"id": "7", "fields": "name"})
+        for method, url, kwargs in session.calls:
+            self.assertTrue(len(kwargs["params"]["ids"].split(",")) <= 50)
+
+    def test_get_objects_raises(self):
+        graph = facebook.GraphAPI("token",
+                                  session=FakeSession(objects_responder))
+        self.assertRaises(facebook.GraphAPIError, graph.get_objects,
+                          ["1", "invalid", "2"])
+
+    def test_get_objects_per_id_errors(self):
+        session = FakeSession(objects_responder)
+        graph = facebook.GraphAPI("token", session=session)
+        ids = [str(i) for i in range(10)] + ["invalid"]
+        result = graph.get_objects(ids, chunk_size=5, raise_errors=False)
+        self.assertEqual(result["1"]["id"], "1")
+        self.assertIsInstance(result["invalid"], facebook.GraphAPIError)
+        # Only the failing chunk is retried per id.
+        self.assertEqual(len(session.calls), 3 + 1)
+
+
+class TestFanOut(unittest.TestCase):
+    """Test running many calls on the GraphAPI thread pool."""
+    def setUp(self):
+        self.in_flight = 0
+        self.max_seen = 0
+        self.lock = threading.Lock()
+
+    def slow_responder(self, method, url, kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.max_seen = max(self.max_seen, self.in_flight)
+        path = url.split("/v2.2/")[-1]
+        time.sleep(0.01 if path != "0" else 0.05)
+        with self.lock:
+            self.in_flight -= 1
+        if path == "error":
+            return make_response({"error": {"message": "failed"}}, 400)
+        return {"id": path, "method": method}
+
+    def test_fan_out_ordered(self):
+        graph = facebook.GraphAPI(
+            "token", session=FakeSession(self.slow_responder), max_workers=3)
+        calls = [("GET", str(i), {}) for i in range(10)]
+        calls.append(("POST", "me/feed", {"message": "Hello"}))
+        results = list(graph.fan_out(calls))
+        self.assertEqual([r["id"] for r in results],
+                         [str(i) for i in range(10)] + ["me/feed"])
+        self.assertEqual(results[-1]["method"], "POST")
+        self.assertTrue(1 < self.max_seen <= 3)
+
+    def test_fan_out_unordered(self):
+        graph = facebook.GraphAPI(
+            "token", session=FakeSession(self.slow_responder), max_workers=4)
+        results = list(graph.fan_out_objects([str(i) for i in range(6)],
+                                             ordered=False))
+        self.assertEqual(sorted(index for index, result in results),
+                         list(range(6)))
+        # The slow first call completes after the others.
+        self.assertNotEqual(results[0][0], 0)
+        for index, result in results:
+            self.assertEqual(result["id"], str(index))
+
+    def test_fan_out_errors(self):
+        graph = facebook.GraphAPI(
+            "token", session=FakeSession(self.slow_responder))
+        self.assertRaises(facebook.GraphAPIError, list,
+                          graph.fan_out_objects(["1", "error"]))
+        results = list(graph.fan_out_objects(["1", "error"],
+                                             return_exceptions=True))
+        self.assertIsInstance(results[1], facebook.GraphAPIError)
+
+    def test_fan_out_shared_executor(self):
+        session = FakeSession(self.slow_responder)
+        first = facebook.GraphAPI("a", session=session, max_workers=2)
+        second = facebook.GraphAPI("b", session=session,
+                                   executor=first.executor)
+        self.assertIs(first.executor, second.executor)
+        calls = list(second.fan_out_connections(["1", "2"], "feed"))
+        self.assertEqual([r["id"] for r in calls], ["1/feed", "2/feed"])
+
+    def test_nested_fan_out(self):
+        session = FakeSession(objects_responder)
+        graph = facebook.GraphAPI("token", session=session, max_workers=1)
+
+        def nested(method, url, kwargs):
+            return {"objects": graph.get_objects(
+                [str(i) for i in range(10)], chunk_size=2)}
+        outer = facebook.GraphAPI("token", session=FakeSession(nested),
+                                  executor=graph.executor)
+        results = list(outer.fan_out_objects(["1", "2"]))
+        self.assertEqual(len(results[0]["objects"]), 10)
+
+
+def paged_responder(pages, page_size=3):
+    """Answer connection requests with pages linked by paging.next."""
+    def responder(method, url, kwargs):
+        page = int((kwargs.get("params") or {}).get("page", 0))
+        if "?page=" in url:
+            page = int(url.split("?page=")[1])
+        data = [{"id": str(page * page_size + i)} for i in range(page_size)]
+        result = {"data": data if page < pages else []}
+        if page < pages:
+            result["paging"] = {
+                "next": "https://graph.facebook.com/v2.2/feed?page={0}".format(
+                    page + 1)}
+        return result
+    return responder
+
+
+class TestIterConnections(unittest.TestCase):
+    """Test iterating over paged connections."""
+    def test_iter_connections(self):
+        for prefetch in (0, 1, 3):
+            session = FakeSession(paged_responder(4))
+            graph = facebook.GraphAPI("token", session=session)
+            items = list(graph.iter_connections("me", "feed",
+                                                prefetch=prefetch))
+            self.assertEqual([item["id"] for item in items],
+                             [str(i) for i in range(12)])
+            self.assertEqual(len(session.calls), 5)
+            self.assertEqual(session.calls[0][1],
+                             "https://graph.facebook.com/v2.2/me/feed")
+
+    def test_prefetch_is_bounded(self):
+        session = FakeSession(paged_responder(10))
+        graph = facebook.GraphAPI("token", session=session)
+        items = graph.iter_connections("me", "feed", prefetch=2)
+        next(items)
+        time.sleep(0.3)
+        # The current page and two pages ahead.
+        self.assertEqual(len(session.calls), 3)
+        items.close()
+        time.sleep(0.3)
+        self.assertEqual(len(session.calls), 3)
+
+    def test_errors_are_raised(self):
+        def responder(method, url, kwargs):
+            if "?page=" in url:
+                return make_response({"error": {"message": "failed"}}, 500)
+            return paged_responder(2)(method, url, kwargs)
+        graph = facebook.GraphAPI("token", session=FakeSession(responder))
+        items = graph.iter_connections("me", "feed")
+        self.assertEqual(len([next(items) for _ in range(3)]), 3)
+        self.assertRaises(facebook.GraphAPIError, next, items)
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test caching of GET responses."""
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = ResponseCache(ttl=60, ttls={"*/feed": 0},
+                                   clock=lambda: self.now)
+        self.session = FakeSession(self.responder)
+
+    def responder(self, method, url, kwargs):
+        if (kwargs.get("headers") or {}).get("If-None-Match") == '"v1"':
+            return make_response(b"", status_code=304)
+        return make_response({"url": url, "params": kwargs["params"]},
+                             headers={"ETag": '"v1"'})
+
+    def test_fresh_responses_from_memory(self):
+        graph = facebook.GraphAPI("token", session=self.session,
+                                  cache=self.cache)
+        first = graph.get_object("me", fields="id,name")
+        self.assertEqual(graph.get_object("me", fields="id,name"), first)
+        self.assertEqual(len(self.session.calls), 1)
+        graph.get_object("me", fields="id")
+        graph.put_object("me", "feed", message="Hello")
+        self.assertEqual(len(self.session.calls), 3)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_revalidation(self):
+        graph = facebook.GraphAPI("token", session=self.session,
+                                  cache=self.cache)
+        first = graph.get_object("me")
+        self.now += 61
+        self.assertEqual(graph.get_object("me"), first)
+        self.assertEqual(len(self.session.calls), 2)
+        self.assertEqual(self.session.calls[1][2]["headers"],
+                         {"If-None-Match": '"v1"'})
+        self.assertEqual(self.cache.stats()["revalidations"], 1)
+        # Fresh again after revalidating.
+        graph.get_object("me")
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_per_path_ttl(self):
+        graph = facebook.GraphAPI("token", session=self.session,
+                                  cache=self.cache)
+        graph.get_connections("me", "feed")
+        graph.get_connections("me", "feed")
+        self.assertEqual(len(self.session.calls), 2)
+        self.assertEqual(self.session.calls[1][2]["headers"],
+                         {"If-None-Match": '"v1"'})
+
+    def test_scoped_by_token(self):
+        first = facebook.GraphAPI("first", session=self.session,
+                                  cache=self.cache)
+        second = facebook.GraphAPI("second", session=self.session,
+                                   cache=self.cache)
+        self.assertEqual(first.get_object("me")["params"]["access_token"],
+                         "first")
+        self.assertEqual(second.get_object("me")["params"]["access_token"],
+                         "second")
+        for key in self.cache._entries._data:
+            self.assertNotIn("first", str(key))
+
+    def test_lru_eviction(self):
+        lru = LRUCache(maxsize=3, max_bytes=10)
+        for key in "abc":
+            lru.set(key, key, size=3)
+        lru.get("a")
+        lru.set("d", "d", size=3)
+        self.assertEqual(sorted(lru._data), ["a", "c", "d"])
+        lru.set("e", "e", size=7)
+        self.assertEqual(sorted(lru._data), ["d", "e"])
+        self.assertEqual((lru.size, lru.evictions), (10, 3))
+
+
+class FakeClock(object):
+    """A clock that only advances when sleeping."""
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test scheduling requests based on the usage headers."""
+    def test_parse_usage(self):
+        headers = CaseInsensitiveDict({
+            "X-App-Usage": json.dumps({"call_count": 12, "total_time": 40,
+                                       "total_cputime": 3}),
+            "X-Business-Use-Case-Usage": json.dumps({"1234": [
+                {"type": "pages", "call_count": 80, "total_cputime": 10,
+                 "total_time": 2, "estimated_time_to_regain_access": 0}]}),
+        })
+        self.assertEqual(parse_usage(headers), {
+            "app": 40, "business": 80, "regain_seconds": 0})
+        self.assertEqual(parse_usage(CaseInsensitiveDict()), {})
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=5, clock=clock,
+                             sleep=clock.sleep)
+        for _ in range(5):
+            self.assertEqual(bucket.acquire(), 0)
+        bucket.acquire()
+        self.assertAlmostEqual(clock.slept, 0.1)
+        bucket.pause(30)
+        bucket.acquire()
+        self.assertAlmostEqual(clock.slept, 30.2)
+
+    def test_rate_for(self):
+        limiter = RateLimiter(rate=100, slowdown_at=50, stop_at=90,
+                              min_rate=1)
+        self.assertEqual(limiter.rate_for(10), 100)
+        self.assertEqual(limiter.rate_for(70), 50)
+        self.assertEqual(limiter.rate_for(95), 1)
+
+    def test_graph_slows_down(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=100, burst=1, clock=clock,
+                              sleep=clock.sleep)
+        usage = {"x-app-usage": json.dumps({"call_count": 10})}
+        session = FakeSession(
+            lambda method, url, kwargs: make_response({}, headers=usage))
+        graph = facebook.GraphAPI("token", session=session,
+                                  rate_limiter=limiter)
+        for _ in range(11):
+            graph.get_object("me")
+        self.assertAlmostEqual(clock.slept, 0.1)
+        self.assertEqual(graph.usage, {"app": 10})
+
+        usage["x-app-usage"] = json.dumps({"call_count": 99})
+        graph.get_object("me")
+        clock.slept = 0
+        graph.get_object("me")
+        self.assertAlmostEqual(clock.slept, 1 / limiter.min_rate)
+
+    def test_page_usage_per_token(self):
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+        limiter.observe({"x-page-usage": json.dumps({"call_count": 50})},
+                        "page-token")
+        self.assertEqual(limiter.usage("page-token"), {"page": 50})
+        self.assertEqual(limiter.usage("other-token"), {})
+        limiter.observe({"x-business-use-case-usage": json.dumps({"1": [
+            {"call_count": 100, "estimated_time_to_regain_access": 2}]})},
+            "page-token")
+        limiter.acquire("other-token")
+        self.assertEqual(clock.slept, 0)
+        limiter.acquire("page-token")
+        self.assertTrue(clock.slept >= 120)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """Test retrying transient errors."""
+    def setUp(self):
+        self.clock = FakeClock()
+        self.failures = []
+
+    def responder(self, method, url, kwargs):
+        if self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, Exception):
+                raise failure
+            return failure
+        return {"id": "1"}
+
+    def make_graph(self, **kwargs):
+        kwargs.setdefault("breaker_threshold", None)
+        policy = RetryPolicy(clock=self.clock, sleep=self.clock.sleep,
+                             random=lambda: 1.0, **kwargs)
+        self.session = FakeSession(self.responder)
+        return facebook.GraphAPI("token", session=self.session,
+                                 retry_policy=policy)
+
+    def test_path_template(self):
+        self.assertEqual(facebook.path_template(
+            "https://graph.facebook.com/v2.2/1234_5678/comments?limit=5"),
+            "{id}/comments")
+        self.assertEqual(facebook.path_template(
+            "https://graph.facebook.com/v2.2/me/feed"), "me/feed")
+
+    def test_retries_transient_errors(self):
+        graph = self.make_graph()
+        self.failures = [
+            make_response({"error": {"message": "Throttled", "code": 4}}, 400),
+            make_response(b"<html>", 502, {"content-type": "text/html"}),
+            requests.ConnectionError("reset"),
+        ]
+        self.assertEqual(graph.get_object("1"), {"id": "1"})
+        self.assertEqual(len(self.session.calls), 4)
+        self.assertEqual(self.clock.slept, 0.5 + 1 + 2)
+
+    def test_fatal_errors_are_not_retried(self):
+        graph = self.make_graph()
+        self.failures = [make_response(
+            {"error": {"message": "Invalid", "code": 100}}, 400)]
+        self.assertRaises(facebook.GraphAPIError, graph.get_object, "1")
+        self.assertEqual(len(self.session.calls), 1)
+
+    def test_posts_are_not_retried(self):
+        graph = self.make_graph()
+        self.failures = [requests.Timeout("timeout")]
+        self.assertRaises(requests.Timeout, graph.put_object, "me", "feed",
+                          message="Hello")
+
+    def test_attempts_and_budget(self):
+        graph = self.make_graph(max_attempts=3)
+        self.failures = [requests.Timeout("timeout")] * 5
+        self.assertRaises(requests.Timeout, graph.get_object, "1")
+        self.assertEqual(len(self.session.calls), 3)
+
+        graph = self.make_graph(budget=1)
+        self.failures = [requests.Timeout("timeout")] * 5
+        self.assertRaises(requests.Timeout, graph.get_object, "1")
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_circuit_breaker(self):
+        graph = self.make_graph(max_attempts=1, breaker_threshold=2,
+                                breaker_timeout=10)
+        self.failures = [requests.ConnectionError("down")] * 2
+        for _ in range(2):
+            self.assertRaises(requests.ConnectionError, graph.get_object, "1")
+        self.assertRaises(CircuitOpenError, graph.get_object, "2")
+        # Other endpoints are unaffected.
+        self.assertEqual(graph.get_connections("1", "feed"), {"id": "1"})
+        self.assertEqual(len(self.session.calls), 3)
+        self.clock.now += 10
+        self.assertEqual(graph.get_object("1"), {"id": "1"})
+        self.assertEqual(graph.get_object("1"), {"id": "1"})
+
+
+class VideoServer(object):
+    """Responder following the chunked video upload protocol."""
+    def __init__(self, file_size, chunk_size, fail_at=None):
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.fail_at = fail_at
+        self.received = {}
+        self.lock = threading.Lock()
+
+    def offsets(self, start):
+        return {"start_offset": str(start),
+                "end_offset": str(min(start + self.chunk_size,
+                                      self.file_size))}
+
+    def __call__(self, method, url, kwargs):
+        data = kwargs["data"]
+        if isinstance(data, dict):
+            if data["upload_phase"] == "start":
+                return dict(self.offsets(0), upload_session_id="1",
+                            video_id="2")
+            return {"success": True, "title": data.get("title")}
+        body = data.read()
+        start = int(body.split(b'name="start_offset"\r\n\r\n')[1]
+                    .split(b"\r\n")[0])
+        if start == self.fail_at:
+            self.fail_at = None
+            raise requests.ConnectionError("reset")
+        chunk = body.split(b"application/octet-stream\r\n\r\n")[1]
+        chunk = chunk.rsplit(b"\r\n--", 1)[0]
+        with self.lock:
+            self.received[start] = chunk
+        return self.offsets(start + len(chunk))
+
+
+class TestUploads(unittest.TestCase):
+    """Test streaming multipart and resumable uploads."""
+    def setUp(self):
+        self.video = tempfile.NamedTemporaryFile()
+        self.content = os.urandom(1000)
+        self.video.write(self.content)
+        self.video.flush()
+
+    def tearDown(self):
+        self.video.close()
+
+    def test_multipart_encoder(self):
+        image = io.BytesIO(b"x" * 100000)
+        image.name = "/tmp/image.jpg"
+        encoder = MultipartEncoder({"message": u"H\xe9llo"},
+                                   {"source": image}, boundary="b")
+        body = b"".join(iter(lambda: encoder.read(1000), b""))
+        self.assertEqual(len(body), len(encoder))
+        self.assertTrue(body.startswith(
+            b'--b\r\nContent-Disposition: form-data; name="message"\r\n\r\n'
+            b'H\xc3\xa9llo\r\n--b\r\nContent-Disposition: form-data; '
+            b'name="source"; filename="image.jpg"\r\n'
+            b'Content-Type: application/octet-stream\r\n\r\nxxx'))
+        self.assertTrue(body.endswith(b"xxx\r\n--b--\r\n"))
+
+    def test_put_photo_streams(self):
+        session = FakeSession(lambda method, url, kwargs: {"id": "1"})
+        graph = facebook.GraphAPI("token", session=session)
+        graph.put_photo(io.BytesIO(b"image"), message="Hello")
+        method, url, kwargs = session.calls[0]
+        self.assertIsInstance(kwargs["data"], MultipartEncoder)
+        self.assertEqual(kwargs["headers"]["Content-Type"],
+                         kwargs["data"].content_type)
+        body = kwargs["data"].read()
+        self.assertIn(b'name="access_token"\r\n\r\ntoken', body)
+        self.assertIn(b"\r\n\r\nimage\r\n", body)
+
+    def test_resumable_upload(self):
+        server = VideoServer(1000, 300, fail_at=600)
+        graph = facebook.GraphAPI("token", session=FakeSession(server))
+        progress = []
+        upload = ResumableUpload(graph, "me/videos", self.video.name,
+                                 progress=lambda *args: progress.append(args))
+        self.assertRaises(requests.ConnectionError, upload.upload)
+        self.assertEqual(upload.start_offset, 600)
+        result = upload.upload(title="Movie")
+        self.assertEqual(result, {"success": True, "title": "Movie"})
+        self.assertEqual(b"".join(server.received[start] for start in
+                                  sorted(server.received)), self.content)
+        self.assertEqual(progress, [(300, 1000), (600, 1000), (900, 1000),
+                                    (1000, 1000)])
+        self.assertTrue(upload._file.closed)
+
+    def test_upload_closes_file(self):
+        server = VideoServer(1000, 300, fail_at=300)
+        graph = facebook.GraphAPI("token", session=FakeSession(server))
+        with ResumableUpload(graph, "me/videos", self.video.name) as upload:
+            self.assertRaises(requests.ConnectionError, upload.upload)
+        self.assertTrue(upload._file.closed)
+        # File objects are left open.
+        with ResumableUpload(graph, "me/videos", self.video) as upload:
+            pass
+        self.assertFalse(self.video.closed)
+
+    def test_parallel_upload(self):
+        server = VideoServer(1000, 300)
+        graph = facebook.GraphAPI("token", session=FakeSession(server))
+        upload = ResumableUpload(graph, "me/videos", self.video,
+                                 chunk_size=128, workers=3)
+        upload.upload()
+        self.assertEqual(sorted(server.received), list(range(0, 1000, 128)))
+        self.assertEqual(b"".join(server.received[start] for start in
+                                  sorted(server.received)), self.content)
+        self.assertEqual(upload.start_offset, 1000)
+
+
+class TestDownloads(unittest.TestCase):
+    """Test streaming binary downloads from a local stand-in server."""
+    def setUp(self):
+        self.server = LocalGraphServer()
+        self.graph = facebook.GraphAPI("token", graph_url=self.server.url,
+                                       session=facebook.make_session())
+        self.dest = tempfile.NamedTemporaryFile(delete=False)
+        self.dest.close()
+
+    def tearDown(self):
+        os.unlink(self.dest.name)
+        self.server.stop()
+
+    def test_iter_download(self):
+        chunks = list(self.graph.iter_download("me/picture", chunk_size=1000))
+        self.assertEqual(max(len(chunk) for chunk in chunks), 1000)
+        self.assertEqual(b"".join(chunks), IMAGE)
+        chunks = self.graph.iter_download(self.server.url + "v2.2/me/picture"
+                                          "?access_token=token", offset=10)
+        self.assertEqual(b"".join(chunks), IMAGE[10:])
+
+    def test_download_to_file(self):
+        written = self.graph.download("me/picture", self.dest.name,
+                                      chunk_size=4096)
+        self.assertEqual(written, len(IMAGE))
+        with open(self.dest.name, "rb") as f:
+            self.assertEqual(f.read(), IMAGE)
+        f = io.BytesIO()
+        self.graph.download("me/picture", f)
+        self.assertEqual(f.getvalue(), IMAGE)
+
+    def test_resume_download(self):
+        with open(self.dest.name, "wb") as f:
+            f.write(IMAGE[:1234])
+        written = self.graph.download("me/picture", self.dest.name,
+                                      resume=True)
+        self.assertEqual(written, len(IMAGE) - 1234)
+        with open(self.dest.name, "rb") as f:
+            self.assertEqual(f.read(), IMAGE)
+        # Complete already, so the range can't be satisfied.
+        self.assertEqual(self.graph.download("me/picture", self.dest.name,
+                                             resume=True), 0)
+        with open(self.dest.name, "rb") as f:
+            self.assertEqual(f.read(), IMAGE)
+        self.assertEqual(list(self.graph.iter_download(
+            "me/picture", offset=len(IMAGE))), [])
+
+    def test_download_error(self):
+        graph = facebook.GraphAPI(graph_url=self.server.url)
+        self.assertRaises(facebook.GraphAPIError, graph.download,
+                          "me/picture", self.dest.name)
+        self.server.failures = 1
+        with self.assertRaises(facebook.GraphAPIError) as cm:
+            list(self.graph.iter_download("me/picture"))
+        self.assertEqual(cm.exception.status_code, 503)
+        with open(self.dest.name, "wb") as f:
+            f.write(IMAGE[:10])
+        self.server.failures = 1
+        self.assertRaises(facebook.GraphAPIError, self.graph.download,
+                          "me/picture", self.dest.name, resume=True)
+        with open(self.dest.name, "rb") as f:
+            self.assertEqual(f.read(), IMAGE[:10])
+
+    def test_download_retry(self):
+        events = []
+        graph = facebook.GraphAPI(
+            "token", graph_url=self.server.url,
+            retry_policy=RetryPolicy(backoff=0), observers=[events.append])
+        self.server.failures = 2
+        self.assertEqual(graph.download("me/picture", self.dest.name),
+                         len(IMAGE))
+        self.assertEqual((events[0].attempts, events[0].status_code),
+                         (3, 200))
+
+
+class TestJSONCodecs(unittest.TestCase):
+    """Test pluggable JSON codecs and lazily decoded pages."""
+    def test_get_codec(self):
+        self.assertEqual(get_codec("json").name, "json")
+        self.assertIs(get_codec(), get_codec())
+        codec = StdlibCodec()
+        self.assertIs(get_codec(codec), codec)
+        self.assertRaises(KeyError, get_codec, "unknown")
+
+    def test_codecs_roundtrip(self):
+        value = {"data": [{"id": "1", "message": u"H\xe9llo"}], "n": 1.5}
+        for name in ("json", "orjson", "ujson"):
+            try:
+                codec = get_codec(name)
+            except ImportError:
+                continue
+            self.assertEqual(codec.loads(codec.dumps(value).encode("utf-8")),
+                             value)
+
+    def test_graph_uses_codec(self):
+        class Codec(StdlibCodec):
+            calls = 0
+
+            def loads(self, content):
+                Codec.calls += 1
+                return StdlibCodec.loads(self, content)
+        session = FakeSession(lambda method, url, kwargs: {"id": "1"})
+        graph = facebook.GraphAPI(session=session, json_codec=Codec())
+        graph.get_object("1")
+        self.assertEqual(Codec.calls, 1)
+
+    def test_lazy_page(self):
+        page = LazyPage(b'{"data": [{"id": "1"}, null, [2]],'
+                        b' "paging": {"next": "url"}}')
+        items = page.iter_data()
+        self.assertEqual(next(items), {"id": "1"})
+        self.assertEqual(page["paging"], {"next": "url"})
+        self.assertEqual(list(items), [None, [2]])
+        self.assertTrue(page.has_data())
+        self.assertEqual(page.get("missing"), None)
+        self.assertFalse(LazyPage(b'{"data": [ ]}').has_data())
+        self.assertEqual(LazyPage(b'{"paging": {}, "data": []}')["data"], [])
+
+    def test_lazy_page_decodes_items_once(self):
+        items = [{"id": str(i), "message": "[{\"]}", "tags": [[i], {}]}
+                 for i in range(100)]
+        content = json.dumps({"data": items,
+                              "paging": {"next": "url"}}).encode("utf-8")
+        graph = facebook.GraphAPI(
+            session=FakeSession(lambda method, url, kwargs: make_response(
+                content)), lazy_pages=True)
+        decoded = []
+        raw_decode = json.JSONDecoder.raw_decode
+
+        def counting(decoder, text, index=0):
+            decoded.append(index)
+            return raw_decode(decoder, text, index)
+        json.JSONDecoder.raw_decode = counting
+        try:
+            page = graph.get_connections("me", "feed")
+            self.assertEqual(page.get("paging"), {"next": "url"})
+            # The keys of the page, but none of the items.
+            self.assertEqual(len(decoded), 3)
+            self.assertEqual(list(page.iter_data()), items)
+        finally:
+            json.JSONDecoder.raw_decode = raw_decode
+        self.assertEqual(len(decoded), 3 + len(items))
+
+    def test_lazy_pages(self):
+        session = FakeSession(paged_responder(3))
+        graph = facebook.GraphAPI("token", session=session, lazy_pages=True)
+        page = graph.get_connections("me", "feed")
+        self.assertIsInstance(page, LazyPage)
+        self.assertEqual([item["id"] for item in page.iter_data()],
+                         ["0", "1", "2"])
+        items = list(graph.iter_connections("me", "feed"))
+        self.assertEqual(len(items), 9)
+
+    def test_lazy_error(self):
+        error = make_response({"error": {"message": "failed"}}, 400)
+        graph = facebook.GraphAPI(
+            session=FakeSession(lambda method, url, kwargs: error),
+            lazy_pages=True)
+        self.assertRaises(facebook.GraphAPIError, graph.get_connections,
+                          "me", "feed")
+
+
+class TestSignedRequest(unittest.TestCase):
+    """Test verifying signed requests."""
+    def setUp(self):
+        self.now = 1000000.0
+        self.data = {"algorithm": "HMAC-SHA256", "code": "code",
+                     "issued_at": int(self.now), "user_id": "1"}
+
+    def test_parse_signed_request(self):
+        auth = facebook.Auth("app", "secret", "http://localhost/")
+        signed_request = make_signed_request(self.data, "secret")
+        self.assertEqual(auth.parse_signed_request(signed_request), self.data)
+        # Parsing twice used to fail because the secret was mutated.
+        self.assertEqual(auth.parse_signed_request(signed_request), self.data)
+
+    def test_invalid_signed_requests(self):
+        verifier = SignedRequestVerifier("secret", cache_size=0)
+        signed_request = make_signed_request(self.data, "secret")
+        sig, payload = signed_request.split(".")
+        cases = [
+            ("nodot", "malformed"),
+            (make_signed_request(self.data, "other"), "signature mismatch"),
+            (sig + "." + payload[:-2], "signature mismatch"),
+            (make_signed_request(dict(self.data, algorithm="HMAC-MD5"),
+                                 "secret"), "unknown algorithm"),
+        ]
+        for signed_request, message in cases:
+            try:
+                verifier.verify(signed_request)
+            except ValueError as e:
+                self.assertIn(message, str(e))
+            else:
+                self.fail("{0} was accepted".format(signed_request))
+
+    def test_rotated_secrets(self):
+        auth = facebook.Auth("app", "new", "http://localhost/",
+                             old_app_secrets=["old"])
+        self.assertEqual(auth.parse_signed_request(
+            make_signed_request(self.data, "old"))["user_id"], "1")
+        self.assertRaises(ValueError, auth.parse_signed_request,
+                          make_signed_request(self.data, "other"))
+
+    def test_cache(self):
+        verifier = SignedRequestVerifier("secret", max_age=60,
+                                         clock=lambda: self.now)
+        signed_request = make_signed_request(self.data, "secret")
+        data = verifier.verify(signed_request)
+        data["access_token"] = "changed"
+        self.assertIn(signed_request, verifier.cache)
+        self.assertEqual(verifier.verify(signed_request), self.data)
+        self.now += 61
+        self.assertEqual(verifier.verify(signed_request), self.data)
+        self.assertNotIn(signed_request, verifier.cache)
+
+    def test_verify_many(self):
+        verifier = SignedRequestVerifier("secret")
+        results = verifier.verify_many([
+            make_signed_request(self.data, "secret"), "invalid"])
+        self.assertEqual(results[0], self.data)
+        self.assertIsInstance(results[1], ValueError)
+
+
+class TestCodeExchangeCache(unittest.TestCase):
+    """Test caching the exchange of the code in the fbsr_ cookie."""
+    def setUp(self):
+        self.now = 1000000.0
+        self.data = {"algorithm": "HMAC-SHA256", "code": "code",
+                     "issued_at": int(self.now), "user_id": "1"}
+        self.cookies = {"fbsr_app": make_signed_request(self.data, "secret")}
+        self.exchanges = []
+
+    def exchange(self, method, url, kwargs):
+        self.exchanges.append(kwargs["params"]["code"])
+        time.sleep(0.05)
+        return {"access_token": "token", "expires": "5184000"}
+
+    def make_auth(self, backend=None):
+        cache = CodeExchangeCache(backend, clock=lambda: self.now)
+        return facebook.Auth("app", "secret", "http://localhost/",
+                             session=FakeSession(self.exchange),
+                             exchange_cache=cache)
+
+    def test_get_user_from_cookie(self):
+        auth = facebook.Auth("app", "secret", "http://localhost/")
+        self.assertEqual(auth.get_user_from_cookie(self.cookies), self.data)
+        self.assertEqual(auth.get_user_from_cookie({}), None)
+
+    def test_cached_exchange(self):
+        auth = self.make_auth()
+        for _ in range(3):
+            user = auth.get_user_from_cookie(self.cookies, validate=True)
+            self.assertEqual(user["access_token"], "token")
+            self.assertEqual(user["user_id"], "1")
+        self.assertEqual(self.exchanges, ["code"])
+        self.now += 5184000
+        auth.get_user_from_cookie(self.cookies, validate=True)
+        self.assertEqual(self.exchanges, ["code", "code"])
+
+    def test_concurrent_exchanges(self):
+        auth = self.make_auth()
+        users = []
+        threads = [threading.Thread(target=lambda: users.append(
+            auth.get_user_from_cookie(self.cookies, validate=True)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(users), 5)
+        self.assertEqual(self.exchanges, ["code"])
+
+    def test_sqlite_backend(self):
+        with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+            self.make_auth(SQLiteBackend(f.name)).get_user_from_cookie(
+                self.cookies, validate=True)
+            # Another process sharing the database.
+            user = self.make_auth(SQLiteBackend(f.name)).get_user_from_cookie(
+                self.cookies, validate=True)
+        self.assertEqual(user["access_token"], "token")
+        self.assertEqual(self.exchanges, ["code"])
+
+    def test_expiry(self):
+        backend = MemoryBackend()
+        cache = CodeExchangeCache(backend, default_ttl=100, margin=10,
+                                  clock=lambda: self.now)
+        cache.set("code", {"access_token": "token"})
+        self.assertEqual(cache.get("code"), {"access_token": "token"})
+        self.now += 90
+        self.assertEqual(cache.get("code"), None)
+
+
+class TestTokenManager(unittest.TestCase):
+    """Test keeping and refreshing access tokens."""
+    def setUp(self):
+        self.now = 1000000.0
+        self.extended = []
+        self.session = FakeSession(self.extend)
+        self.auth = facebook.Auth("app", "secret", "http://localhost/",
+                                  session=self.session)
+        self.tokens = TokenManager(self.auth, refresh_margin=100,
+                                   clock=lambda: self.now)
+
+    def extend(self, method, url, kwargs):
+        token = kwargs["params"]["fb_exchange_token"]
+        self.extended.append(token)
+        return {"access_token": token + "+", "expires_in": 1000}
+
+    def test_app_token(self):
+        self.assertEqual(self.auth.get_app_access_token(), "app|secret")
+        graph = self.auth.tokens.graph()
+        self.assertEqual(graph.access_token, "app|secret")
+        self.assertEqual(self.session.calls, [])
+
+    def test_extend_access_token(self):
+        result = self.auth.extend_access_token("short")
+        self.assertEqual(result["access_token"], "short+")
+        params = self.session.calls[0][2]["params"]
+        self.assertEqual(params["client_id"], "app")
+        self.assertEqual(params["grant_type"], "fb_exchange_token")
+
+    def test_get(self):
+        self.tokens.add("page", "token", expires_in=1000)
+        self.tokens.add("forever", "other")
+        self.assertEqual(self.tokens.get("page"), "token")
+        self.assertEqual(self.tokens.get("forever"), "other")
+        self.assertEqual(self.tokens.get("unknown"), None)
+        self.assertEqual(self.session.calls, [])
+
+    def test_background_refresh(self):
+        self.tokens.add("page", "token", expires_in=1000)
+        graph = self.tokens.graph("page")
+        self.now += 950
+        # The current token is returned while it is being refreshed.
+        self.assertEqual(self.tokens.get("page"), "token")
+        for _ in range(100):
+            if graph.access_token != "token":
+                break
+            time.sleep(0.01)
+        self.assertEqual(graph.access_token, "token+")
+        self.assertEqual(self.tokens.get("page"), "token+")
+        self.assertEqual(self.tokens.expires("page"), self.now + 1000)
+        self.assertEqual(self.extended, ["token"])
+
+    def test_expired(self):
+        self.tokens.add("page", "token", expires_in=1000)
+        self.now += 1000
+        self.assertEqual(self.tokens.get("page"), "token+")
+
+    def test_refresh_due(self):
+        self.tokens.add("a", "a", expires_in=1000)
+        self.tokens.add("b", "b", expires_in=50)
+        self.assertEqual(self.tokens.refresh_due(), ["b"])
+        self.assertEqual(self.tokens.get("b"), "b+")
+
+    def test_failed_refresh(self):
+        self.session.responder = lambda method, url, kwargs: {
+            "error": {"message": "Invalid token", "code": 190}}
+        self.tokens.add("a", "a", expires_in=50)
+        self.tokens.refresh_due()
+        self.assertIsInstance(self.tokens.errors["a"], facebook.GraphAPIError)
+        self.assertEqual(self.tokens.get("a"), "a")
+        self.assertEqual(self.tokens.refresh_due(), [])
+
+    def test_backend(self):
+        backend = MemoryBackend()
+        TokenManager(self.auth, backend, clock=lambda: self.now).add(
+            "page", "token", expires_in=1000)
+        tokens = TokenManager(self.auth, backend, clock=lambda: self.now)
+        self.assertEqual(tokens.get("page"), "token")
+
+    def test_sqlite_backend_int_key(self):
+        with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+            TokenManager(self.auth, SQLiteBackend(f.name),
+                         clock=lambda: self.now).add(
+                1234, "token", expires_in=1000)
+            tokens = TokenManager(self.auth, SQLiteBackend(f.name),
+                                  clock=lambda: self.now)
+            self.assertEqual(tokens.get(1234), "token")
+
+
+class TestAppSecretProof(unittest.TestCase):
+    """Test signing calls with an appsecret_proof."""
+    def proof(self, token):
+        return hmac.new(b"secret", token.encode("ascii"),
+                        hashlib.sha256).hexdigest()
+
+    def test_proof(self):
+        proof = AppSecretProof("secret", maxsize=2)
+        self.assertEqual(proof("token"), self.proof("token"))
+        self.assertEqual(proof("token"), self.proof("token"))
+        for token in ("a", "b", "c"):
+            self.assertEqual(proof(token), self.proof(token))
+        self.assertIs(get_appsecret_proof("secret"),
+                      get_appsecret_proof("secret"))
+
+    def test_requests(self):
+        session = FakeSession(lambda method, url, kwargs: {"id": "1"})
+        graph = facebook.GraphAPI("token", session=session,
+                                  app_secret="secret")
+        graph.get_object("1")
+        graph.put_object("1", "feed", message="Hello")
+        self.assertEqual(session.calls[0][2]["params"]["appsecret_proof"],
+                         self.proof("token"))
+        self.assertEqual(session.calls[1][2]["data"]["appsecret_proof"],
+                         self.proof("token"))
+
+    def test_paging(self):
+        pages = {"1": {"data": [1], "paging": {
+            "next": "https://graph.facebook.com/v2.2/1/feed?"
+                    "access_token=token&after=2"}},
+            "2": {"data": []}}
+        session = FakeSession(lambda method, url, kwargs: pages[
+            "2" if "after=2" in url else "1"])
+        graph = facebook.GraphAPI("token", session=session,
+                                  app_secret="secret")
+        self.assertEqual(list(graph.iter_connections("1", "feed")), [1])
+        self.assertEqual(session.calls[1][2]["params"],
+                         {"appsecret_proof": self.proof("token")})
+
+    def test_no_secret(self):
+        session = FakeSession(lambda method, url, kwargs: {"id": "1"})
+        facebook.GraphAPI("token", session=session).get_object("1")
+        self.assertNotIn("appsecret_proof", session.calls[0][2]["params"])
+
+
+class TestMetrics(unittest.TestCase):
+    """Test observing calls and collecting their metrics."""
+    def setUp(self):
+        self.events = []
+        self.metrics = MetricsCollector()
+        self.failures = []
+        self.session = FakeSession(self.responder)
+
+    def responder(self, method, url, kwargs):
+        if self.failures:
+            return self.failures.pop(0)
+        return make_response({"id": "1"}, headers={
+            "X-App-Usage": '{"call_count": 10}', "ETag": '"v1"'})
+
+    def make_graph(self, **kwargs):
+        return facebook.GraphAPI(
+            "token", session=self.session,
+            observers=[self.events.append, self.metrics], **kwargs)
+
+    def test_events(self):
+        graph = self.make_graph()
+        graph.get_object("1234", fields="id")
+        event = self.events[0]
+        self.assertEqual((event.method, event.path, event.status_code),
+                         ("GET", "{id}", 200))
+        self.assertEqual(event.response_size, len(b'{"id": "1"}'))
+        self.assertEqual(event.attempts, 1)
+        self.assertEqual(event.usage, {"app": 10})
+        self.assertEqual(event.cache, None)
+        self.assertTrue(event.total >= event.wait + event.decode)
+
+    def test_errors_and_retries(self):
+        clock = FakeClock()
+        graph = self.make_graph(retry_policy=RetryPolicy(
+            clock=clock, sleep=clock.sleep, breaker_threshold=None))
+        self.failures = [make_response(
+            {"error": {"message": "Throttled", "code": 4}}, 400)]
+        graph.get_object("me")
+        self.assertEqual((self.events[0].attempts, self.events[0].retries),
+                         (2, 1))
+        self.failures = [make_response(
+            {"error": {"message": "Invalid", "code": 100}}, 400)]
+        self.assertRaises(facebook.GraphAPIError, graph.get_object, "me")
+        event = self.events[1]
+        self.assertEqual((event.status_code, event.error_code), (400, 100))
+        stats = self.metrics.snapshot()[0]
+        self.assertEqual((stats["path"], stats["count"], stats["errors"],
+                          stats["retries"]), ("me", 2, 1, 1))
+        self.assertEqual(stats["error_codes"], {100: 1})
+
+    def test_cache(self):
+        graph = self.make_graph(cache=ResponseCache(ttl=60))
+        graph.get_object("me")
+        graph.get_object("me")
+        self.assertEqual([event.cache for event in self.events],
+                         ["miss", "hit"])
+        self.assertEqual(self.events[1].attempts, 0)
+        self.assertEqual(self.metrics.snapshot()[0]["cache_hits"], 1)
+
+    def test_broken_observer(self):
+        def broken(event):
+            raise ValueError(event)
+
+        graph = facebook.GraphAPI("token", session=self.session,
+                                  observers=[broken, self.events.append])
+        self.assertEqual(graph.get_object("me"), {"id": "1"})
+        self.assertEqual(len(self.events), 1)
+
+    def test_auth(self):
+        self.session.responder = lambda method, url, kwargs: {
+            "access_token": "token"}
+        auth = facebook.Auth("app", "secret", "http://localhost/",
+                             session=self.session, observers=[self.metrics])
+        auth.get_access_token_from_code("code")
+        self.assertEqual(self.metrics.snapshot()[0]["path"],
+                         "oauth/access_token")
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.mean, 0.5005)
+        for percent in (50, 90, 99):
+            estimate = histogram.percentile(percent)
+            self.assertTrue(percent / 100.0 <= estimate <=
+                            percent / 100.0 * 1.1, (percent, estimate))
+        self.assertEqual(histogram.percentile(100), 1.0)
+        self.assertEqual(Histogram().percentile(50), None)
+
+    def test_slowest(self):
+        for path, latency in (("fast", 0.01), ("slow", 1.0), ("mid", 0.1)):
+            event = facebook.metrics.RequestEvent("GET", path)
+            event.total = latency
+            self.metrics(event)
+        self.assertEqual([stats["path"] for stats in self.metrics.slowest(2)],
+                         ["slow", "mid"])
+
+
+class TestTransports(unittest.TestCase):
+    """Test sending requests through other transports."""
+    def test_memory_transport(self):
+        transport = MemoryTransport({
+            "me": {"id": "1"},
+            "me/picture": IMAGE,
+            "me/feed": lambda method, url, kwargs: {"method": method},
+        })
+        graph = facebook.GraphAPI("token", transport=transport)
+        self.assertEqual(graph.get_object("me"), {"id": "1"})
+        self.assertEqual(graph.put_object("me", "feed", message="Hi"),
+                         {"method": "POST"})
+        self.assertEqual(b"".join(graph.iter_download("me/picture")), IMAGE)
+        # Without range requests, the bytes before the offset are dropped.
+        self.assertEqual(b"".join(graph.iter_download(
+            "me/picture", chunk_size=100, offset=250)), IMAGE[250:])
+        f = io.BytesIO()
+        self.assertEqual(graph.download("me/picture", f, chunk_size=100),
+                         len(IMAGE))
+        self.assertEqual(f.getvalue(), IMAGE)
+        # Bodies of other types, even if they aren't UTF-8.
+        transport.routes["video"] = b"\xff\xd8\xff\xe0"
+        self.assertRaises(facebook.GraphAPIError, graph.get_object, "video")
+        with self.assertRaises(facebook.GraphAPIError) as cm:
+            graph.get_object("unknown")
+        self.assertEqual((cm.exception.code, cm.exception.status_code),
+                         (2500, 404))
+        method, url, kwargs = transport.calls[1]
+        self.assertEqual((method, url), ("POST", facebook.GRAPH_URL + "v2.2/me/feed"))
+        self.assertEqual(kwargs["data"]["message"], "Hi")
+
+    def test_auth_transport(self):
+        transport = MemoryTransport({"oauth/access_token": Response(
+            200, {"Content-Type": "text/plain"},
+            b"access_token=token&expires=5183944")})
+        auth = facebook.Auth("app", "secret", "http://localhost/",
+                             transport=transport)
+        self.assertEqual(auth.get_access_token_from_code("code"),
+                         {"access_token": "token", "expires": "5183944"})
+        self.assertIs(auth.tokens.graph().transport, transport)
+
+    def test_retries_transport_errors(self):
+        errors = [TransportError("reset")]
+
+        def respond(method, url, kwargs):
+            if errors:
+                raise errors.pop()
+            return {"id": "1"}
+
+        clock = FakeClock()
+        graph = facebook.GraphAPI(
+            "token", transport=MemoryTransport(respond),
+            retry_policy=RetryPolicy(clock=clock, sleep=clock.sleep))
+        self.assertEqual(graph.get_object("1"), {"id": "1"})
+
+    @unittest.skipIf(httpx is None, "httpx[http2] is not installed")
+    def test_http2_transport(self):
+        server = LocalGraphServer()
+        transport = HTTP2Transport(max_connections=2)
+        try:
+            graph = facebook.GraphAPI("token", graph_url=server.url,
+                                      transport=transport, max_workers=8)
+            results = list(graph.fan_out(
+                ("GET", str(i), {"fields": "id"}) for i in range(20)))
+            self.assertEqual([r["id"] for r in results],
+                             [str(i) for i in range(20)])
+            result = graph.put_photo(io.BytesIO(b"x" * 10000), message="Hi")
+            self.assertEqual(result["id"], "post")
+            self.assertEqual(b"".join(graph.iter_download("me/picture")),
+                             IMAGE)
+        finally:
+            transport.close()
+            server.stop()
+
+
+class TestResultTypes(unittest.TestCase):
+    """Test compact GraphObject and ColumnarPage results."""
+    def setUp(self):
+        self.feed = {"data": [{"id": "1_1", "message": "Hi", "from": {"id": "2"}},
+                              {"id": "1_2", "from": {"id": "3"}}],
+                     "paging": {"cursors": {"after": "2"}}}
+        self.transport = MemoryTransport({"1": {"id": "1", "name": "One"},
+                                          "1/feed": self.feed})
+
+    def graph(self, results, **kwargs):
+        return facebook.GraphAPI("token", transport=self.transport,
+                                 results=results, **kwargs)
+
+    def test_graph_objects(self):
+        obj = to_objects({"id": "1", "from": {"id": "2"}, "1x": [{"a": 1}]})
+        self.assertIsInstance(obj, GraphObject)
+        self.assertFalse(hasattr(obj, "__dict__"))
+        self.assertEqual((obj.id, obj["from"].id, obj["1x"][0].a),
+                         ("1", "2", 1))
+        self.assertEqual(obj.get("missing", 5), 5)
+        self.assertRaises(KeyError, lambda: obj["missing"])
+        self.assertEqual(obj, {"id": "1", "from": {"id": "2"},
+                               "1x": [{"a": 1}]})
+        self.assertEqual(sorted(obj.keys()), ["1x", "from", "id"])
+        self.assertIs(type(to_objects({"id": "2", "from": {}, "1x": []})),
+                      type(obj))
+        self.assertEqual(pickle.loads(pickle.dumps(obj)), obj)
+
+    def test_objects(self):
+        graph = self.graph("objects")
+        self.assertEqual(graph.get_object("1").name, "One")
+        page = graph.get_connections("1", "feed")
+        self.assertEqual(page["data"][1]["from"].id, "3")
+        self.assertEqual(page.to_dict(), self.feed)
+        items = list(graph.iter_connections("1", "feed", prefetch=0))
+        self.assertEqual([item.id for item in items], ["1_1", "1_2"])
+
+    def test_columns(self):
+        for lazy_pages in (False, True):
+            graph = self.graph("columns", lazy_pages=lazy_pages)
+            page = graph.get_connections("1", "feed", fields="message,from")
+            self.assertIsInstance(page, ColumnarPage)
+            self.assertEqual(len(page), 2)
+            self.assertEqual(page.column("message"), ["Hi", None])
+            self.assertEqual(page.to_dict(), self.feed)
+            self.assertNotIn("message", page.row(-1))
+            self.assertEqual(page["paging"].cursors.after, "2")
+            items = list(graph.iter_connections("1", "feed", fields="id"))
+            self.assertEqual(items, [{"id": "1_1"}, {"id": "1_2"}])
+        # Without fields the columns aren't known.
+        page = graph.get_connections("1", "feed")
+        self.assertIsInstance(page, GraphObject)
+
+    def test_shared_strings(self):
+        page = ColumnarPage("created_time", [
+            {"id": str(i), "created_time": "2015-01-01T00:00:{0:02d}".format(
+                i // 100)} for i in range(200)])
+        values = page.column("created_time")
+        self.assertIs(values[0], values[99])
+        self.assertIsNot(values[0], values[100])
+
+    def test_class_cache_is_bounded(self):
+        for i in range(facebook.objects.MAX_CLASSES + 10):
+            to_objects({"field{0}".format(i): i})
+        self.assertEqual(len(facebook.objects._classes),
+                         facebook.objects.MAX_CLASSES)
+        # Mappings keyed by ids, and very wide dicts, stay dicts.
+        result = to_objects({"1": {"id": "1"}, "2_3": {"id": "2_3"}})
+        self.assertIs(type(result), dict)
+        self.assertIsInstance(result["1"], GraphObject)
+        wide = dict(("f{0}".format(i), i)
+                    for i in range(facebook.objects.MAX_FIELDS + 1))
+        self.assertIs(type(to_objects(wide)), dict)
+
+    def test_invalid_result_type(self):
+        self.assertRaises(facebook.GraphAPIError, self.graph, "rows")
+
+
+class PagedFeeds(object):
+    """Answers feed requests with pages of limit items, size per feed."""
+    def __init__(self, size=7):
+        self.size = size
+        self.fail_after = None
+
+    def __call__(self, method, url, kwargs):
+        if self.fail_after is not None:
+            if not self.fail_after:
+                raise facebook.GraphAPIError("Connection reset")
+            self.fail_after -= 1
+        params = dict(parse_qsl(urlparse(url).query))
+        params.update(kwargs["params"] or {})
+        id = MemoryTransport.path(url).split("/")[0]
+        if id == "deleted":
+            return Response(400, {"content-type": "application/json"},
+                            b'{"error": {"message": "Unsupported", "code": 100}}')
+        start = int(params.get("after", 0))
+        end = min(start + int(params.get("limit", 3)), self.size)
+        page = {"data": [{"id": "{0}_{1}".format(id, i)}
+                         for i in range(start, end)]}
+        if end < self.size:
+            page["paging"] = {"next": "{0}?limit={1}&after={2}&"
+                              "access_token={3}".format(
+                                  url.split("?")[0], params.get("limit", 3),
+                                  end, params["access_token"])}
+        return page
+
+
+class TestExport(unittest.TestCase):
+    """Test exporting connections to NDJSON with checkpoints."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "feeds.ndjson.gz")
+        self.feeds = PagedFeeds()
+        self.graph = facebook.GraphAPI(
+            "token", transport=MemoryTransport(self.feeds))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with gzip.open(self.path) as f:
+            return [json.loads(line.decode("utf-8")) for line in f]
+
+    def expected(self, ids):
+        return [{"object_id": id, "connection": "feed",
+                 "data": {"id": "{0}_{1}".format(id, i)}}
+                for id in ids for i in range(self.feeds.size)]
+
+    def test_export(self):
+        stats = Export(self.graph, self.path, "feed", limit=3).run(["1", "2"])
+        self.assertEqual(self.read(), self.expected(["1", "2"]))
+        self.assertEqual((stats["items"], stats["pages"]), (14, 6))
+        self.assertFalse(os.path.exists(self.path + ".state"))
+
+    def test_result_types(self):
+        for results in ("objects", "columns"):
+            graph = facebook.GraphAPI(
+                "token", transport=MemoryTransport(self.feeds),
+                results=results)
+            Export(graph, self.path, "feed", fields="id").run(["1"])
+            self.assertEqual(self.read(), self.expected(["1"]))
+
+    def test_resume(self):
+        self.feeds.fail_after = 4
+        export = Export(self.graph, self.path, ["feed"], buffer_size=1)
+        self.assertRaises(facebook.GraphAPIError, export.run, ["1", "2"])
+        with open(self.path + ".state") as f:
+            state = json.load(f)
+        self.assertEqual(state["position"], 1)
+        self.assertNotIn("token", state["next"])
+        self.feeds.fail_after = None
+        Export(self.graph, self.path, ["feed"]).run(["1", "2"])
+        self.assertEqual(self.read(), self.expected(["1", "2"]))
+        # The state belongs to the same export only.
+        self.feeds.fail_after = 1
+        self.assertRaises(facebook.GraphAPIError, Export(
+            self.graph, self.path, "feed", buffer_size=1).run, ["1", "2"])
+        self.assertRaises(ValueError, Export(
+            self.graph, self.path, "feed").run, ["3"])
+
+    def test_skip_errors(self):
+        path = os.path.join(self.dir, "feeds.ndjson")
+        stats = Export(self.graph, path, "feed", skip_errors=True).run(
+            ["1", "deleted"])
+        self.assertEqual(stats["errors"], 1)
+        with open(path) as f:
+            self.assertEqual(len(f.readlines()), self.feeds.size)
+
+    def test_command_line(self):
+        from facebook.__main__ import main
+        ids_file = os.path.join(self.dir, "ids.txt")
+        with open(ids_file, "w") as f:
+            f.write("1\n2\n")
+        transport = facebook.GraphAPI.transport
+        facebook.GraphAPI.transport = property(
+            lambda graph: MemoryTransport(self.feeds))
+        try:
+            main(["--access-token", "token", "export", "--connection",
+                  "feed", "--ids-file", ids_file, self.path])
+        finally:
+            facebook.GraphAPI.transport = transport
+        self.assertEqual(self.read(), self.expected(["1", "2"]))
+
+
+class TimedFeed(object):
+    """
+    A feed of posts with created_time, newest first, that supports since
+    and before like the Graph API. Posts are (id, unix time) tuples.
+    """
+    def __init__(self, posts):
+        self.posts = posts
+        self.requests = 0
+
+    def __call__(self, method, url, kwargs):
+        self.requests += 1
+        params = dict(parse_qsl(urlparse(url).query))
+        params.update(kwargs["params"] or {})
+        posts = sorted(self.posts, key=lambda post: -post[1])
+        posts = [post for post in posts
+                 if post[1] >= int(params.get("since", 0))]
+        limit = int(params.get("limit", 2))
+        if "before" in params:
+            # Newer than the cursor, the index of a post.
+            end = [id for id, _ in posts].index(params["before"])
+            start = max(0, end - limit)
+        else:
+            start = int(params.get("after", 0))
+            end = start + limit
+        data = [{"id": id, "created_time": time.strftime(
+            "%Y-%m-%dT%H:%M:%S+0000", time.gmtime(created))}
+            for id, created in posts[start:end]]
+        page = {"data": data, "paging": {}}
+        if data:
+            page["paging"]["cursors"] = {"before": data[0]["id"]}
+        if end < len(posts):
+            page["paging"]["next"] = "{0}?after={1}&access_token=x".format(
+                url.split("?")[0], end)
+        if start > 0:
+            page["paging"]["previous"] = url
+        return page
+
+
+class TestDeltaSync(unittest.TestCase):
+    """Test syncing only the new items of connections."""
+    def setUp(self):
+        self.feed = TimedFeed([("p1", 1000), ("p2", 2000), ("p3", 3000)])
+        self.graph = facebook.GraphAPI(
+            "token", transport=MemoryTransport({"1/feed": self.feed}))
+
+    def ids(self, result):
+        return [item["id"] for item in result.items]
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time("1970-01-01T01:00:00+0100"), 0)
+        self.assertEqual(parse_time("1970-01-01T00:00:10Z"), 10)
+        self.assertEqual(parse_time("1970-01-01T00:00:00-00:01"), 60)
+        self.assertEqual(parse_time("1420070400"), 1420070400)
+        self.assertRaises(ValueError, parse_time, "yesterday")
+
+    def test_time_sync(self):
+        sync = DeltaSync(self.graph, overlap=60, limit=2)
+        result = sync.sync("1", "feed")
+        self.assertTrue(result.full)
+        self.assertEqual(self.ids(result), ["p3", "p2", "p1"])
+        self.assertEqual(result.requests, 2)
+        result = sync.sync("1", "feed")
+        self.assertEqual((self.ids(result), result.requests), ([], 1))
+        self.assertFalse(result.changed)
+        # A new post, one with the same time as the mark and one that shows
+        # up late, within the overlap; p3 at the mark isn't repeated. Posts
+        # that show up later than the overlap are missed.
+        self.feed.posts += [("p4", 4000), ("p5", 3000), ("p6", 2990),
+                            ("p7", 1000)]
+        result = sync.sync("1", "feed")
+        self.assertEqual(self.ids(result), ["p4", "p5", "p6"])
+        self.assertEqual(sync.get_mark("1", "feed")["time"], 4000)
+        result = sync.sync("1", "feed")
+        self.assertEqual(self.ids(result), [])
+        sync.reset("1", "feed")
+        self.assertEqual(len(sync.sync("1", "feed").items), 7)
+
+    def test_start(self):
+        sync = DeltaSync(self.graph, start=1500)
+        self.assertEqual(self.ids(sync.sync("1", "feed")), ["p3", "p2"])
+
+    def test_cursor_sync(self):
+        sync = DeltaSync(self.graph, mode="cursor", limit=2)
+        self.assertEqual(len(sync.sync("1", "feed").items), 3)
+        result = sync.sync("1", "feed")
+        self.assertEqual((self.ids(result), result.requests), ([], 1))
+        self.feed.posts += [("p4", 4000), ("p5", 5000), ("p6", 6000)]
+        result = sync.sync("1", "feed")
+        self.assertEqual(self.ids(result), ["p6", "p5", "p4"])
+        self.assertEqual(self.ids(sync.sync("1", "feed")), [])
+
+    def test_sqlite_store(self):
+        with tempfile.NamedTemporaryFile(suffix=".sqlite") as f:
+            store = SQLiteBackend(f.name, table="facebook_sync")
+            DeltaSync(self.graph, store).sync("1", "feed")
+            sync = DeltaSync(self.graph, store)
+            self.assertEqual(sync.get_mark("1", "feed")["time"], 3000)
+            results = sync.sync_many(["1"], "feed")
+            self.assertEqual(results["1"].requests, 1)
+
+
+def sign_notification(body, secret, algorithm=hashlib.sha256):
+    return hmac.new(secret.encode("ascii"), body, algorithm).hexdigest()
+
+
+class TestWebhooks(unittest.TestCase):
+    """Test receiving webhook notifications."""
+    def setUp(self):
+        self.results = []
+        self.transport = MemoryTransport(
+            lambda method, url, kwargs: fields_responder(method, url, kwargs)
+            if "ids" in (kwargs["params"] or {}) else {"error": {
+                "message": "Unsupported", "code": 100}})
+        self.graph = facebook.GraphAPI("token", transport=self.transport)
+        self.handler = WebhookHandler("secret", "verify", self.results.extend,
+                                      graph=self.graph, batch_window=1,
+                                      old_app_secrets=["old"], fields="name")
+        self.addCleanup(self.handler.close)
+
+    def notification(self, *post_ids, **kwargs):
+        return json.dumps({"object": "page", "entry": [{
+            "id": "1", "time": kwargs.get("time", 100), "changes": [
+                {"field": "feed", "value": {
+                    "item": "post", "verb": kwargs.get("verb", "add"),
+                    "post_id": post_id}} for post_id in post_ids]}]}
+        ).encode("utf-8")
+
+    def post(self, body, secret="secret", header="X-Hub-Signature-256",
+             algorithm=hashlib.sha256):
+        prefix = "sha256=" if algorithm is hashlib.sha256 else "sha1="
+        return self.handler.handle("POST", {}, {header: prefix + (
+            sign_notification(body, secret, algorithm))}, body)
+
+    def test_challenge(self):
+        query = {"hub.mode": "subscribe", "hub.verify_token": "verify",
+                 "hub.challenge": "1158201444"}
+        self.assertEqual(self.handler.handle("GET", query, {}, b""),
+                         (200, "1158201444"))
+        query["hub.verify_token"] = "other"
+        self.assertEqual(self.handler.handle("GET", query, {}, b"")[0], 403)
+        self.assertEqual(self.handler.handle("PUT", {}, {}, b"")[0], 405)
+
+    def test_signatures(self):
+        body = self.notification("1_1")
+        self.assertEqual(self.post(body), (200, "OK"))
+        self.assertEqual(self.post(body, "old", "x-hub-signature",
+                                   hashlib.sha1)[0], 200)
+        self.assertEqual(self.post(body, "other")[0], 403)
+        self.assertEqual(self.post(body + b" ")[0], 200)
+        self.assertEqual(self.post(b"{", "secret")[0], 400)
+        self.assertEqual(self.handler.handle("POST", {}, {}, body)[0], 403)
+        self.assertEqual(self.handler.stats["invalid"], 3)
+
+    def test_batched_hydration(self):
+        for post_id in ("1_1", "1_2", "1_3"):
+            self.post(self.notification(post_id))
+        self.post(self.notification("1_4", verb="remove"))
+        self.post(self.notification("1_2"))  # A repeated delivery.
+        self.handler.close()
+        self.assertEqual(self.handler.stats["duplicates"], 1)
+        self.assertEqual(len(self.transport.calls), 1)
+        self.assertEqual(
+            sorted((change.object_id, obj and obj["id"])
+                   for change, obj in self.results),
+            [("1_1", "1_1"), ("1_2", "1_2"), ("1_3", "1_3"), ("1_4", None)])
+
+    def test_errors(self):
+        self.handler.graph = facebook.GraphAPI(
+            "token", transport=MemoryTransport({}))
+        self.handler.receive(json.loads(self.notification("1_1").decode(
+            "utf-8")))
+        self.handler.close()
+        change, obj = self.results[0]
+        self.assertIsInstance(obj, facebook.GraphAPIError)
+
+    def test_callback_errors(self):
+        records = []
+        log_handler = logging.Handler()
+        log_handler.emit = records.append
+        logger = logging.getLogger("facebook.webhooks")
+        logger.addHandler(log_handler)
+        self.addCleanup(logger.removeHandler, log_handler)
+
+        def callback(results):
+            raise RuntimeError("failed")
+        self.handler.callback = callback
+        self.post(self.notification("1_1"))
+        self.handler.close()
+        self.assertEqual(self.handler.stats["callback_errors"], 1)
+        self.assertEqual(records[0].exc_info[0], RuntimeError)
+        # Later notifications are still processed.
+        self.handler.callback = self.results.extend
+        self.post(self.notification("1_2"))
+        self.handler.close()
+        self.assertEqual(len(self.results), 1)
+
+    def test_parse_changes(self):
+        changes = parse_changes({"object": "user", "entry": [
+            {"uid": "5", "time": 1, "changed_fields": ["name", "email"]}]})
+        self.assertEqual([(c.entry_id, c.field, c.object_id)
+                          for c in changes],
+                         [("5", "name", "5"), ("5", "email", "5")])
+
+    def test_auth_handler(self):
+        auth = facebook.Auth("app", "secret", "http://localhost/",
+                             old_app_secrets=["old"])
+        handler = auth.webhook_handler("verify")
+        body = self.notification("1_1")
+        handler.verify_signature(body, {"X-Hub-Signature-256": "sha256=" +
+                                        sign_notification(body, "old")})
+        handler.close()
+
+
+def fields_responder(method, url, kwargs):
+    """Answer ids= requests with a value for every requested field."""
+    time.sleep(0.02)
+    params = kwargs["params"]
+    fields = split_fields(params.get("fields", "name"))
+    return dict((id, dict([("id", id)] + [(field, id + field)
+                                          for field in fields]))
+                for id in params["ids"].split(","))
+
+
+class TestCoalescer(unittest.TestCase):
+    """Test merging get_object calls into ids= requests."""
+    def setUp(self):
+        self.session = FakeSession(fields_responder)
+        self.graph = facebook.GraphAPI("token", session=self.session)
+        self.objects = Coalescer(self.graph, window=0.05)
+
+    def get_objects(self, calls):
+        results = [None] * len(calls)
+
+        def get(index):
+            id, args = calls[index]
+            results[index] = self.objects.get_object(id, **args)
+
+        threads = [threading.Thread(target=get, args=(i,))
+                   for i in range(len(calls))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_split_fields(self):
+        self.assertEqual(split_fields("id, posts{id,message},picture"),
+                         ["id", "posts{id,message}", "picture"])
+        self.assertEqual(split_fields(["a", "b"]), ["a", "b"])
+
+    def test_coalesced(self):
+        results = self.get_objects([("1", {"fields": "name"}),
+                                    ("2", {"fields": "name,about"}),
+                                    ("1", {"fields": "about"})])
+        self.assertEqual(results, [{"id": "1", "name": "1name"},
+                                   {"id": "2", "name": "2name",
+                                    "about": "2about"},
+                                   {"id": "1", "about": "1about"}])
+        self.assertEqual(len(self.session.calls), 1)
+        params = self.session.calls[0][2]["params"]
+        self.assertEqual(sorted(params["ids"].split(",")), ["1", "2"])
+        self.assertEqual(params["fields"], "about,name")
+
+    def test_single_flight(self):
+        first = self.objects.submit("1", fields="name")
+        self.assertIs(self.objects.submit("1", fields="name"), first)
+        self.assertEqual(first.result(), {"id": "1", "name": "1name"})
+        self.assertEqual(len(self.session.calls), 1)
+        # Finished calls are not cached.
+        self.objects.get_object("1", fields="name")
+        self.assertEqual(len(self.session.calls), 2)
+
+    def test_separate_batches(self):
+        self.get_objects([("1", {"fields": "name"}), ("2", {}),
+                          ("3", {"fields": "name", "locale": "nl_NL"})])
+        self.assertEqual(len(self.session.calls), 3)
+
+    def test_max_keys(self):
+        self.objects = Coalescer(self.graph, window=10, max_keys=3)
+        results = self.get_objects([(str(i), {}) for i in range(3)])
+        self.assertEqual([r["id"] for r in results], ["0", "1", "2"])
+        self.assertEqual(self.objects.requests, 1)
+
+    def test_errors(self):
+        self.session.responder = objects_responder
+        futures = [self.objects.submit(id) for id in ("1", "invalid")]
+        self.assertEqual(futures[0].result()["id"], "1")
+        self.assertRaises(facebook.GraphAPIError, futures[1].result)
+
+
+IMPORT_SCRIPT = """
+import json, sys, timeit
+start = timeit.default_timer()
+import facebook
+seconds = timeit.default_timer() - start
+imported = sorted(sys.modules)
+auth = facebook.Auth("app", "secret", "http://localhost/")
+auth.parse_signed_request(sys.argv[1])
+graph = facebook.GraphAPI("token", transport=facebook.transport.MemoryTransport(
+    {"me": {"id": "1"}}))
+graph.get_object("me")
+print(json.dumps({"seconds": seconds, "imported": imported,
+                  "used": sorted(sys.modules)}))
+"""
+
+
+class TestImport(unittest.TestCase):
+    """Test that importing the package stays cheap."""
+    # Before the HTTP stack was imported lazily this took over 100ms, most
+    # of it spent in requests.
+    BUDGET = 0.05
+
+    def run_import(self):
+        signed_request = make_signed_request(
+            {"algorithm": "HMAC-SHA256", "issued_at": int(time.time())},
+            "secret")
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_SCRIPT, signed_request],
+            cwd=os.path.join(os.path.dirname(__file__), ".."))
+        return json.loads(output.decode("utf-8"))
+
+    def test_lazy_imports(self):
+        result = self.run_import()
+        for name in ("requests", "urllib3", "concurrent.futures", "sqlite3",
+                     "orjson", "ujson", "aiohttp", "httpx"):
+            self.assertNotIn(name, result["imported"])
+        # Neither verifying a signed request nor a call over another
+        # transport needs requests.
+        self.assertNotIn("requests", result["used"])
+
+    def test_import_time(self):
+        # The best of a few runs, as a busy machine makes single runs slow.
+        seconds = min(self.run_import()["seconds"] for _ in range(3))
+        self.assertLess(seconds, self.BUDGET)
+
+
+@unittest.skipIf(asyncio is None, "asyncio and aiohttp are required")
+class TestAsyncGraphAPI(unittest.TestCase):
+    """Test the asyncio client against a local stand-in server."""
+    def setUp(self):
+        self.server = LocalGraphServer()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.graph = facebook.aio.AsyncGraphAPI(
+            "token", graph_url=self.server.url, max_concurrency=5)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.graph.close())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.server.stop()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_get_object(self):
+        result = self.run_async(self.graph.get_object("me", fields="name"))
+        self.assertEqual(result["id"], "me")
+        self.assertEqual(result["query"],
+                         {"fields": "name", "access_token": "token"})
+
+    def test_concurrent_requests(self):
+        calls = [self.graph.get_connections(str(i), "feed")
+                 for i in range(50)]
+        results = self.run_async(asyncio.gather(*calls))
+        self.assertEqual([r["id"] for r in results],
+                         ["{0}/feed".format(i) for i in range(50)])
+
+    def test_get_objects(self):
+        ids = [str(i) for i in range(120)]
+        result = self.run_async(self.graph.get_objects(ids))
+        self.assertEqual(sorted(result), sorted(ids))
+
+    def test_coalescer(self):
+        objects = facebook.aio.AsyncCoalescer(self.graph, window=0.01)
+        calls = [objects.get_object(str(i % 5), fields="name")
+                 for i in range(10)]
+        results = self.run_async(asyncio.gather(*calls))
+        self.assertEqual([r["id"] for r in results],
+                         [str(i % 5) for i in range(10)])
+        self.assertEqual(objects.requests, 1)
+
+    def test_observers(self):
+        events = []
+        self.graph.observers.append(events.append)
+        self.run_async(self.graph.get_object("1234"))
+        self.assertEqual((events[0].path, events[0].status_code),
+                         ("{id}", 200))
+        self.assertTrue(events[0].response_size > 0)
+
+    def test_put_photo(self):
+        result = self.run_async(self.graph.put_photo(
+            b"image data", message="Look at this"))
+        self.assertEqual(result["id"], "post")
+
+    def test_auth(self):
+        auth = facebook.aio.AsyncAuth("app", "secret", "http://localhost/",
+                                      graph_url=self.server.url)
+        self.assertEqual(self.run_async(auth.get_app_access_token()),
+                         "app|secret")
+        self.assertEqual(
+            self.run_async(auth.get_app_access_token(offline=False)),
+            "token-app")
+        result = self.run_async(auth.get_access_token_from_code("code"))
+        self.assertEqual(result["access_token"], "token-code")
+        # Also an async context manager, closing the graph's session.
+        self.assertIs(self.run_async(auth.__aenter__()), auth)
+        self.run_async(auth.__aexit__(None, None, None))
+        self.assertIsNone(auth.graph._session)
+        self.assertRaises(TypeError, facebook.aio.AsyncAuth, "app", "secret",
+                          "http://localhost/", transport=MemoryTransport({}))
+
+    def test_concurrent_code_exchanges(self):
+        auth = facebook.aio.AsyncAuth("app", "secret", "http://localhost/",
+                                      graph_url=self.server.url)
+        exchanges = []
+
+        def exchange(code):
+            exchanges.append(code)
+            future = self.loop.create_future()
+            self.loop.call_later(0.05, future.set_result,
+                                 {"access_token": "token-" + code})
+            return future
+        auth.get_access_token_from_code = exchange
+        cookies = {"fbsr_app": make_signed_request(
+            {"algorithm": "HMAC-SHA256", "code": "code", "user_id": "1",
+             "issued_at": int(time.time())}, "secret")}
+        users = self.run_async(asyncio.gather(*[
+            auth.get_user_from_cookie(cookies, validate=True)
+            for _ in range(5)]))
+        self.assertEqual([user["access_token"] for user in users],
+                         ["token-code"] * 5)
+        self.assertEqual(exchanges, ["code"])
+        self.assertEqual(auth._exchanges, {})
+        self.run_async(auth.close())
+
+
 if __name__ == '__main__':
     unittest.main()